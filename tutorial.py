@@ -1,18 +1,64 @@
-import pygame
+import argparse
+import csv
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import Mapping
 from os import listdir
 from os.path import isfile, join
 
-pygame.init()
 
-pygame.display.set_caption("Platformer")
+def _has_option(name, argv=None):
+    return any(arg == name or arg.startswith(name + "=") for arg in (sys.argv[1:] if argv is None else argv))
+
+
+if _has_option("--headless") or (_has_option("--replay") and not _has_option("--speed")):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 WIDTH, HEIGHT = 1000, 650
 FPS = 60
+RENDER_FPS = 60
+MAX_FRAME_TIME = 0.25
 PLAYER_VEL = 5
+BLOCK_SIZE = 96
+DIRTY_RECTS = True
+BACKGROUND_PARALLAX = 0
+STREAM_LEVELS = False
+RECORD_DIR = None
+PROFILE_DIR = None
+DEFAULT_PROFILE_DIR = "profiles"
 skin = "MaskDude"
 skin_2 = "MaskDude"
 
-window = pygame.display.set_mode((WIDTH, HEIGHT))
+
+def init_display():
+    """
+    Инициализирует pygame и задаёт режим дисплея, без которого не работают `convert`
+    и `convert_alpha`.
+
+    Если окно игры ещё не создано, создаётся скрытое окно 1×1, поэтому загрузка ресурсов
+    в тестах и прогонах без окна ничего не показывает на экране. `App.window` потом
+    заменяет его настоящим окном.
+    """
+    if pygame.display.get_surface() is None:
+        pygame.init()
+        pygame.display.set_mode((1, 1), pygame.HIDDEN)
 
 
 def flip(sprites):
@@ -28,7 +74,160 @@ def flip(sprites):
     return [pygame.transform.flip(sprite, True, False) for sprite in sprites]
 
 
-def load_sprite_sheets(dir1, dir2, width, height, direction=False):
+class TextureAtlas:
+    """
+    Общий атлас текстур: кадры персонажей, предметов и земли упаковываются полками
+    в большие страницы в формате дисплея, а наружу отдаются подповерхности страниц.
+
+    Подповерхность не копирует пиксели и держит страницу живой, поэтому `clear` лишь
+    забывает страницы: уже выданные кадры продолжают работать, а новые попадают
+    в новые страницы. Место вытесненных из кэшей кадров не переиспользуется.
+
+    :param page_size: Размер одной страницы.
+    :type page_size: tuple
+    """
+    PAGE_SIZE = (1024, 1024)
+
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+        self.pages = []
+        self._page = None
+        self._format = None
+        self._x = self._y = self._shelf = 0
+
+    def allocate(self, size):
+        """
+        Выделяет в атласе прозрачную область размера `size`.
+
+        Области больше страницы получают собственную страницу.
+
+        :param size: Размер (ширина, высота) области.
+        :type size: tuple
+        :rtype: pygame.Surface
+        """
+        width, height = size
+        page_width, page_height = self.page_size
+        if width > page_width or height > page_height:
+            page = self._new_page(size)
+            self.pages.append(page)
+            return page.subsurface((0, 0, width, height))
+
+        if self._x + width > page_width:
+            self._x, self._y, self._shelf = 0, self._y + self._shelf, 0
+        if self._page is None or self._y + height > page_height:
+            self._page = self._new_page(self.page_size)
+            self.pages.append(self._page)
+            self._x = self._y = self._shelf = 0
+        region = self._page.subsurface((self._x, self._y, width, height))
+        self._x += width
+        self._shelf = max(self._shelf, height)
+        return region
+
+    def _new_page(self, size):
+        # Страница сразу создаётся в формате дисплея: convert_alpha копировал бы её целиком.
+        if self._format is None:
+            init_display()
+            self._format = pygame.Surface((1, 1), pygame.SRCALPHA).convert_alpha()
+        return pygame.Surface(size, pygame.SRCALPHA, self._format)
+
+    def add(self, surface):
+        """
+        Копирует `surface` в атлас.
+
+        :rtype: pygame.Surface
+        """
+        region = self.allocate(surface.get_size())
+        region.blit(surface, (0, 0))
+        return region
+
+    def clear(self):
+        self.pages = []
+        self._page = None
+        self._format = None
+        self._x = self._y = self._shelf = 0
+
+    def __len__(self):
+        return len(self.pages)
+
+
+texture_atlas = TextureAtlas()
+
+
+class SpriteSheets(Mapping):
+    """
+    Неизменяемый словарь «имя анимации -> кортеж кадров».
+
+    Отражённые кадры для направления "left" строятся из кадров "right" при первом
+    обращении к анимации и складываются в тот же атлас, поэтому анимации, которые ни разу
+    не показываются влево (например, кадр скина на кнопке меню), не занимают памяти.
+
+    :param frames: Кадры анимаций.
+    :type frames: dict
+    :param mirrored: Имена отражённых анимаций и имена анимаций, из которых они строятся.
+    :type mirrored: dict
+    :param atlas: Атлас для отражённых кадров (по умолчанию отдельные поверхности).
+    :type atlas: TextureAtlas or None
+    """
+    def __init__(self, frames, mirrored=None, atlas=None):
+        self._frames = {name: tuple(sprites) for name, sprites in frames.items()}
+        self._mirrored = dict(mirrored or {})
+        self._names = []
+        for name in self._frames:
+            self._names.append(name)
+            self._names.extend(left for left, right in self._mirrored.items() if right == name)
+        self._atlas = atlas
+
+    def __getitem__(self, name):
+        frames = self._frames.get(name)
+        if frames is None:
+            flipped = flip(self._frames[self._mirrored[name]])
+            if self._atlas is not None:
+                flipped = [self._atlas.add(sprite) for sprite in flipped]
+            frames = self._frames[name] = tuple(flipped)
+        return frames
+
+    def __contains__(self, name):
+        return name in self._frames or name in self._mirrored
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def built(self, name):
+        return name in self._frames
+
+
+class FrameMasks(Mapping):
+    """
+    Неизменяемый словарь масок столкновений для кадров `SpriteSheets` с теми же именами
+    и индексами. Маски анимации строятся при первом обращении к ней.
+
+    :param sprites: Кадры анимаций.
+    :type sprites: Mapping
+    """
+    def __init__(self, sprites):
+        self._sprites = sprites
+        self._masks = {}
+
+    def __getitem__(self, name):
+        masks = self._masks.get(name)
+        if masks is None:
+            masks = self._masks[name] = tuple(pygame.mask.from_surface(frame) for frame in self._sprites[name])
+        return masks
+
+    def __contains__(self, name):
+        return name in self._sprites
+
+    def __iter__(self):
+        return iter(self._sprites)
+
+    def __len__(self):
+        return len(self._sprites)
+
+
+def load_sprite_sheets(dir1, dir2, width, height, direction=False, atlas=None):
     """
     Загружает листы спрайтов из указанной папки, разбивает изображения на спрайты
     заданных размеров и сохраняет их в словарь, с возможностью отражать их по горизонтали.
@@ -43,56 +242,314 @@ def load_sprite_sheets(dir1, dir2, width, height, direction=False):
     :type height: int
     :param direction: Флаг, определяющий, нужно ли создавать зеркальные спрайты (для направления "left").
     :type direction: bool, по умолчанию False
-    :returns: Словарь с загруженными и разбитыми спрайтами.
-    :rtype: dict
+    :param atlas: Атлас, в который масштабируются кадры (по умолчанию общий `texture_atlas`).
+    :type atlas: TextureAtlas or None
+    :returns: Словарь с загруженными и разбитыми спрайтами; зеркальные кадры строятся
+        при первом обращении к ним.
+    :rtype: SpriteSheets
     :raises FileNotFoundError: Если указанные папки или файлы не существуют.
     :raises pygame.error: Если возникла ошибка при загрузке изображения.
     :raises ValueError: Если изображения не соответствуют заданной ширине и высоте.
     """
+    init_display()
+    sheets = {os.path.basename(path): pygame.image.load(path).convert_alpha()
+              for path in sprite_sheet_files(dir1, dir2)}
+    return slice_sprite_sheets(sheets, width, height, direction, atlas)
+
+
+def sprite_sheet_files(dir1, dir2):
+    """
+    Возвращает пути к файлам листов спрайтов в папке assets/`dir1`/`dir2`.
+
+    :rtype: list of str
+    """
     path = join("assets", dir1, dir2)
-    images = [f for f in listdir(path) if isfile(join(path, f))]
+    return [join(path, f) for f in listdir(path) if isfile(join(path, f))]
 
-    all_sprites = {}
 
-    for image in images:
-        sprite_sheet = pygame.image.load(join(path, image)).convert_alpha()
+def slice_sprite_sheets(sheets, width, height, direction=False, atlas=None):
+    """
+    Разбивает уже загруженные листы спрайтов на кадры так же, как `load_sprite_sheets`.
 
+    :param sheets: Листы в формате дисплея по именам файлов.
+    :type sheets: dict
+    :param atlas: Атлас для кадров (по умолчанию общий `texture_atlas`).
+    :type atlas: TextureAtlas or None
+    :rtype: SpriteSheets
+    """
+    if atlas is None:
+        atlas = texture_atlas
+
+    all_sprites = {}
+    mirrored = {}
+
+    for image, sprite_sheet in sheets.items():
+        # Кадр масштабируется прямо из подповерхности листа в область атласа, без
+        # промежуточных поверхностей.
         sprites = []
         for i in range(sprite_sheet.get_width() // width):
-            surface = pygame.Surface((width, height), pygame.SRCALPHA, 32)
-            rect = pygame.Rect(i * width, 0, width, height)
-            surface.blit(sprite_sheet, (0, 0), rect)
-            sprites.append(pygame.transform.scale2x(surface))
+            frame = sprite_sheet.subsurface((i * width, 0, width, height))
+            sprites.append(pygame.transform.scale2x(frame, atlas.allocate((width * 2, height * 2))))
 
+        name = image.replace(".png", "")
         if direction:
-            all_sprites[image.replace(".png", "") + "_right"] = sprites
-            all_sprites[image.replace(".png", "") + "_left"] = flip(sprites)
+            all_sprites[name + "_right"] = sprites
+            mirrored[name + "_left"] = name + "_right"
         else:
-            all_sprites[image.replace(".png", "")] = sprites
+            all_sprites[name] = sprites
+
+    return SpriteSheets(all_sprites, mirrored, atlas)
+
+
+class SpriteCache:
+    """
+    Общий для всего процесса LRU-кэш листов спрайтов персонажей.
+
+    Ключ кэша — (папка, скин, ширина, высота, флаг направления). Значение — неизменяемый
+    словарь, в котором каждому имени анимации соответствует кортеж кадров, и такой же
+    словарь с масками столкновений для каждого кадра, которые строятся при первом
+    обращении к анимации. Один и тот же
+    объект отдаётся обоим игрокам, при перезапуске уровня и кнопкам выбора скина в меню,
+    поэтому повторный вход в уровень не читает файлы с диска.
+
+    :param maxsize: Максимальное количество хранимых листов спрайтов.
+    :type maxsize: int
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def _entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        return self.put(key, load_sprite_sheets(*key))
+
+    def put(self, key, sheets):
+        """
+        Кладёт в кэш листы спрайтов, загруженные заранее, например фоновым загрузчиком.
+
+        :param key: (папка, скин, ширина, высота, флаг направления).
+        :type key: tuple
+        :param sheets: Листы спрайтов.
+        :type sheets: SpriteSheets or dict
+        """
+        sprites = sheets if isinstance(sheets, SpriteSheets) else SpriteSheets(sheets)
+        entry = (sprites, FrameMasks(sprites))
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def get(self, dir1, dir2, width, height, direction=False):
+        """
+        Возвращает листы спрайтов из кэша, при промахе загружает их через `load_sprite_sheets`.
+
+        :returns: Неизменяемый словарь «имя анимации -> кортеж кадров».
+        :rtype: SpriteSheets
+        """
+        return self._entry((dir1, dir2, width, height, direction))[0]
+
+    def masks(self, dir1, dir2, width, height, direction=False):
+        """
+        Возвращает маски столкновений для кадров, отданных `get` с теми же аргументами.
+
+        :returns: Неизменяемый словарь «имя анимации -> кортеж масок» с теми же индексами кадров.
+        :rtype: FrameMasks
+        """
+        return self._entry((dir1, dir2, width, height, direction))[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+sprite_cache = SpriteCache()
+
+
+def get_character_sprites(name):
+    """
+    Возвращает кэшированные листы спрайтов персонажа с кадрами для обоих направлений.
+
+    :param name: Название скина (папка в assets/MainCharacters).
+    :type name: str
+    :rtype: SpriteSheets
+    """
+    return sprite_cache.get("MainCharacters", name, 32, 32, True)
 
-    return all_sprites
 
+def get_character_masks(name):
+    """
+    Возвращает кэшированные маски кадров персонажа, соответствующие `get_character_sprites`.
+
+    :param name: Название скина (папка в assets/MainCharacters).
+    :type name: str
+    :rtype: FrameMasks
+    """
+    return sprite_cache.masks("MainCharacters", name, 32, 32, True)
+
+
+def get_character_hitbox(name):
+    """
+    Возвращает прямоугольник столкновений персонажа в координатах кадра.
+
+    По ширине он охватывает непрозрачные пиксели кадров покоя и стоит по центру кадра,
+    поэтому не меняется при повороте, а снизу доходит до края кадра, чтобы персонаж
+    стоял на блоке без зазора.
 
-def get_block(size):
+    :param name: Название скина (папка в assets/MainCharacters).
+    :type name: str
+    :rtype: pygame.Rect
+    """
+    masks = get_character_masks(name)["idle_right"]
+    bounds = [rect for mask in masks for rect in mask.get_bounding_rects()]
+    box = bounds[0].unionall(bounds[1:])
+    width, height = masks[0].get_size()
+    return pygame.Rect((width - box.width) // 2, box.top, box.width, height - box.top)
+
+
+TERRAIN_IMAGE = join("assets", "Terrain", "Terrain.png")
+
+
+def get_block(size, image=None):
     """
     Загружает блок из файла "Terrain.png", обрезает его по заданному размеру и возвращает 
     увеличенную версию этого блока.
 
     :param size: Размер блока (ширина и высота), который нужно извлечь из изображения.
     :type size: int
+    :param image: Уже загруженное изображение "Terrain.png" (по умолчанию загружается с диска).
+    :type image: pygame.Surface or None
     :returns: Увеличенная версия блока в виде объекта `pygame.Surface`.
     :rtype: pygame.Surface
     :raises pygame.error: Если изображение "Terrain.png" не удаётся загрузить.
     :raises ValueError: Если размер блока больше доступного размера в изображении.
     """
-    path = join("assets", "Terrain", "Terrain.png")
-    image = pygame.image.load(path).convert_alpha()
+    if image is None:
+        init_display()
+        image = pygame.image.load(TERRAIN_IMAGE).convert_alpha()
     surface = pygame.Surface((size, size), pygame.SRCALPHA, 32)
     rect = pygame.Rect(96, 0, size, size)
     surface.blit(image, (0, 0), rect)
     return pygame.transform.scale2x(surface)
 
 
+FRUIT_IMAGE = join("assets", "Items", "Fruits", "Mashroom.png")
+MOB_IMAGE = join("assets", "Items", "Fruits", "zombi.png")
+BUFF_IMAGE = join("assets", "Traps", "Sand Mud Ice", "Ice Particle.png")
+
+
+class ResourceManager:
+    """
+    Менеджер общих ресурсов объектов уровня (приспособленец).
+
+    Каждое исходное изображение загружается с диска один раз, а для каждой пары
+    (ресурс, размер) хранится одна масштабированная поверхность и одна маска столкновений,
+    которые разделяются всеми экземплярами `Block`, `Fruit`, `Mob` и `Buff`. Масштабированные
+    поверхности лежат в атласе текстур, их нельзя изменять на месте.
+
+    :param atlas: Атлас для масштабированных поверхностей (по умолчанию общий `texture_atlas`).
+    :type atlas: TextureAtlas or None
+    """
+    def __init__(self, atlas=None):
+        self.atlas = texture_atlas if atlas is None else atlas
+        self._images = {}
+        self._resources = {}
+
+    def image(self, path):
+        """
+        Возвращает исходное изображение, загружая его с диска только при первом обращении.
+
+        :param path: Путь к файлу изображения.
+        :type path: str
+        :rtype: pygame.Surface
+        """
+        image = self._images.get(path)
+        if image is None:
+            init_display()
+            image = pygame.image.load(path).convert_alpha()
+            self._images[path] = image
+        return image
+
+    def put_image(self, path, image):
+        """
+        Кладёт в менеджер исходное изображение, загруженное заранее.
+
+        :param image: Изображение в формате дисплея.
+        :type image: pygame.Surface
+        """
+        self._images[path] = image
+
+    def scaled(self, path, size):
+        """
+        Возвращает общую пару (поверхность, маска) для изображения, масштабированного до `size`.
+
+        :param path: Путь к файлу изображения.
+        :type path: str
+        :param size: Размер (ширина, высота) итоговой поверхности.
+        :type size: tuple
+        :rtype: tuple (pygame.Surface, pygame.mask.Mask)
+        """
+        key = (path, size)
+        resource = self._resources.get(key)
+        if resource is None:
+            surface = pygame.transform.scale(self.image(path), size, self.atlas.allocate(size))
+            resource = (surface, pygame.mask.from_surface(surface))
+            self._resources[key] = resource
+        return resource
+
+    def block(self, size):
+        """
+        Возвращает общую пару (поверхность, маска) для блока земли размера `size`.
+
+        :param size: Размер блока.
+        :type size: int
+        :rtype: tuple (pygame.Surface, pygame.mask.Mask)
+        """
+        key = ("block", size)
+        resource = self._resources.get(key)
+        if resource is None:
+            surface = self.atlas.allocate((size, size))
+            surface.blit(get_block(size, self.image(TERRAIN_IMAGE)), (0, 0))
+            resource = (surface, pygame.mask.from_surface(surface))
+            self._resources[key] = resource
+        return resource
+
+    def background(self, name, parallax=0):
+        """
+        Возвращает общий собранный фон `Background` для изображения `name`.
+
+        :rtype: Background
+        """
+        key = ("background", name, parallax)
+        resource = self._resources.get(key)
+        if resource is None:
+            resource = self._resources[key] = Background(name, parallax)
+        return resource
+
+    def clear(self):
+        self._images.clear()
+        self._resources.clear()
+
+    def __len__(self):
+        return len(self._resources)
+
+
+resources = ResourceManager()
+
+
 class Player(pygame.sprite.Sprite):
     """
     Класс игрока первого персонажа, наследующий от pygame.sprite.Sprite.
@@ -110,7 +567,9 @@ class Player(pygame.sprite.Sprite):
     ANIMATION_DELAY = 3
 
     def __init__(self, x, y, width, height):
-        self.SPRITES = load_sprite_sheets("MainCharacters", f"{skin}", 32, 32, True)
+        self.SPRITES = get_character_sprites(skin)
+        self.MASKS = get_character_masks(skin)
+        self.hitbox = get_character_hitbox(skin)
         super().__init__()
         self.rect = pygame.Rect(x, y, width, height)
         self.x_vel = 0
@@ -122,6 +581,7 @@ class Player(pygame.sprite.Sprite):
         self.jump_count = 0
         self.hit = False
         self.hit_count = 0
+        self.prev_pos = self.rect.topleft
 
     def jump(self):
         self.y_vel = -self.GRAVITY * 8
@@ -150,9 +610,14 @@ class Player(pygame.sprite.Sprite):
             self.direction = "right"
             self.animation_count = 0
 
-    def loop(self, fps):
+    def loop(self, fps, solids=None):
+        self.prev_pos = self.rect.topleft
         self.y_vel += min(1, (self.fall_count / fps) * self.GRAVITY)
-        self.move(self.x_vel, self.y_vel)
+        if solids is None:
+            self.move(self.x_vel, self.y_vel)
+            blocked = None
+        else:
+            blocked = self.move_and_collide(solids)
 
         if self.hit:
             self.hit_count += 1
@@ -162,6 +627,22 @@ class Player(pygame.sprite.Sprite):
 
         self.fall_count += 1
         self.update_sprite()
+        if blocked is not None:
+            if self.y_vel > 0:
+                self.landed()
+            elif self.y_vel < 0:
+                self.hit_head()
+
+    def collision_rect(self):
+        return self.hitbox.move(self.rect.topleft)
+
+    def move_and_collide(self, solids):
+        target = self.rect.copy()
+        target.x += self.x_vel
+        target.y += self.y_vel
+        box, _, blocked = sweep(self.collision_rect(), target.x - self.rect.x, target.y - self.rect.y, solids)
+        self.rect.topleft = (box.x - self.hitbox.x, box.y - self.hitbox.y)
+        return blocked
 
     def landed(self):
         self.fall_count = 0
@@ -191,15 +672,21 @@ class Player(pygame.sprite.Sprite):
         sprites = self.SPRITES[sprite_sheet_name]
         sprite_index = (self.animation_count // self.ANIMATION_DELAY) % len(sprites)
         self.sprite = sprites[sprite_index]
+        self.sprite_mask = self.MASKS[sprite_sheet_name][sprite_index]
         self.animation_count += 1
         self.update()
 
     def update(self):
         self.rect = self.sprite.get_rect(topleft = (self.rect.x, self.rect.y))
-        self.mask = pygame.mask.from_surface(self.sprite)
+        self.mask = self.sprite_mask
 
-    def draw(self, win, offset_x):
-        win.blit(self.sprite, (self.rect.x - offset_x, self.rect.y))
+    def render_pos(self, alpha=1):
+        x, y = self.prev_pos
+        return round(x + (self.rect.x - x) * alpha), round(y + (self.rect.y - y) * alpha)
+
+    def draw(self, win, offset_x, alpha=1):
+        x, y = self.render_pos(alpha)
+        win.blit(self.sprite, (x - offset_x, y))
 
 
 class Player_2(pygame.sprite.Sprite):
@@ -219,7 +706,9 @@ class Player_2(pygame.sprite.Sprite):
     ANIMATION_DELAY = 2
 
     def __init__(self, x, y, width, height):
-        self.SPRITES = load_sprite_sheets("MainCharacters", f"{skin_2}", 32, 32, True)
+        self.SPRITES = get_character_sprites(skin_2)
+        self.MASKS = get_character_masks(skin_2)
+        self.hitbox = get_character_hitbox(skin_2)
         super().__init__()
         self.rect = pygame.Rect(x, y, width, height)
         self.x_vel = 0
@@ -231,6 +720,7 @@ class Player_2(pygame.sprite.Sprite):
         self.jump_count = 0
         self.hit = False
         self.hit_count = 0
+        self.prev_pos = self.rect.topleft
 
     def jump(self):
         self.y_vel = -self.GRAVITY * 8
@@ -259,9 +749,14 @@ class Player_2(pygame.sprite.Sprite):
             self.direction = "right"
             self.animation_count = 0
 
-    def loop(self, fps):
+    def loop(self, fps, solids=None):
+        self.prev_pos = self.rect.topleft
         self.y_vel += min(1, (self.fall_count / fps) * self.GRAVITY)
-        self.move(self.x_vel, self.y_vel)
+        if solids is None:
+            self.move(self.x_vel, self.y_vel)
+            blocked = None
+        else:
+            blocked = self.move_and_collide(solids)
 
         if self.hit:
             self.hit_count += 1
@@ -271,6 +766,22 @@ class Player_2(pygame.sprite.Sprite):
 
         self.fall_count += 1
         self.update_sprite()
+        if blocked is not None:
+            if self.y_vel > 0:
+                self.landed()
+            elif self.y_vel < 0:
+                self.hit_head()
+
+    def collision_rect(self):
+        return self.hitbox.move(self.rect.topleft)
+
+    def move_and_collide(self, solids):
+        target = self.rect.copy()
+        target.x += self.x_vel
+        target.y += self.y_vel
+        box, _, blocked = sweep(self.collision_rect(), target.x - self.rect.x, target.y - self.rect.y, solids)
+        self.rect.topleft = (box.x - self.hitbox.x, box.y - self.hitbox.y)
+        return blocked
 
     def landed(self):
         self.fall_count = 0
@@ -300,17 +811,150 @@ class Player_2(pygame.sprite.Sprite):
         sprites = self.SPRITES[sprite_sheet_name]
         sprite_index = (self.animation_count // self.ANIMATION_DELAY) % len(sprites)
         self.sprite = sprites[sprite_index]
+        self.sprite_mask = self.MASKS[sprite_sheet_name][sprite_index]
         self.animation_count += 1
         self.update()
 
     def update(self):
         self.rect = self.sprite.get_rect(topleft = (self.rect.x, self.rect.y))
-        self.mask = pygame.mask.from_surface(self.sprite)
+        self.mask = self.sprite_mask
 
 
-    def draw(self, win, offset_x):
-        win.blit(self.sprite, (self.rect.x - offset_x, self.rect.y))
+    def render_pos(self, alpha=1):
+        x, y = self.prev_pos
+        return round(x + (self.rect.x - x) * alpha), round(y + (self.rect.y - y) * alpha)
+
+    def draw(self, win, offset_x, alpha=1):
+        x, y = self.render_pos(alpha)
+        win.blit(self.sprite, (x - offset_x, y))
+
+
+
+class EntityStore:
+    """
+    Хранилище состояния персонажей в виде структуры массивов NumPy.
+
+    Позиции, скорости и счётчики всех персонажей лежат в непрерывных массивах, а шаг
+    выполняется сразу для всех персонажей векторными операциями. Шаг покрывает только
+    гравитацию, перемещение на скорость и таймер удара: столкновений с землёй (`sweep`),
+    приземления, `prev_pos` и кадров анимации в нём нет, поэтому с `Player.loop` он
+    совпадает лишь на открытом пространстве, где игроку не во что упереться. В игре
+    хранилище не используется. Позиции округляются так же, как это делает `pygame.Rect`.
+
+    :param capacity: Начальная ёмкость хранилища.
+    :type capacity: int
+    :raises ImportError: Если NumPy не установлен.
+    """
+    GRAVITY = 1
+    INT_FIELDS = ("x", "y", "width", "height", "fall_count", "jump_count", "hit_count")
+    FLOAT_FIELDS = ("x_vel", "y_vel")
+
+    def __init__(self, capacity=64):
+        if np is None:
+            raise ImportError("EntityStore requires numpy")
+        self.size = 0
+        for name in self.INT_FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype=np.int64))
+        for name in self.FLOAT_FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype=np.float64))
+        self.hit = np.zeros(capacity, dtype=bool)
+
+    @property
+    def capacity(self):
+        return len(self.hit)
+
+    def _grow(self):
+        capacity = self.capacity * 2
+        for name in self.INT_FIELDS + self.FLOAT_FIELDS + ("hit",):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def add(self, x, y, width, height):
+        """
+        Добавляет персонажа и возвращает его индекс в массивах.
+
+        :rtype: int
+        """
+        if self.size == self.capacity:
+            self._grow()
+        index = self.size
+        self.x[index] = x
+        self.y[index] = y
+        self.width[index] = width
+        self.height[index] = height
+        self.size += 1
+        return index
+
+    def add_actor(self, actor):
+        """
+        Добавляет персонажа, копируя состояние объекта `Player` или `Player_2`.
+
+        :rtype: int
+        """
+        index = self.add(actor.rect.x, actor.rect.y, actor.rect.width, actor.rect.height)
+        self.x_vel[index] = actor.x_vel
+        self.y_vel[index] = actor.y_vel
+        self.fall_count[index] = actor.fall_count
+        self.jump_count[index] = actor.jump_count
+        self.hit[index] = actor.hit
+        self.hit_count[index] = actor.hit_count
+        return index
+
+    def write_back(self, index, actor):
+        """
+        Копирует состояние персонажа с индексом `index` обратно в объект `actor`.
+        """
+        actor.rect.x = int(self.x[index])
+        actor.rect.y = int(self.y[index])
+        actor.x_vel = float(self.x_vel[index])
+        actor.y_vel = float(self.y_vel[index])
+        actor.fall_count = int(self.fall_count[index])
+        actor.jump_count = int(self.jump_count[index])
+        actor.hit = bool(self.hit[index])
+        actor.hit_count = int(self.hit_count[index])
+
+    def jump(self, indices):
+        self.y_vel[indices] = -self.GRAVITY * 8
+        self.jump_count[indices] += 1
+        first = np.asarray(indices)[self.jump_count[indices] == 1]
+        self.fall_count[first] = 0
+
+    def landed(self, indices):
+        self.fall_count[indices] = 0
+        self.y_vel[indices] = 0
+        self.jump_count[indices] = 0
+
+    def step(self, fps):
+        """
+        Выполняет один шаг для всех персонажей: гравитация, перемещение на скорость и
+        таймер удара, без проверки столкновений.
+
+        :param fps: Частота кадров, в которой измеряются счётчики.
+        :type fps: int
+        """
+        n = self.size
+        y_vel = self.y_vel[:n]
+        y_vel += np.minimum(1, (self.fall_count[:n] / fps) * self.GRAVITY)
+        self.x[:n] = _round_half_away(self.x[:n] + self.x_vel[:n])
+        self.y[:n] = _round_half_away(self.y[:n] + y_vel)
+
+        hit = self.hit[:n]
+        hit_count = self.hit_count[:n]
+        hit_count += hit
+        expired = hit_count > fps * 2
+        hit[expired] = False
+        hit_count[expired] = 0
 
+        self.fall_count[:n] += 1
+
+    def __len__(self):
+        return self.size
+
+
+def _round_half_away(values):
+    return np.trunc(values + np.copysign(0.5, values))
 
 
 class Object(pygame.sprite.Sprite):
@@ -327,11 +971,14 @@ class Object(pygame.sprite.Sprite):
     :type height: int
     :param name: Имя объекта (по умолчанию None).
     :type name: str or None
+    :param image: Готовое (обычно общее) изображение объекта. Если не задано, создаётся
+        пустая прозрачная поверхность.
+    :type image: pygame.Surface or None
     """
-    def __init__(self, x, y, width, height, name=None):
+    def __init__(self, x, y, width, height, name=None, image=None):
         super().__init__()
         self.rect = pygame.Rect(x, y, width, height)
-        self.image = pygame.Surface((width, height), pygame.SRCALPHA)
+        self.image = image if image is not None else pygame.Surface((width, height), pygame.SRCALPHA)
         self.width = width
         self.height = height
         self.name = name
@@ -354,10 +1001,8 @@ class Fruit(Object):
     :type height: int
     """
     def __init__(self, x, y, width, height):
-        super().__init__(x, y, width, height, "fruit")
-        fruit_image = pygame.image.load(join("assets", "items", "fruits", "Mashroom.png")).convert_alpha()
-        self.image = pygame.transform.scale(fruit_image, (width, height))
-        self.mask = pygame.mask.from_surface(self.image)
+        image, self.mask = resources.scaled(FRUIT_IMAGE, (width, height))
+        super().__init__(x, y, width, height, "fruit", image)
 
 
 class Block(Object):
@@ -372,10 +1017,8 @@ class Block(Object):
     :type size: int
     """
     def __init__(self, x, y, size):
-        super().__init__(x, y, size, size)
-        block = get_block(size)
-        self.image.blit(block, (0, 0))
-        self.mask = pygame.mask.from_surface(self.image)
+        image, self.mask = resources.block(size)
+        super().__init__(x, y, size, size, image=image)
 
 
 class Mob(Object):
@@ -392,10 +1035,8 @@ class Mob(Object):
     :type height: int
     """
     def __init__(self, x, y, width, height):
-        super().__init__(x, y, width, height, "zombi")
-        zombie_image = pygame.image.load(join("assets", "Items", "Fruits", "zombi.png")).convert_alpha()
-        self.image = pygame.transform.scale(zombie_image, (width, height))
-        self.mask = pygame.mask.from_surface(self.image)
+        image, self.mask = resources.scaled(MOB_IMAGE, (width, height))
+        super().__init__(x, y, width, height, "zombi", image)
 
 
 class Buff(Object):
@@ -412,10 +1053,8 @@ class Buff(Object):
     :type height: int
     """
     def __init__(self, x, y, width, height):
-        super().__init__(x, y, width, height, "buff")
-        buff_image = pygame.image.load(join("assets", "Traps", "Sand Mud Ice", "Ice Particle.png")).convert_alpha()
-        self.image = pygame.transform.scale(buff_image, (width, height))
-        self.mask = pygame.mask.from_surface(self.image)
+        image, self.mask = resources.scaled(BUFF_IMAGE, (width, height))
+        super().__init__(x, y, width, height, "buff", image)
 
 
 class Button():
@@ -495,638 +1134,2741 @@ def get_background(name):
     return tiles, image
 
 
-def draw(window, background, bg_image, player, player_2, objects, offset_x, fruits_collected):
+class SpatialHash:
+    """
+    Пространственный хеш (равномерная сетка) объектов уровня для быстрого поиска соседей.
+
+    Каждый объект хранится во всех ячейках, которые пересекает его `rect`. Запрос `near`
+    возвращает только объекты из ячеек, задетых заданным прямоугольником, поэтому стоимость
+    проверки столкновений не зависит от длины уровня. Объекты считаются неподвижными:
+    при удалении фрукта, моба или баффа из уровня его нужно удалить и из сетки.
+
+    :param objects: Начальный набор объектов с атрибутом `rect`.
+    :type objects: iterable
+    :param cell_size: Размер ячейки сетки в пикселях.
+    :type cell_size: int
+    """
+    def __init__(self, objects=(), cell_size=128):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._order = {}
+        self._counter = 0
+        for obj in objects:
+            self.add(obj)
+
+    def _cell_range(self, rect):
+        size = self.cell_size
+        return (range(rect.left // size, (rect.right - 1) // size + 1),
+                range(rect.top // size, (rect.bottom - 1) // size + 1))
+
+    def add(self, obj):
+        if obj in self._order:
+            return
+        self._order[obj] = self._counter
+        self._counter += 1
+        columns, rows = self._cell_range(obj.rect)
+        for cx in columns:
+            for cy in rows:
+                self._cells.setdefault((cx, cy), {})[obj] = None
+
+    def remove(self, obj):
+        if self._order.pop(obj, None) is None:
+            return
+        columns, rows = self._cell_range(obj.rect)
+        for cx in columns:
+            for cy in rows:
+                cell = self._cells.get((cx, cy))
+                if cell is not None:
+                    cell.pop(obj, None)
+                    if not cell:
+                        del self._cells[(cx, cy)]
+
+    def near(self, rect):
+        """
+        Возвращает объекты из ячеек, которые пересекает `rect`, в порядке их добавления.
+
+        :param rect: Прямоугольник запроса в мировых координатах.
+        :type rect: pygame.Rect
+        :rtype: list
+        """
+        found = {}
+        cells = self._cells
+        columns, rows = self._cell_range(rect)
+        for cx in columns:
+            for cy in rows:
+                cell = cells.get((cx, cy))
+                if cell:
+                    found.update(cell)
+        if len(found) < 2:
+            return list(found)
+        return sorted(found, key=self._order.__getitem__)
+
+    def __contains__(self, obj):
+        return obj in self._order
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+
+class ObjectRegistry:
+    """
+    Объекты уровня, разложенные по видам: фрукты, мобы, баффы и прочие.
+
+    Каждый вид хранится в словаре как упорядоченное множество, поэтому добавление,
+    удаление и проверка «объект ещё на уровне» выполняются за O(1), а проверки
+    взаимодействий перебирают только объекты нужного вида. Земля хранится отдельно
+    в `TileMap`. При обходе
+    объекты идут по видам в порядке `KINDS`, а внутри вида — в порядке добавления.
+
+    `visible` находит объекты в прямоугольнике (кадре камеры или под игроком) через
+    `SpatialHash`, так что отрисовка и проверки подбора не зависят от длины уровня. Сетка строится при первом запросе и дальше
+    обновляется вместе с реестром.
+
+    :param objects: Начальный набор объектов.
+    :type objects: iterable
+    """
+    KINDS = (Fruit, Mob, Buff, Object)
+    INDEX_CELL_SIZE = 256
+
+    def __init__(self, objects=()):
+        self.by_kind = {kind: {} for kind in self.KINDS}
+        self.fruits = self.by_kind[Fruit]
+        self.mobs = self.by_kind[Mob]
+        self.buffs = self.by_kind[Buff]
+        self._ranks = {id(bucket): rank for rank, bucket in enumerate(self.by_kind.values())}
+        self._index = None
+        for obj in objects:
+            self.add(obj)
+
+    def _bucket(self, obj):
+        bucket = self.by_kind.get(type(obj))
+        if bucket is None:
+            bucket = self.by_kind[next(kind for kind in self.KINDS if isinstance(obj, kind))]
+        return bucket
+
+    def add(self, obj):
+        self._bucket(obj)[obj] = None
+        if self._index is not None:
+            self._index.add(obj)
+
+    def remove(self, obj):
+        self._bucket(obj).pop(obj, None)
+        if self._index is not None:
+            self._index.remove(obj)
+
+    def visible(self, rect):
+        """
+        Возвращает объекты, пересекающие `rect`, в порядке обхода реестра.
+
+        :param rect: Прямоугольник в мировых координатах, например кадр камеры.
+        :type rect: pygame.Rect
+        :rtype: list
+        """
+        if self._index is None:
+            self._index = SpatialHash(self, self.INDEX_CELL_SIZE)
+        found = [obj for obj in self._index.near(rect) if rect.colliderect(obj.rect)]
+        if len(found) > 1:
+            found.sort(key=lambda obj: self._ranks[id(self._bucket(obj))])
+        return found
+
+    def __contains__(self, obj):
+        return obj in self._bucket(obj)
+
+    def __iter__(self):
+        for bucket in self.by_kind.values():
+            yield from bucket
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.by_kind.values())
+
+
+class Background:
+    """
+    Фон уровня, один раз собранный из плиток в поверхность формата дисплея.
+
+    Без параллакса фон выводится одним вызовом blit. В режиме параллакса собирается
+    полоса шириной в экран плюс одна плитка, которая сдвигается вместе с камерой
+    с коэффициентом `parallax` и зацикливается по ширине плитки.
+
+    :param name: Имя файла изображения фона.
+    :type name: str
+    :param parallax: Скорость прокрутки фона относительно камеры (0 — неподвижный фон).
+    :type parallax: float
+    :raises FileNotFoundError: Если файл с указанным именем не найден.
+    """
+    def __init__(self, name, parallax=0):
+        image = resources.image(join("assets", "Background", name))
+        self.tile_width, tile_height = image.get_size()
+        self.parallax = parallax
+
+        width = WIDTH + self.tile_width if parallax else WIDTH
+        self.surface = pygame.Surface((width, HEIGHT), 0, pygame.display.get_surface())
+        for x in range(0, width, self.tile_width):
+            for y in range(0, HEIGHT, tile_height):
+                self.surface.blit(image, (x, y))
+
+    def draw(self, win, offset_x):
+        if self.parallax:
+            win.blit(self.surface, (-(int(offset_x * self.parallax) % self.tile_width), 0))
+        else:
+            win.blit(self.surface, (0, 0))
+
+
+Tile = namedtuple("Tile", ["rect", "image"])
+
+
+class TileMap:
+    """
+    Статичная земля уровня в виде двумерной сетки номеров тайлов по одному байту на клетку.
+
+    Клетка (столбец, ряд) занимает прямоугольник `origin + (столбец, ряд) * size`; номер 0
+    означает пустую клетку, остальные — индекс изображения в `images`. Поиск тайлов под
+    прямоугольником (`near`) и отрисовка (`draw`) обращаются только к клеткам в заданной
+    области, поэтому не зависят от размера уровня. Сетка растёт при добавлении тайлов
+    за её пределами и сужается методом `crop`. Если установлен NumPy, `ids` возвращает
+    массив, разделяющий память с сеткой.
+
+    :param size: Размер тайла в пикселях.
+    :type size: int
+    :param origin: Мировые координаты угла клетки (0, 0).
+    :type origin: tuple
+    """
+    BLOCK = 1
+
+    def __init__(self, size, origin=(0, HEIGHT)):
+        self.size = size
+        self.origin = origin
+        self.images = [None, resources.block(size)[0]]
+        self.col0 = self.row0 = 0
+        self.cols = self.rows = 0
+        self._ids = bytearray()
+
+    @classmethod
+    def from_tiles(cls, tiles, size, origin=(0, HEIGHT)):
+        """
+        Строит сетку по списку левых верхних углов блоков.
+
+        :param tiles: Координаты блоков в пикселях.
+        :type tiles: list of tuple
+        :rtype: TileMap
+        """
+        tilemap = cls(size, origin)
+        cells = [tilemap.cell(x, y) for x, y in tiles]
+        if cells:
+            columns = [col for col, _ in cells]
+            rows = [row for _, row in cells]
+            tilemap._resize(min(columns), min(rows), max(columns) + 1, max(rows) + 1)
+            for col, row in cells:
+                tilemap._ids[tilemap._index(col, row)] = cls.BLOCK
+        return tilemap
+
+    def cell(self, x, y):
+        """
+        Переводит левый верхний угол тайла в номер клетки.
+
+        :rtype: tuple
+        :raises ValueError: Если угол не лежит на сетке тайлов.
+        """
+        col, dx = divmod(x - self.origin[0], self.size)
+        row, dy = divmod(y - self.origin[1], self.size)
+        if dx or dy:
+            raise ValueError(f"tile at ({x}, {y}) is not aligned to the {self.size}px grid")
+        return col, row
+
+    def _index(self, col, row):
+        return (row - self.row0) * self.cols + col - self.col0
+
+    def _resize(self, col0, row0, col1, row1):
+        cols = col1 - col0
+        ids = bytearray(cols * (row1 - row0))
+        first, last = max(col0, self.col0), min(col1, self.col0 + self.cols)
+        if first < last:
+            for row in range(max(row0, self.row0), min(row1, self.row0 + self.rows)):
+                start = self._index(first, row)
+                target = (row - row0) * cols + first - col0
+                ids[target:target + last - first] = self._ids[start:start + last - first]
+        self.col0, self.row0, self.cols, self.rows = col0, row0, cols, row1 - row0
+        self._ids = ids
+
+    def add(self, x, y, tile=BLOCK):
+        col, row = self.cell(x, y)
+        if not self.rows:
+            self._resize(col, row, col + 1, row + 1)
+        elif not (self.col0 <= col < self.col0 + self.cols and self.row0 <= row < self.row0 + self.rows):
+            # По горизонтали сетка растёт с запасом, чтобы подгрузка участков подряд не
+            # копировала её каждый раз.
+            col0, col1 = self.col0, self.col0 + self.cols
+            if col < col0:
+                col0 = min(col, col0 - self.cols)
+            elif col >= col1:
+                col1 = max(col + 1, col1 + self.cols)
+            self._resize(col0, min(self.row0, row), col1, max(self.row0 + self.rows, row + 1))
+        self._ids[self._index(col, row)] = tile
+
+    def crop(self, left, right):
+        """
+        Отбрасывает столбцы, левый край которых лежит вне [left, right) в пикселях, вместе
+        с их тайлами, так что память сетки снова соответствует этой области.
+        """
+        if not self.rows:
+            return
+        size, ox = self.size, self.origin[0]
+        col0 = max(self.col0, -((ox - left) // size))
+        col1 = min(self.col0 + self.cols, -((ox - right) // size))
+        if col1 <= col0:
+            self.col0 = self.row0 = self.cols = self.rows = 0
+            self._ids = bytearray()
+        elif (col0, col1) != (self.col0, self.col0 + self.cols):
+            self._resize(col0, self.row0, col1, self.row0 + self.rows)
+
+    def remove(self, x, y):
+        col, row = self.cell(x, y)
+        if self.col0 <= col < self.col0 + self.cols and self.row0 <= row < self.row0 + self.rows:
+            self._ids[self._index(col, row)] = 0
+
+    def tile_at(self, col, row):
+        if self.col0 <= col < self.col0 + self.cols and self.row0 <= row < self.row0 + self.rows:
+            return self._ids[self._index(col, row)]
+        return 0
+
+    @property
+    def ids(self):
+        if np is None:
+            raise ImportError("TileMap.ids requires numpy")
+        return np.frombuffer(self._ids, dtype=np.uint8).reshape(self.rows, self.cols)
+
+    def _tile(self, col, row, tile):
+        size = self.size
+        return Tile(pygame.Rect(self.origin[0] + col * size, self.origin[1] + row * size, size, size),
+                    self.images[tile])
+
+    def _cells(self, rect):
+        size, (ox, oy) = self.size, self.origin
+        columns = range(max((rect.left - ox) // size, self.col0),
+                        min((rect.right - 1 - ox) // size + 1, self.col0 + self.cols))
+        rows = range(max((rect.top - oy) // size, self.row0), min((rect.bottom - 1 - oy) // size + 1,
+                                                                   self.row0 + self.rows))
+        ids = self._ids
+        for row in rows:
+            base = self._index(0, row)
+            for col in columns:
+                tile = ids[base + col]
+                if tile:
+                    yield col, row, tile
+
+    def near(self, rect):
+        """
+        Возвращает тайлы, которые пересекает `rect`, по рядам сверху вниз.
+
+        :param rect: Прямоугольник запроса в мировых координатах.
+        :type rect: pygame.Rect
+        :rtype: list of Tile
+        """
+        return [self._tile(col, row, tile) for col, row, tile in self._cells(rect)]
+
+    def draw(self, win, offset_x):
+        size, (ox, oy) = self.size, self.origin
+        images = self.images
+        view = pygame.Rect(offset_x, oy + self.row0 * size, win.get_width(), self.rows * size)
+        win.blits([(images[tile], (ox + col * size - offset_x, oy + row * size))
+                   for col, row, tile in self._cells(view)], doreturn=False)
+
+    def __iter__(self):
+        if np is not None:
+            ids = self.ids
+            rows, columns = np.nonzero(ids)
+            for row, col in zip(rows.tolist(), columns.tolist()):
+                yield self._tile(self.col0 + col, self.row0 + row, int(ids[row, col]))
+            return
+        for index, tile in enumerate(self._ids):
+            if tile:
+                row, col = divmod(index, self.cols)
+                yield self._tile(self.col0 + col, self.row0 + row, tile)
+
+    def __len__(self):
+        return len(self._ids) - self._ids.count(0)
+
+
+class DirtyRects:
+    """
+    Учёт изменившихся областей экрана для частичного обновления дисплея.
+
+    Каждый кадр в трекер добавляются экранные прямоугольники видимых элементов вместе с
+    ключом, описывающим их содержимое (например, объект и его текущий кадр). Области,
+    у которых ключ или положение изменились с прошлого кадра, считаются грязными. Если
+    сдвинулась камера или трекер был сброшен, нужно перерисовать весь экран.
+
+    :param enabled: Включён ли режим частичного обновления.
+    :type enabled: bool
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._previous = set()
+        self._current = set()
+        self._marked = []
+        self._offset_x = None
+        self._full = True
+
+    def begin(self, offset_x):
+        if offset_x != self._offset_x:
+            self._full = True
+        self._offset_x = offset_x
+        self._current = set()
+
+    def add(self, key, rect):
+        self._current.add((key, tuple(rect)))
+
+    def mark(self, rect):
+        self._marked.append(pygame.Rect(rect))
+
+    def invalidate(self):
+        self._full = True
+
+    def regions(self, bounds=None):
+        """
+        Возвращает список грязных прямоугольников текущего кадра или None, если нужно
+        обновить весь экран. Вызов завершает кадр.
+
+        :param bounds: Границы экрана, по которым обрезаются области.
+        :type bounds: pygame.Rect or None
+        :rtype: list of pygame.Rect or None
+        """
+        changed = self._previous ^ self._current
+        full = self._full or not self.enabled
+        self._previous = self._current
+        self._full = False
+
+        rects = self._marked
+        self._marked = []
+        if full:
+            return None
+
+        if bounds is None:
+            bounds = pygame.Rect(0, 0, WIDTH, HEIGHT)
+        rects.extend(pygame.Rect(rect) for _, rect in changed)
+        merged = []
+        for rect in rects:
+            rect = rect.clip(bounds)
+            if not rect.width or not rect.height:
+                continue
+            for index in reversed(range(len(merged))):
+                if merged[index].colliderect(rect):
+                    rect.union_ip(merged.pop(index))
+            merged.append(rect)
+        return merged
+
+
+class DigitStrip:
+    """
+    Заранее отрисованная полоса глифов цифр для быстрого вывода чисел.
+
+    Глифы рендерятся шрифтом один раз, а число собирается копированием готовых глифов,
+    без повторного вызова `Font.render`.
+
+    :param font: Шрифт для глифов.
+    :type font: pygame.font.Font
+    :param color: Цвет глифов.
+    :type color: tuple
+    :param chars: Символы полосы.
+    :type chars: str
+    """
+    def __init__(self, font, color, chars="0123456789"):
+        glyphs = [font.render(char, True, color) for char in chars]
+        self.height = max(glyph.get_height() for glyph in glyphs)
+        self.strip = pygame.Surface((sum(glyph.get_width() for glyph in glyphs), self.height), pygame.SRCALPHA)
+        self.areas = {}
+        x = 0
+        for char, glyph in zip(chars, glyphs):
+            self.strip.blit(glyph, (x, 0))
+            self.areas[char] = pygame.Rect(x, 0, glyph.get_width(), self.height)
+            x += glyph.get_width()
+
+    def render(self, value):
+        """
+        Собирает поверхность с числом `value` из глифов полосы.
+
+        :param value: Число или строка из символов полосы.
+        :type value: int or str
+        :rtype: pygame.Surface
+        """
+        areas = [self.areas[char] for char in str(value)]
+        surface = pygame.Surface((sum(area.width for area in areas), self.height), pygame.SRCALPHA)
+        x = 0
+        for area in areas:
+            surface.blit(self.strip, (x, 0), area)
+            x += area.width
+        return surface
+
+
+class TextCache:
+    """
+    Кэш шрифтов и отрисованного текста интерфейса.
+
+    Каждый шрифт загружается один раз, а готовые поверхности с текстом хранятся по ключу
+    (текст, шрифт, размер, цвет), поэтому строка рендерится заново только когда меняется
+    её содержимое.
+
+    :param maxsize: Максимальное количество хранимых поверхностей с текстом.
+    :type maxsize: int
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._fonts = {}
+        self._texts = OrderedDict()
+        self._strips = {}
+
+    def font(self, name, size):
+        font = self._fonts.get((name, size))
+        if font is None:
+            pygame.font.init()
+            font = pygame.font.SysFont(name, size)
+            self._fonts[(name, size)] = font
+        return font
+
+    def render(self, text, name, size, color):
+        """
+        Возвращает поверхность с текстом, рендеря её только при первом обращении.
+
+        :rtype: pygame.Surface
+        """
+        key = (text, name, size, color)
+        surface = self._texts.get(key)
+        if surface is not None:
+            self._texts.move_to_end(key)
+            return surface
+
+        surface = self.font(name, size).render(text, True, color)
+        self._texts[key] = surface
+        while len(self._texts) > self.maxsize:
+            self._texts.popitem(last=False)
+        return surface
+
+    def digits(self, name, size, color):
+        """
+        Возвращает полосу глифов цифр для шрифта и цвета.
+
+        :rtype: DigitStrip
+        """
+        key = (name, size, color)
+        strip = self._strips.get(key)
+        if strip is None:
+            strip = DigitStrip(self.font(name, size), color)
+            self._strips[key] = strip
+        return strip
+
+
+text_cache = TextCache()
+
+HUD_FONT = ("comicsans", 30)
+HUD_COLOR = (255, 255, 255)
+
+
+class Hud:
+    """
+    Интерфейс уровня: счётчик фруктов и таймер раунда.
+
+    Поверхности пересобираются только когда меняется отображаемое значение: счётчик берётся
+    из `text_cache`, а цифры таймера собираются из полосы глифов.
+    """
+    def __init__(self):
+        self._fruits = None
+        self._seconds = None
+        self.items = []
+        self._fruits_item = None
+        self._timer_item = None
+
+    def update(self, fruits_collected, remaining_time=None):
+        """
+        Обновляет элементы интерфейса и возвращает список пар (поверхность, позиция).
+
+        :param fruits_collected: Количество собранных фруктов.
+        :type fruits_collected: int
+        :param remaining_time: Оставшееся время раунда в секундах (по умолчанию None).
+        :type remaining_time: float or None
+        :rtype: list
+        """
+        if fruits_collected != self._fruits:
+            self._fruits = fruits_collected
+            surface = text_cache.render(f"Fruits Collected: {fruits_collected}/3", *HUD_FONT, HUD_COLOR)
+            self._fruits_item = (surface, (10, 10))
+
+        seconds = None if remaining_time is None else max(0, int(remaining_time))
+        if seconds != self._seconds:
+            self._seconds = seconds
+            if seconds is None:
+                self._timer_item = None
+            else:
+                label = text_cache.render("Time: ", *HUD_FONT, HUD_COLOR)
+                value = text_cache.digits(*HUD_FONT, HUD_COLOR).render(seconds)
+                surface = pygame.Surface((label.get_width() + value.get_width(),
+                                          max(label.get_height(), value.get_height())), pygame.SRCALPHA)
+                surface.blit(label, (0, 0))
+                surface.blit(value, (label.get_width(), 0))
+                self._timer_item = (surface, (WIDTH - surface.get_width() - 10, 10))
+
+        self.items = [item for item in (self._fruits_item, self._timer_item) if item is not None]
+        return self.items
+
+
+PROFILER_FONT = ("consolas", 16)
+PROFILER_COLOR = (255, 255, 0)
+
+
+class FrameProfiler:
+    """
+    Время фаз игрового кадра в кольцевом буфере на последние `size` кадров.
+
+    Фазы отмечаются вызовом `mark(phase)`: время с предыдущей отметки прибавляется к фазе
+    текущего кадра, поэтому несколько шагов физики за кадр складываются. Пока профилировщик
+    не передан уровню и `draw`, отметки не ставятся вовсе.
+
+    :param size: Сколько последних кадров хранить.
+    :type size: int
+    """
+    PHASES = ("wait", "events", "input", "loop", "scan", "move", "camera", "draw", "display")
+
+    def __init__(self, size=600):
+        self.size = size
+        self.samples = {phase: array("d", bytes(8 * size)) for phase in self.PHASES}
+        self.frames = 0
+        self._row = 0
+        self._last = time.perf_counter()
+        self._overlay = []
+        self._overlay_frame = None
+
+    def __len__(self):
+        return min(self.frames, self.size)
+
+    def begin_frame(self):
+        self._row = self.frames % self.size
+        for samples in self.samples.values():
+            samples[self._row] = 0
+        self.frames += 1
+        self._last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.samples[phase][self._row] += now - self._last
+        self._last = now
+
+    def rows(self):
+        """
+        Возвращает сохранённые кадры от старых к новым: номер кадра и время фаз в миллисекундах.
+
+        :rtype: list
+        """
+        first = self.frames - len(self)
+        return [(frame, *(self.samples[phase][frame % self.size] * 1000 for phase in self.PHASES))
+                for frame in range(first, self.frames)]
+
+    def percentiles(self, quantiles=(50, 95, 99)):
+        """
+        Считает перцентили времени каждой фазы и всего кадра (`"frame"`) в миллисекундах.
+
+        :rtype: dict
+        """
+        rows = self.rows()
+        columns = dict(zip(self.PHASES, zip(*(row[1:] for row in rows)))) if rows else {}
+        columns["frame"] = [sum(row[1:]) for row in rows]
+        result = {}
+        for phase in (*self.PHASES, "frame"):
+            values = sorted(columns.get(phase, ()))
+            result[phase] = tuple(values[max(math.ceil(q / 100 * len(values)) - 1, 0)] if values else 0
+                                  for q in quantiles)
+        return result
+
+    def export_csv(self, path):
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(("frame", *self.PHASES, "total"))
+            for frame, *phases in self.rows():
+                writer.writerow((frame, *(f"{ms:.4f}" for ms in phases), f"{sum(phases):.4f}"))
+
+    def overlay(self, refresh=30):
+        """
+        Возвращает таблицу p50/p95/p99 по фазам для вывода поверх кадра как элемент
+        интерфейса. Таблица пересобирается раз в `refresh` кадров.
+
+        :rtype: list
+        """
+        if self._overlay_frame is not None and self.frames - self._overlay_frame < refresh:
+            return self._overlay
+        self._overlay_frame = self.frames
+
+        font = text_cache.font(*PROFILER_FONT)
+        lines = [f"{'ms':<10}{'p50':>7}{'p95':>7}{'p99':>7}"]
+        lines += [f"{phase:<10}" + "".join(f"{value:7.2f}" for value in values)
+                  for phase, values in self.percentiles().items()]
+        rendered = [font.render(line, True, PROFILER_COLOR) for line in lines]
+        surface = pygame.Surface((max(line.get_width() for line in rendered) + 10,
+                                  sum(line.get_height() for line in rendered) + 10), pygame.SRCALPHA)
+        surface.fill((0, 0, 0, 160))
+        y = 5
+        for line in rendered:
+            surface.blit(line, (5, y))
+            y += line.get_height()
+        self._overlay = [(surface, (10, HEIGHT - surface.get_height() - 10))]
+        return self._overlay
+
+
+def render_scene(window, background, bg_image, player, player_2, objects, offset_x, hud, terrain=None, alpha=1):
+    """
+    Рисует кадр игры на поверхности, не обновляя дисплей.
+
+    :param hud: Элементы интерфейса — пары (поверхность, позиция).
+    :type hud: list
+    :param alpha: Доля шага физики для интерполяции положения игроков.
+    :type alpha: float
+    """
+    if bg_image is None:
+        background.draw(window, offset_x)
+    else:
+        for tile in background:
+            window.blit(bg_image, tile)
+
+    if terrain is None:
+        for obj in objects:
+            obj.draw(window, offset_x)
+    else:
+        terrain.draw(window, offset_x)
+        for obj in objects:
+            if isinstance(obj, Block) or obj.rect.right < offset_x or obj.rect.left > offset_x + WIDTH:
+                continue
+            obj.draw(window, offset_x)
+
+    player.draw(window, offset_x, alpha)
+    player_2.draw(window, offset_x, alpha)
+    for surface, pos in hud:
+        window.blit(surface, pos)
+
+
+def draw(window, background, bg_image, player, player_2, objects, offset_x, fruits_collected, terrain=None,
+         dirty=None, hud=None, remaining_time=None, alpha=1, profiler=None, overlay=None):
     """
     Отображает элементы игры на экране.
 
-    Рисует фон, объекты, игроков и текст с количеством собранных фруктов.
+    Рисует фон, объекты, игроков и текст с количеством собранных фруктов. Если передана
+    статичная земля `terrain`, блоки берутся из неё, а из `objects` рисуются только
+    остальные объекты, попадающие на экран; у `ObjectRegistry` они находятся запросом
+    к пространственной сетке без перебора всего уровня. Если передан трекер `dirty`, при неподвижной
+    камере перерисовываются и отправляются на дисплей только изменившиеся области.
 
     :param window: Окно для отрисовки элементов игры.
     :type window: pygame.Surface
-    :param background: Список тайлов фона для отрисовки.
-    :type background: list
-    :param bg_image: Изображение фона.
-    :type bg_image: pygame.Surface
+    :param background: Собранный фон или список тайлов фона для отрисовки.
+    :type background: Background or list
+    :param bg_image: Изображение фона для списка тайлов или None для `Background`.
+    :type bg_image: pygame.Surface or None
     :param player: Первый игрок для отрисовки.
     :type player: Player
     :param player_2: Второй игрок для отрисовки.
     :type player_2: Player_2
-    :param objects: Список объектов для отрисовки.
-    :type objects: list
+    :param objects: Объекты для отрисовки.
+    :type objects: ObjectRegistry or list
     :param offset_x: Смещение по оси X для корректного отображения объектов.
     :type offset_x: int
     :param fruits_collected: Количество собранных фруктов.
     :type fruits_collected: int
+    :param terrain: Статичная земля уровня (по умолчанию None).
+    :type terrain: TileMap or None
+    :param dirty: Трекер изменившихся областей экрана (по умолчанию None).
+    :type dirty: DirtyRects or None
+    :param hud: Интерфейс уровня, хранящий отрисованный текст между кадрами (по умолчанию None).
+    :type hud: Hud or None
+    :param remaining_time: Оставшееся время раунда для таймера (по умолчанию None — без таймера).
+    :type remaining_time: float or None
+    :param alpha: Доля шага физики, прошедшая после последнего шага, для интерполяции игроков
+        между предыдущим и текущим состоянием (по умолчанию 1 — текущее состояние).
+    :type alpha: float
+    :param profiler: Профилировщик, в котором отмечаются фазы "draw" и "display" (по умолчанию None).
+    :type profiler: FrameProfiler or None
+    :param overlay: Дополнительные элементы поверх интерфейса, например таблица профилировщика.
+    :type overlay: list or None
     """
-    for tile in background:
-        window.blit(bg_image, tile)
+    if hud is None:
+        hud = Hud()
+    items = hud.update(fruits_collected, remaining_time)
+    if overlay:
+        items = items + overlay
+    visible = _on_screen(objects, offset_x)
+    if terrain is not None:
+        objects = visible
+
+    if dirty is None:
+        render_scene(window, background, bg_image, player, player_2, objects, offset_x, items, terrain, alpha)
+        _update_display(profiler)
+        return
+
+    dirty.begin(offset_x)
+    for sprite in (player, player_2):
+        x, y = sprite.render_pos(alpha)
+        dirty.add((sprite, sprite.sprite), sprite.sprite.get_rect(topleft=(x - offset_x, y)))
+    for obj in visible:
+        dirty.add((obj, obj.image), obj.rect.move(-offset_x, 0))
+    for surface, pos in items:
+        dirty.add(("hud", surface), surface.get_rect(topleft=pos))
+
+    regions = dirty.regions(window.get_rect())
+    if regions is None:
+        render_scene(window, background, bg_image, player, player_2, objects, offset_x, items, terrain, alpha)
+        _update_display(profiler)
+        return
+
+    for region in regions:
+        window.set_clip(region)
+        render_scene(window, background, bg_image, player, player_2, objects, offset_x, items, terrain, alpha)
+    window.set_clip(None)
+    _update_display(profiler, regions)
+
+
+def _on_screen(objects, offset_x):
+    if isinstance(objects, ObjectRegistry):
+        return objects.visible(pygame.Rect(offset_x, 0, WIDTH, HEIGHT))
+    return [obj for obj in objects
+            if not (isinstance(obj, Block) or obj.rect.right < offset_x or obj.rect.left > offset_x + WIDTH)]
+
+
+def _update_display(profiler, regions=None):
+    if profiler is not None:
+        profiler.mark("draw")
+    if regions is None:
+        pygame.display.update()
+    else:
+        pygame.display.update(regions)
+    if profiler is not None:
+        profiler.mark("display")
 
-    for obj in objects:
-        obj.draw(window, offset_x)
 
-    player.draw(window, offset_x)
-    player_2.draw(window, offset_x)
-    font = pygame.font.SysFont("comicsans", 30)
-    text = font.render(f"Fruits Collected: {fruits_collected}/3", True, (255, 255, 255))
-    window.blit(text, (10, 10))
+def sweep(rect, dx, dy, solids):
+    """
+    Сдвигает прямоугольник на (dx, dy) до первого касания с твёрдыми объектами.
+
+    Движение разбивается на два прохода: сначала по оси X, затем по оси Y. На каждом
+    проходе среди объектов, задетых всей траекторией, ищется ближайший по ходу движения,
+    и сдвиг обрезается до касания с ним, поэтому быстрое движение не проскакивает сквозь
+    блоки. Блоки, с которыми прямоугольник уже пересекается, не мешают двигаться по X,
+    а по Y выталкивают его: при движении вниз он встаёт на верх такого блока, при
+    движении вверх — упирается в его низ.
+
+    :param rect: Прямоугольник столкновений в мировых координатах.
+    :type rect: pygame.Rect
+    :param dx: Сдвиг по оси X в пикселях.
+    :type dx: int
+    :param dy: Сдвиг по оси Y в пикселях.
+    :type dy: int
+    :param solids: Твёрдые объекты: сетка тайлов, `SpatialHash` или список объектов
+        с атрибутом `rect`.
+    :type solids: TileMap or SpatialHash or list
+    :returns: Сдвинутый прямоугольник и объекты, в которые он упёрся по осям X и Y
+        (или None).
+    :rtype: tuple
+    """
+    hit_x = hit_y = None
+    if dx:
+        for obj in _solids_near(solids, rect.union(rect.move(dx, 0))):
+            other = obj.rect
+            if other.bottom <= rect.top or other.top >= rect.bottom:
+                continue
+            if dx > 0 and rect.right <= other.left < rect.right + dx:
+                dx = other.left - rect.right
+                hit_x = obj
+            elif dx < 0 and rect.left + dx < other.right <= rect.left:
+                dx = other.right - rect.left
+                hit_x = obj
+        rect = rect.move(dx, 0)
+    if dy:
+        for obj in _solids_near(solids, rect.union(rect.move(0, dy))):
+            other = obj.rect
+            if other.right <= rect.left or other.left >= rect.right:
+                continue
+            if dy > 0 and rect.top < other.top < rect.bottom + dy:
+                dy = other.top - rect.bottom
+                hit_y = obj
+            elif dy < 0 and rect.top + dy < other.bottom < rect.bottom:
+                dy = other.bottom - rect.top
+                hit_y = obj
+        rect = rect.move(0, dy)
+    return rect, hit_x, hit_y
+
+
+def _solids_near(solids, area):
+    if isinstance(solids, (SpatialHash, TileMap)):
+        return solids.near(area)
+    return solids
+
+
+def can_move(player, dx, solids):
+    """
+    Проверяет, может ли игрок сдвинуться по оси X в сторону `dx`, то есть не стоит
+    ли он вплотную к стене.
 
-    pygame.display.update()
+    :rtype: bool
+    """
+    rect = player.collision_rect()
+    return sweep(rect, dx, 0, solids)[0].x != rect.x
 
 
-def handle_vertical_collision(player, objects, dy):
+def handle_move(player, player_2, objects, keys=None):
     """
-    Обрабатывает вертикальные столкновения игрока с объектами. В зависимости от направления 
-    перемещения (dy), корректирует позицию игрока и вызывает соответствующие методы 
-    для приземления или столкновения с головой.
+    Задаёт горизонтальную скорость игроков по зажатым клавишам. Игрок, стоящий вплотную
+    к стене, не разгоняется в её сторону; само движение и столкновения выполняет `sweep`
+    на следующем такте.
+
+    :param objects: Твёрдые объекты уровня.
+    :type objects: TileMap or SpatialHash or list
+    :param keys: Зажатые клавиши (по умолчанию `pygame.key.get_pressed()`).
+    :type keys: KeyState or None
+    """
+    if keys is None:
+        keys = pygame.key.get_pressed()
+
+    player.x_vel = 0
+    player_2.x_vel = 0
+
+    if keys[pygame.K_a] and can_move(player, -1, objects):
+        player.move_left(PLAYER_VEL)
+    if keys[pygame.K_d] and can_move(player, 1, objects):
+        player.move_right(PLAYER_VEL)
+    if keys[pygame.K_LEFT] and can_move(player_2, -1, objects):
+        player_2.move_left(PLAYER_VEL)
+    elif keys[pygame.K_RIGHT] and can_move(player_2, 1, objects):
+        player_2.move_right(PLAYER_VEL)
+
+
+def show_you_win(window):
+    win_text = text_cache.render("You Win!", "Arial", 50, (0, 255, 0))
+    rect = window.blit(win_text, (WIDTH // 2 - win_text.get_width() // 2, HEIGHT // 4))
+    pygame.display.update(rect)
+    pygame.time.delay(2000)
+
 
-    :param player: Объект игрока, с которым проверяются столкновения.
-    :type player: pygame.sprite.Sprite (или объект, поддерживающий метод collide_mask)
-    :param objects: Список объектов, с которыми проверяются столкновения.
-    :type objects: list
-    :param dy: Направление и расстояние перемещения по вертикали.
-    :type dy: int или float
-    :returns: Список объектов, с которыми произошло столкновение.
-    :rtype: list
-    :raises TypeError: Если аргумент `objects` не является списком или если элементы 
-        списка не являются объектами класса, поддерживающими метод `collide_mask`.
-    :raises AttributeError: Если у объектов `player` или элементов в `objects` нет метода `collide_mask`.
+def show_game_over(window):
+    lose_text = text_cache.render("You Lose!", "Arial", 50, (255, 0, 0))
+    rect = window.blit(lose_text, (WIDTH // 2 - lose_text.get_width() // 2, HEIGHT // 4))
+    pygame.display.update(rect)
+    pygame.time.delay(1000)
+
+
+TickInput = namedtuple("TickInput", ["pressed", "held", "quit"])
+
+
+class KeyState(frozenset):
     """
-    collided_objects = []
-    for obj in objects:
-        if pygame.sprite.collide_mask(player, obj):
-            if dy > 0:
-                player.rect.bottom = obj.rect.top
-                player.landed()
-            elif dy < 0:
-                player.rect.top = obj.rect.bottom
-                player.hit_head()
+    Набор зажатых клавиш с тем же интерфейсом, что у `pygame.key.get_pressed()`.
+    """
+    def __getitem__(self, key):
+        return key in self
 
-            collided_objects.append(obj)
 
-    return collided_objects
+CONTROL_KEYS = (pygame.K_a, pygame.K_d, pygame.K_LEFT, pygame.K_RIGHT, pygame.K_w, pygame.K_SPACE, pygame.K_ESCAPE)
+NO_INPUT = TickInput((), KeyState(), False)
 
 
-def collide(player, objects, dx):
+class LiveInput:
+    """
+    Ввод игроков с клавиатуры через очередь событий pygame. Опрашивается раз в кадр.
     """
-    Проверяет столкновение игрока с объектами при перемещении по оси X. Игрок временно 
-    перемещается, чтобы проверить столкновение, после чего его позиция возвращается обратно.
+    per_tick = False
+
+    def poll(self):
+        """
+        Забирает события текущего такта.
 
-    :param player: Объект игрока, с которым проверяются столкновения.
-    :type player: pygame.sprite.Sprite (или объект, поддерживающий метод `move` и `update`)
-    :param objects: Список объектов, с которыми проверяются столкновения.
-    :type objects: list
-    :param dx: Расстояние перемещения игрока по оси X.
-    :type dx: int или float
-    :returns: Объект, с которым произошло столкновение, или `None`, если столкновений не было.
-    :rtype: pygame.sprite.Sprite или None
-    :raises TypeError: Если аргумент `objects` не является списком или если элементы 
-        списка не являются объектами, поддерживающими метод `collide_mask`.
-    :raises AttributeError: Если у объектов `player` или элементов в `objects` нет метода `move` или `collide_mask`.
+        :rtype: TickInput
+        """
+        pressed = []
+        quit_requested = False
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                quit_requested = True
+            elif event.type == pygame.KEYDOWN:
+                pressed.append(event.key)
+
+        keys = pygame.key.get_pressed()
+        return TickInput(tuple(pressed), KeyState(key for key in CONTROL_KEYS if keys[key]), quit_requested)
+
+
+class ScriptedInput:
     """
-    player.move(dx, 0)
-    player.update()
-    collided_object = None
-    for obj in objects:
-        if pygame.sprite.collide_mask(player, obj):
-            collided_object = obj
-            break
+    Заранее заданный ввод: по одному `TickInput` на такт физики (а не на кадр). Когда
+    сценарий заканчивается, игроки больше ничего не нажимают.
 
-    player.move(-dx, 0)
-    player.update()
-    return collided_object
+    :param script: Последовательность ввода по тактам.
+    :type script: iterable of TickInput
+    """
+    per_tick = True
 
+    def __init__(self, script):
+        self._script = iter(script)
 
-def handle_move(player, player_2, objects):
+    def poll(self):
+        return next(self._script, NO_INPUT)
 
-    keys = pygame.key.get_pressed()
 
-    player.x_vel = 0
-    collide_left = collide(player, objects, -PLAYER_VEL * 2)
-    collide_right = collide(player, objects, PLAYER_VEL * 2)
+def _copy_state(attributes):
+    # Прямоугольники — единственные изменяемые значения в атрибутах игроков, остальное
+    # (числа, кадры, маски) можно разделять между снимком и игроком.
+    return {name: value.copy() if isinstance(value, pygame.Rect) else value for name, value in attributes.items()}
 
-    player_2.x_vel = 0
-    collide_left_2 = collide(player_2, objects, -PLAYER_VEL * 2)
-    collide_right_2 = collide(player_2, objects, PLAYER_VEL * 2)
 
-    if keys[pygame.K_a] and not collide_left:
-        player.move_left(PLAYER_VEL)
-    if keys[pygame.K_d] and not collide_right:
-        player.move_right(PLAYER_VEL)
-    if keys[pygame.K_LEFT] and not collide_left_2:
-        player_2.move_left(PLAYER_VEL)
-    elif keys[pygame.K_RIGHT] and not collide_right_2:
-        player_2.move_right(PLAYER_VEL)
+def _restore_sprite(sprite, state):
+    attributes = vars(sprite)
+    attributes.clear()
+    attributes.update(_copy_state(state))
 
 
-def show_you_win(window):
-    font = pygame.font.SysFont("Arial", 50)
-    win_text = font.render("You Win!", True, (0, 255, 0))
-    window.blit(win_text, (WIDTH // 2 - win_text.get_width() // 2, HEIGHT // 4))
-    pygame.display.update()
-    pygame.time.delay(2000)
+class Level:
+    """
+    Состояние уровня и логика одного такта игры, не зависящая от окна и таймера.
 
+    Сразу после создания уровень запоминает своё исходное состояние, и `reset` возвращает
+    его к началу без повторного создания игроков и объектов.
 
-def show_game_over(window):
-    font = pygame.font.SysFont("Arial", 50)
-    lose_text = font.render("You Lose!", True, (255, 0, 0))
-    window.blit(lose_text, (WIDTH // 2 - lose_text.get_width() // 2, HEIGHT // 4))
-    pygame.display.update()
-    pygame.time.delay(1000)
+    :param background: Имя файла фона уровня.
+    :type background: str
+    :param player: Первый игрок.
+    :type player: Player
+    :param player_2: Второй игрок.
+    :type player_2: Player_2
+    :param objects: Объекты уровня; уровень раскладывает их по видам в `ObjectRegistry`,
+        а блоки переносит в сетку земли.
+    :type objects: iterable
+    :param buff: Бафф, после которого второй игрок может убивать мобов.
+    :type buff: Buff
+    :param fruits_to_win: Сколько фруктов нужно собрать для победы.
+    :type fruits_to_win: int
+    :param mobs_to_win: Сколько мобов нужно убить для победы.
+    :type mobs_to_win: int
+    :param fall_limit: Высота, падение ниже которой означает проигрыш.
+    :type fall_limit: int
+    :param round_time: Длительность раунда в секундах.
+    :type round_time: float
+    :param terrain: Сетка статичной земли (по умолчанию строится из блоков в `objects`).
+    :type terrain: TileMap or None
+    """
+    def __init__(self, background, player, player_2, objects, buff, fruits_to_win, mobs_to_win, fall_limit,
+                 round_time=100, terrain=None):
+        self.background = background
+        self.player = player
+        self.player_2 = player_2
+        objects = list(objects)
+        blocks = [obj for obj in objects if isinstance(obj, Block)]
+        if terrain is None:
+            terrain = TileMap.from_tiles([block.rect.topleft for block in blocks],
+                                         blocks[0].width if blocks else BLOCK_SIZE)
+        else:
+            for block in blocks:
+                terrain.add(*block.rect.topleft)
+        self.terrain = terrain
+        objects = [obj for obj in objects if not isinstance(obj, Block)]
+        self.objects = ObjectRegistry(objects)
+        self.entity_ids = {obj: entity_id for entity_id, obj in enumerate(objects)}
+        self.consumed = set()
+        self.buff = buff
+        self.fruits_to_win = fruits_to_win
+        self.mobs_to_win = mobs_to_win
+        self.fall_limit = fall_limit
+        self.round_time = round_time
+
+        self.offset_x = -1500
+        self.prev_offset_x = self.offset_x
+        self.scroll_area_width = 500
+        self.fruits_collected = 0
+        self.coll_mobs = 0
+        self.dead_mobs = 0
+        self.eat_buff = 0
+        self.tick = 0
+        self.time = 0
+        self.outcome = None
+        self.profiler = None
+        self.snapshot()
+
+    STATE = ("offset_x", "prev_offset_x", "fruits_collected", "coll_mobs", "dead_mobs", "eat_buff", "tick", "time",
+             "outcome")
+
+    def snapshot(self):
+        """
+        Запоминает текущее состояние уровня, к которому его вернёт `reset`: счётчики,
+        камеру, все атрибуты обоих игроков, список оставшихся объектов и номера
+        подобранных.
+        """
+        self._pristine = ({name: getattr(self, name) for name in self.STATE},
+                          (_copy_state(vars(self.player)), _copy_state(vars(self.player_2))), list(self.objects),
+                          frozenset(self.consumed))
 
+    def reset(self):
+        """
+        Возвращает уровень в состояние последнего `snapshot`. Земля уровня не меняется
+        во время игры и не восстанавливается.
+        """
+        state, players, objects, consumed = self._pristine
+        for name, value in state.items():
+            setattr(self, name, value)
+        _restore_sprite(self.player, players[0])
+        _restore_sprite(self.player_2, players[1])
+        self.objects = ObjectRegistry(objects)
+        self.consumed = set(consumed)
+
+    def restore_consumed(self, consumed):
+        """
+        Возвращает на уровень объекты исходного состояния, кроме подобранных: собранных
+        фруктов, убитых мобов и съеденных баффов.
 
-def level1(window):
-    clock = pygame.time.Clock()
-    start_time = pygame.time.get_ticks()
-    round_time = 100
+        :param consumed: Номера подобранных объектов (см. `entity_ids`).
+        :type consumed: iterable of int
+        """
+        self.consumed = set(consumed)
+        entity_ids = self.entity_ids
+        self.objects = ObjectRegistry(obj for obj in self._pristine[2] if entity_ids.get(obj) not in self.consumed)
 
-    background, bg_image = get_background("Pink.png")
+    @property
+    def remaining_time(self):
+        return self.round_time - self.time
 
-    fruits_collected = 0
-    coll_mobs = 0
-    dead_mobs = 0
-    eat_buff = 0
+    def render_offset(self, alpha=1):
+        return round(self.prev_offset_x + (self.offset_x - self.prev_offset_x) * alpha)
 
-    offset_x = -1500
-    scroll_area_width = 500
+    def finish(self, outcome):
+        if self.outcome is None:
+            self.outcome = outcome
 
-    block_size = 96
+    def remove(self, obj):
+        self.objects.remove(obj)
+        entity_id = self.entity_ids.get(obj)
+        if entity_id is not None:
+            self.consumed.add(entity_id)
 
-    player = Player(-1000, 300, 50, 50)
-    player_2 = Player_2(-900, 300, 50, 50)
-    floor = [
-        Block(i * block_size,
-              HEIGHT - block_size if not (-1 <= i <= 1 or 10 <= i <= 15 or 16 <= i <= 22) else HEIGHT, block_size
-              ) for i in range(-WIDTH // block_size, (WIDTH * 3) // block_size)]
+    def buff_alive(self):
+        return self.buff is not None and self.buff in self.objects.buffs
 
-    platform1 = Block(block_size * 2, HEIGHT - block_size * 2, block_size)
-    platform12 = Block(block_size * 2, HEIGHT - block_size * 5, block_size)
-    platform13 = Block(block_size * -2, HEIGHT - block_size * 5, block_size)
-    platform2 = Block(block_size * 5, HEIGHT - block_size * 4, block_size)
-    platform32 = Block(block_size * 9, HEIGHT - block_size * 5, block_size)
-    platform33 = Block(block_size * 9, HEIGHT - block_size * 4, block_size)
-    platform34 = Block(block_size * 9, HEIGHT - block_size * 3, block_size)
-    platform35 = Block(block_size * 9, HEIGHT - block_size * 2, block_size)
-    platform4 = Block(block_size * 13, HEIGHT - block_size * 4, block_size)
-    platform5 = Block(block_size * 16, HEIGHT - block_size * 2, block_size)
-    platform6 = Block(block_size * 10, HEIGHT - block_size * 2, block_size)
-    platform7 = Block(block_size * 19, HEIGHT - block_size * 3, block_size)
-    platform8 = Block(block_size * 22, HEIGHT - block_size * 5, block_size)
+    def step(self, controls):
+        """
+        Выполняет один такт логики уровня: ввод, условия победы и поражения, физику,
+        подбор предметов, столкновения и прокрутку камеры.
 
+        :param controls: Ввод игроков на этом такте.
+        :type controls: TickInput
+        """
+        player, player_2, objects, terrain = self.player, self.player_2, self.objects, self.terrain
+        profiler = self.profiler
+        self.prev_offset_x = self.offset_x
+
+        if self.remaining_time <= 0:
+            self.finish("lose")
+        if controls.quit:
+            self.finish("quit")
+
+        for key in controls.pressed:
+            if key == pygame.K_w and player.jump_count < 2:
+                player.jump()
+            if key == pygame.K_SPACE and player_2.jump_count < 2:
+                player_2.jump()
+            if key == pygame.K_ESCAPE:
+                self.finish("quit")
+
+        if self.fruits_collected == self.fruits_to_win and self.dead_mobs == self.mobs_to_win:
+            self.finish("win")
+        if self.coll_mobs >= 1:
+            self.finish("lose")
+        if (player.rect.bottom > self.fall_limit) or (player_2.rect.bottom > self.fall_limit):
+            self.finish("lose")
+
+        if profiler is not None:
+            profiler.mark("input")
+        player.loop(FPS, terrain)
+        player_2.loop(FPS, terrain)
+        if profiler is not None:
+            profiler.mark("loop")
+
+        # Маска игрока и объекта совпадает по размеру с их прямоугольником, поэтому
+        # проверять маски нужно только у объектов, чьи прямоугольники пересекают игрока.
+        collide = pygame.sprite.collide_mask
+        touched = [obj for obj in objects.visible(player.rect) if collide(player, obj)]
+        touched_2 = [obj for obj in objects.visible(player_2.rect) if collide(player_2, obj)]
+
+        for obj in touched:
+            if obj in objects.fruits:
+                self.remove(obj)
+                self.fruits_collected += 1
+
+        hit = [obj for obj in touched if obj in objects.mobs]
+        hit_2 = [obj for obj in touched_2 if obj in objects.mobs]
+        if self.buff_alive():
+            self.coll_mobs += len(set(hit).union(hit_2))
+        else:
+            for obj in hit_2:
+                self.remove(obj)
+                self.dead_mobs += 1
+            self.coll_mobs += len([obj for obj in hit if obj in objects.mobs])
 
-    Marshroom1 = Fruit(block_size * 10.4, HEIGHT - block_size * 1.80 - 48, 32, 32)
-    Marshroom2 = Fruit(block_size * 22.5, HEIGHT - block_size * 4.8 - 48, 32, 32)
-    Marshroom3 = Fruit(block_size * 7, HEIGHT - block_size * 0.85 - 48, 32, 32)
+        for obj in touched_2:
+            if obj in objects.buffs:
+                self.remove(obj)
+                self.eat_buff += 1
 
+        if profiler is not None:
+            profiler.mark("scan")
+        handle_move(player, player_2, terrain, controls.held)
+        if profiler is not None:
+            profiler.mark("move")
 
-    mob1 = Mob(block_size * 9.3, HEIGHT - block_size * 5.5 - 32, 64, 64)
+        if ((player.rect.right - self.offset_x >= WIDTH - self.scroll_area_width) and player.x_vel > 0) or (
+                (player.rect.left - self.offset_x <= self.scroll_area_width) and player.x_vel < 0):
+            self.offset_x += player.x_vel
 
-    buff1 = Buff(block_size * -1.8, HEIGHT - block_size * 5 - 48, 64, 64)
+        self.tick += 1
+        if profiler is not None:
+            profiler.mark("camera")
 
-    objects = [*floor, mob1, buff1, Marshroom1, Marshroom2, Marshroom3, platform1, platform12, platform13,
-               platform2, platform32, platform33, platform34, platform35, platform4, platform5, platform6,
-               platform7, platform8]
 
+LEVEL_DIR = "levels"
+LEVEL_CACHE_DIR = join(LEVEL_DIR, "__cache__")
+LEVELS = {1: join(LEVEL_DIR, "level1.json"), 2: join(LEVEL_DIR, "level2.json"), 3: join(LEVEL_DIR, "level3.json")}
 
-    run = True
+LevelData = namedtuple("LevelData", ["background", "block_size", "round_time", "fall_limit", "fruits_to_win",
+                                     "mobs_to_win", "spawn", "spawn_2", "tiles", "fruits", "mobs", "buffs"])
 
-    while run:
-        clock.tick(FPS)
+LEVEL_MAGIC = b"LVLC"
+LEVEL_VERSION = 1
+_LEVEL_HEADER = struct.Struct("<4sHqqHHdiHH4i64sIIII")
+_LEVEL_HEADER_BACKGROUND = 64
+_TILE = struct.Struct("<2i")
+_ENTITY = struct.Struct("<4i")
 
-        seconds_passed = (pygame.time.get_ticks() - start_time) / 1000
-        remaining_time = round_time - seconds_passed
-        if remaining_time <= 0:
-            show_game_over(window)
-            run = False
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run = False
-                break
+def parse_level(data):
+    """
+    Разбирает описание уровня в формате JSON.
+
+    Описание содержит фон (`background`), размер блока (`block_size`), время раунда
+    (`round_time`), высоту проигрыша (`fall_limit`), условия победы (`win`: `fruits`
+    и `mobs`), точки появления игроков (`spawn`: `player` и `player_2`), пол (`floor`:
+    столбцы `from`..`to` без `to` и список провалов `gaps` — закрытых диапазонов столбцов,
+    где блок опущен под экран), отдельные блоки `tiles` в виде [столбец, ряд], где ряд
+    отсчитывается от нижнего края окна, а также фрукты, мобов и баффы (`fruits`, `mobs`,
+    `buffs`) в виде прямоугольников [x, y, ширина, высота] в пикселях.
+
+    Координаты, размеры и пороги приводятся к целым отбрасыванием дробной части, как это
+    делает `pygame.Rect`.
+
+    :param data: Разобранный JSON уровня.
+    :type data: dict
+    :rtype: LevelData
+    :raises KeyError: Если в описании нет обязательного поля.
+    :raises ValueError: Если число или прямоугольник записаны неверно или имя фона длиннее
+        64 байт.
+    """
+    block_size = _level_int(data["block_size"], "block_size")
+    background = data["background"]
+    if len(background.encode("utf-8")) > _LEVEL_HEADER_BACKGROUND:
+        raise ValueError(f"background name is longer than {_LEVEL_HEADER_BACKGROUND} bytes: {background!r}")
+    tiles = []
+    floor = data.get("floor")
+    if floor:
+        gaps = floor.get("gaps", [])
+        for i in range(floor["from"], floor["to"]):
+            gap = any(first <= i <= last for first, last in gaps)
+            tiles.append((i * block_size, HEIGHT if gap else HEIGHT - block_size))
+    tiles.extend((col * block_size, HEIGHT - row * block_size) for col, row in data.get("tiles", []))
+
+    return LevelData(
+        background=background,
+        block_size=block_size,
+        round_time=_level_number(data.get("round_time", 100), "round_time"),
+        fall_limit=_level_int(data["fall_limit"], "fall_limit"),
+        fruits_to_win=_level_int(data["win"]["fruits"], "win.fruits"),
+        mobs_to_win=_level_int(data["win"]["mobs"], "win.mobs"),
+        spawn=_level_ints(data["spawn"]["player"], 2, "spawn.player"),
+        spawn_2=_level_ints(data["spawn"]["player_2"], 2, "spawn.player_2"),
+        tiles=[(_level_int(x, "tiles"), _level_int(y, "tiles")) for x, y in tiles],
+        fruits=[_level_ints(rect, 4, "fruits") for rect in data.get("fruits", [])],
+        mobs=[_level_ints(rect, 4, "mobs") for rect in data.get("mobs", [])],
+        buffs=[_level_ints(rect, 4, "buffs") for rect in data.get("buffs", [])],
+    )
+
+
+def _level_number(value, field):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f"{field}: expected a number, got {value!r}")
+    return value
+
+
+def _level_int(value, field):
+    return int(_level_number(value, field))
+
+
+def _level_ints(values, count, field):
+    if not isinstance(values, (list, tuple)) or len(values) != count:
+        raise ValueError(f"{field}: expected {count} numbers, got {values!r}")
+    return tuple(_level_int(value, field) for value in values)
+
+
+def compile_level(level_data, source_mtime_ns=0, source_size=0):
+    """
+    Упаковывает данные уровня в компактный двоичный вид.
+
+    :param level_data: Данные уровня.
+    :type level_data: LevelData
+    :param source_mtime_ns: Время изменения исходного файла, по которому проверяется актуальность.
+    :type source_mtime_ns: int
+    :param source_size: Размер исходного файла.
+    :type source_size: int
+    :rtype: bytes
+    """
+    header = _LEVEL_HEADER.pack(
+        LEVEL_MAGIC, LEVEL_VERSION, source_mtime_ns, source_size, HEIGHT, level_data.block_size,
+        level_data.round_time, level_data.fall_limit, level_data.fruits_to_win, level_data.mobs_to_win,
+        *level_data.spawn, *level_data.spawn_2, level_data.background.encode("utf-8"),
+        len(level_data.tiles), len(level_data.fruits), len(level_data.mobs), len(level_data.buffs))
+    parts = [header]
+    parts.extend(_TILE.pack(*tile) for tile in level_data.tiles)
+    for rects in (level_data.fruits, level_data.mobs, level_data.buffs):
+        parts.extend(_ENTITY.pack(*rect) for rect in rects)
+    return b"".join(parts)
+
+
+def read_compiled_level(blob, source_mtime_ns=None, source_size=None):
+    """
+    Читает уровень из двоичного вида, созданного `compile_level`.
+
+    :param blob: Двоичные данные уровня.
+    :type blob: bytes
+    :param source_mtime_ns: Ожидаемое время изменения исходного файла (None — не проверять).
+    :type source_mtime_ns: int or None
+    :param source_size: Ожидаемый размер исходного файла (None — не проверять).
+    :type source_size: int or None
+    :rtype: LevelData
+    :raises ValueError: Если данные повреждены, устарели или собраны другой версией.
+    """
+    try:
+        (magic, version, mtime_ns, size, height, block_size, round_time, fall_limit, fruits_to_win, mobs_to_win,
+         x, y, x_2, y_2, background, n_tiles, n_fruits, n_mobs, n_buffs) = _LEVEL_HEADER.unpack_from(blob)
+    except struct.error as error:
+        raise ValueError("truncated level cache") from error
+    if magic != LEVEL_MAGIC or version != LEVEL_VERSION or height != HEIGHT:
+        raise ValueError("incompatible level cache")
+    if (source_mtime_ns is not None and mtime_ns != source_mtime_ns) or (source_size is not None and size != source_size):
+        raise ValueError("stale level cache")
+
+    offset = _LEVEL_HEADER.size
+    end = offset + n_tiles * _TILE.size
+    entity_end = end + (n_fruits + n_mobs + n_buffs) * _ENTITY.size
+    if len(blob) != entity_end:
+        raise ValueError("truncated level cache")
+    tiles = list(_TILE.iter_unpack(blob[offset:end]))
+    entities = list(_ENTITY.iter_unpack(blob[end:entity_end]))
+
+    return LevelData(
+        background=background.rstrip(b"\0").decode("utf-8"),
+        block_size=block_size,
+        round_time=round_time,
+        fall_limit=fall_limit,
+        fruits_to_win=fruits_to_win,
+        mobs_to_win=mobs_to_win,
+        spawn=(x, y),
+        spawn_2=(x_2, y_2),
+        tiles=tiles,
+        fruits=entities[:n_fruits],
+        mobs=entities[n_fruits:n_fruits + n_mobs],
+        buffs=entities[n_fruits + n_mobs:],
+    )
+
+
+def load_level_data(path, cache_dir=LEVEL_CACHE_DIR):
+    """
+    Загружает данные уровня, используя скомпилированный кэш, если он актуален.
 
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_w and player.jump_count < 2:
-                    player.jump()
-                if event.key == pygame.K_SPACE and player_2.jump_count < 2:
-                    player_2.jump()
-                if event.key == pygame.K_ESCAPE:
-                    run = False
-            if fruits_collected == 3 and dead_mobs == 1:
-                show_you_win(window)
-                run = False
-            if coll_mobs >= 1:
-                show_game_over(window)
-                run = False
-        if (player.rect.bottom > 630) or (player_2.rect.bottom > 630):
-            show_game_over(window)
-            run = False
-
-        player.loop(FPS)
-        player_2.loop(FPS)
-        for obj in objects[:]:
-            if isinstance(obj, Fruit) and (pygame.sprite.collide_mask(player, obj)):
-                objects.remove(obj)
-                fruits_collected += 1
-
-        for obj in objects[:]:
-            if isinstance(obj, Mob) and (pygame.sprite.collide_mask(player, obj) or pygame.sprite.collide_mask(player_2, obj)) and buff1 in objects:
-                coll_mobs += 1
-
-        for obj in objects[:]:
-            if isinstance(obj, Mob) and (pygame.sprite.collide_mask(player_2, obj)) and buff1 not in objects:
-                objects.remove(obj)
-                dead_mobs += 1
-
-        for obj in objects[:]:
-            if isinstance(obj, Mob) and (pygame.sprite.collide_mask(player, obj)) and buff1 not in objects:
-                coll_mobs += 1
-
-        for obj in objects[:]:
-            if isinstance(obj, Buff) and (pygame.sprite.collide_mask(player_2, obj)):
-                objects.remove(obj)
-                eat_buff += 1
-
-        handle_move(player, player_2, objects)
-        handle_vertical_collision(player, objects, player.y_vel)
-        handle_vertical_collision(player_2, objects, player_2.y_vel)
-        draw(window, background, bg_image, player, player_2, objects, offset_x, fruits_collected)
-
-        if ((player.rect.right - offset_x >= WIDTH - scroll_area_width) and player.x_vel > 0) or (
-                (player.rect.left - offset_x <= scroll_area_width) and player.x_vel < 0):
-            offset_x += player.x_vel
+    При отсутствии или устаревании кэша JSON разбирается заново, а двоичный вид
+    записывается в `cache_dir` для следующих запусков.
 
+    :param path: Путь к JSON-файлу уровня.
+    :type path: str
+    :param cache_dir: Папка для скомпилированных уровней (None — не использовать кэш).
+    :type cache_dir: str or None
+    :rtype: LevelData
+    :raises FileNotFoundError: Если файл уровня не найден.
+    """
+    stat = os.stat(path)
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = join(cache_dir, os.path.splitext(os.path.basename(path))[0] + ".lvlc")
+        try:
+            with open(cache_path, "rb") as file:
+                return read_compiled_level(file.read(), stat.st_mtime_ns, stat.st_size)
+        except (OSError, ValueError):
+            pass
+
+    with open(path, encoding="utf-8") as file:
+        level_data = parse_level(json.load(file))
+
+    if cache_path is not None:
+        blob = compile_level(level_data, stat.st_mtime_ns, stat.st_size)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path, "wb") as file:
+                file.write(blob)
+        except OSError:
+            pass
+    return level_data
+
+
+def build_level_from_data(level_data):
+    """
+    Создаёт объекты уровня по его данным.
 
-def level2(window):
+    :param level_data: Данные уровня.
+    :type level_data: LevelData
+    :rtype: Level
+    """
+    player = Player(*level_data.spawn, 50, 50)
+    player_2 = Player_2(*level_data.spawn_2, 50, 50)
+    fruits = [Fruit(*rect) for rect in level_data.fruits]
+    mobs = [Mob(*rect) for rect in level_data.mobs]
+    buffs = [Buff(*rect) for rect in level_data.buffs]
+
+    return Level(level_data.background, player, player_2, [*fruits, *mobs, *buffs],
+                 buffs[0] if buffs else None, level_data.fruits_to_win, level_data.mobs_to_win,
+                 level_data.fall_limit, level_data.round_time,
+                 TileMap.from_tiles(level_data.tiles, level_data.block_size))
+
+
+CHUNK_MAGIC = b"LVLS"
+CHUNK_VERSION = 1
+_CHUNK_HEADER = struct.Struct("<4sHqqHHiIi")
+_CHUNK_INDEX = struct.Struct("<QII")
+_CHUNK_ENTITY = struct.Struct("<6i")
+ENTITY_KINDS = (Fruit, Mob, Buff)
+
+
+def write_chunk_file(level_data, path, chunk_width=WIDTH, source_mtime_ns=0, source_size=0):
+    """
+    Записывает блоки и предметы уровня в файл участков для потоковой загрузки.
+
+    Уровень делится по оси X на участки шириной `chunk_width`. Файл содержит заголовок,
+    таблицу участков (смещение, число блоков, число предметов) и данные участков подряд,
+    поэтому любой участок читается из отображённого в память файла без разбора остальных.
+    Каждый предмет хранит постоянный номер, по которому уровень помнит, что он уже собран.
+
+    :param level_data: Данные уровня.
+    :type level_data: LevelData
+    :param path: Путь к создаваемому файлу.
+    :type path: str
+    :param chunk_width: Ширина участка в пикселях.
+    :type chunk_width: int
+    """
+    chunks = {}
+    for tile in level_data.tiles:
+        chunks.setdefault(tile[0] // chunk_width, ([], []))[0].append(tile)
+    entities = [(kind, rect) for kind, rects in enumerate((level_data.fruits, level_data.mobs, level_data.buffs))
+                for rect in rects]
+    for entity_id, (kind, rect) in enumerate(entities):
+        chunks.setdefault(rect[0] // chunk_width, ([], []))[1].append((entity_id, kind, *rect))
+    buff_id = len(level_data.fruits) + len(level_data.mobs) if level_data.buffs else -1
+
+    first = min(chunks) if chunks else 0
+    count = max(chunks) - first + 1 if chunks else 0
+    offset = _CHUNK_HEADER.size + count * _CHUNK_INDEX.size
+    index = []
+    data = []
+    for chunk in range(first, first + count):
+        tiles, chunk_entities = chunks.get(chunk, ([], []))
+        index.append(_CHUNK_INDEX.pack(offset, len(tiles), len(chunk_entities)))
+        data.extend(_TILE.pack(*tile) for tile in tiles)
+        data.extend(_CHUNK_ENTITY.pack(*entity) for entity in chunk_entities)
+        offset += len(tiles) * _TILE.size + len(chunk_entities) * _CHUNK_ENTITY.size
+
+    header = _CHUNK_HEADER.pack(CHUNK_MAGIC, CHUNK_VERSION, source_mtime_ns, source_size, level_data.block_size,
+                                chunk_width, first, count, buff_id)
+    with open(path, "wb") as file:
+        file.write(header)
+        file.write(b"".join(index))
+        file.write(b"".join(data))
+
+
+class ChunkFile:
+    """
+    Файл участков уровня, отображённый в память.
+
+    Данные участка читаются напрямую из отображения по смещению из таблицы, так что
+    в памяти процесса находятся только страницы, к которым обращались.
+
+    :param path: Путь к файлу, созданному `write_chunk_file`.
+    :type path: str
+    :raises ValueError: Если файл повреждён или собран другой версией.
+    """
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            (magic, version, self.source_mtime_ns, self.source_size, self.block_size, self.chunk_width,
+             self.first, self.count, self.buff_id) = _CHUNK_HEADER.unpack_from(self._map)
+        except (ValueError, struct.error) as error:
+            self._file.close()
+            raise ValueError("invalid chunk file") from error
+        if magic != CHUNK_MAGIC or version != CHUNK_VERSION:
+            self.close()
+            raise ValueError("incompatible chunk file")
+
+    def __contains__(self, chunk):
+        return self.first <= chunk < self.first + self.count
+
+    def read(self, chunk):
+        """
+        Читает участок с номером `chunk`.
+
+        :returns: Список блоков (x, y) и список предметов (номер, вид, x, y, ширина, высота).
+        :rtype: tuple (list, list)
+        """
+        if chunk not in self:
+            return [], []
+        offset, n_tiles, n_entities = _CHUNK_INDEX.unpack_from(
+            self._map, _CHUNK_HEADER.size + (chunk - self.first) * _CHUNK_INDEX.size)
+        tiles = [_TILE.unpack_from(self._map, offset + i * _TILE.size) for i in range(n_tiles)]
+        offset += n_tiles * _TILE.size
+        entities = [_CHUNK_ENTITY.unpack_from(self._map, offset + i * _CHUNK_ENTITY.size) for i in range(n_entities)]
+        return tiles, entities
+
+    def close(self):
+        if not self._map.closed:
+            self._map.close()
+        self._file.close()
+
+
+class StreamingLevel(Level):
+    """
+    Уровень, участки которого подгружаются из файла участков по мере движения камеры.
+
+    В памяти держатся только участки вокруг камеры и обоих игроков (плюс `lookahead`
+    участков с каждой стороны), а дальние выгружаются. Собранные фрукты, убитые мобы
+    и съеденные баффы запоминаются по номеру и не появляются снова при повторной загрузке
+    участка. За один такт подгружается не больше `loads_per_tick` участков, чтобы
+    загрузка не вызывала подтормаживаний.
+
+    :param level_data: Данные уровня (фон, условия победы, точки появления).
+    :type level_data: LevelData
+    :param chunk_file: Файл участков уровня.
+    :type chunk_file: ChunkFile
+    :param lookahead: Сколько участков держать загруженными за пределами камеры.
+    :type lookahead: int
+    :param loads_per_tick: Максимум участков, загружаемых за один такт.
+    :type loads_per_tick: int
+    """
+    def __init__(self, level_data, chunk_file, lookahead=1, loads_per_tick=1):
+        super().__init__(level_data.background, Player(*level_data.spawn, 50, 50),
+                         Player_2(*level_data.spawn_2, 50, 50), [], None, level_data.fruits_to_win,
+                         level_data.mobs_to_win, level_data.fall_limit, level_data.round_time,
+                         TileMap(chunk_file.block_size))
+        self.chunks = chunk_file
+        self.lookahead = lookahead
+        self.loads_per_tick = loads_per_tick
+        self.loaded = {}
+        self.chunk_tiles = {}
+        self.stream(limit=None)
+
+    def wanted_chunks(self):
+        width = self.chunks.chunk_width
+        left = min(self.offset_x, self.player.rect.left, self.player_2.rect.left) - width * self.lookahead
+        right = max(self.offset_x + WIDTH, self.player.rect.right, self.player_2.rect.right) + width * self.lookahead
+        return range(int(left) // width, int(right) // width + 1)
+
+    def stream(self, limit=None):
+        """
+        Выгружает участки вне нужного диапазона и подгружает недостающие, начиная с
+        ближайших к камере.
+
+        :param limit: Максимум загружаемых участков (None — все нужные).
+        :type limit: int or None
+        """
+        wanted = self.wanted_chunks()
+        unloaded = [chunk for chunk in self.loaded if chunk not in wanted]
+        for chunk in unloaded:
+            self.unload_chunk(chunk)
+        if unloaded:
+            # Выгрузка только обнуляет клетки; без обрезки сетка росла бы с пройденным путём.
+            width = self.chunks.chunk_width
+            self.terrain.crop(wanted.start * width, wanted.stop * width)
+
+        center = (self.offset_x + WIDTH // 2) // self.chunks.chunk_width
+        missing = sorted((chunk for chunk in wanted if chunk not in self.loaded and chunk in self.chunks),
+                         key=lambda chunk: abs(chunk - center))
+        for chunk in missing[:limit]:
+            self.load_chunk(chunk)
+
+    def load_chunk(self, chunk):
+        tiles, entities = self.chunks.read(chunk)
+        for x, y in tiles:
+            self.terrain.add(x, y)
+        self.chunk_tiles[chunk] = tiles
+        objects = {}
+        for entity_id, kind, x, y, width, height in entities:
+            if entity_id in self.consumed:
+                continue
+            obj = ENTITY_KINDS[kind](x, y, width, height)
+            self.entity_ids[obj] = entity_id
+            self.objects.add(obj)
+            objects[obj] = None
+        self.loaded[chunk] = objects
+
+    def unload_chunk(self, chunk):
+        for x, y in self.chunk_tiles.pop(chunk):
+            self.terrain.remove(x, y)
+        for obj in self.loaded.pop(chunk):
+            self.objects.remove(obj)
+            self.entity_ids.pop(obj, None)
+
+    def remove(self, obj):
+        super().remove(obj)
+        if self.entity_ids.pop(obj, None) is not None:
+            self.loaded[obj.rect.x // self.chunks.chunk_width].pop(obj)
+
+    def buff_alive(self):
+        return self.chunks.buff_id >= 0 and self.chunks.buff_id not in self.consumed
+
+    def reset(self):
+        for chunk in list(self.loaded):
+            self.unload_chunk(chunk)
+        super().reset()
+        self.stream(limit=None)
+
+    def restore_consumed(self, consumed):
+        for chunk in list(self.loaded):
+            self.unload_chunk(chunk)
+        self.consumed = set(consumed)
+        self.stream(limit=None)
+
+    def step(self, controls):
+        super().step(controls)
+        self.stream(self.loads_per_tick)
+
+    def close(self):
+        self.chunks.close()
+
+
+def load_streaming_level(path, cache_dir=LEVEL_CACHE_DIR, chunk_width=WIDTH):
+    """
+    Открывает уровень в потоковом режиме, при необходимости пересобирая файл участков.
+
+    :param path: Путь к JSON-файлу уровня.
+    :type path: str
+    :param cache_dir: Папка для файлов участков.
+    :type cache_dir: str
+    :param chunk_width: Ширина участка в пикселях.
+    :type chunk_width: int
+    :rtype: StreamingLevel
+    """
+    return StreamingLevel(*open_level_chunks(path, cache_dir, chunk_width))
+
+
+def open_level_chunks(path, cache_dir=LEVEL_CACHE_DIR, chunk_width=WIDTH):
+    """
+    Читает данные уровня и открывает его файл участков, при необходимости пересобирая его.
+    Не создаёт поверхностей pygame, поэтому может выполняться в фоновом потоке.
+
+    :returns: Данные уровня и файл участков.
+    :rtype: tuple(LevelData, ChunkFile)
+    """
+    stat = os.stat(path)
+    level_data = load_level_data(path, cache_dir)
+    chunk_path = join(cache_dir, os.path.splitext(os.path.basename(path))[0] + ".lvls")
+    try:
+        chunk_file = ChunkFile(chunk_path)
+        if (chunk_file.source_mtime_ns, chunk_file.source_size, chunk_file.chunk_width) != (
+                stat.st_mtime_ns, stat.st_size, chunk_width):
+            chunk_file.close()
+            raise ValueError("stale chunk file")
+    except (OSError, ValueError):
+        os.makedirs(cache_dir, exist_ok=True)
+        write_chunk_file(level_data, chunk_path, chunk_width, stat.st_mtime_ns, stat.st_size)
+        chunk_file = ChunkFile(chunk_path)
+    return level_data, chunk_file
+
+
+def read_level(number, streaming=False):
+    """
+    Читает данные уровня с номером `number` из файла в папке `levels`, не создавая игроков,
+    объектов и поверхностей. Может выполняться в фоновом потоке, а сам уровень из данных
+    собирает `level_from_data` в главном.
+
+    :returns: Данные уровня, а в потоковом режиме — данные уровня и файл участков.
+    :rtype: LevelData or tuple(LevelData, ChunkFile)
+    :raises KeyError: Если уровня с таким номером нет.
+    """
+    if streaming:
+        return open_level_chunks(LEVELS[number])
+    return load_level_data(LEVELS[number])
+
+
+def level_from_data(data, streaming=False):
+    """
+    Собирает уровень из результата `read_level`.
+
+    :rtype: Level
+    """
+    if streaming:
+        return StreamingLevel(*data)
+    return build_level_from_data(data)
+
+
+def build_level(number, streaming=False):
+    """
+    Строит уровень с номером `number` из файла в папке `levels`.
+
+    :param streaming: Загружать участки уровня по мере движения камеры.
+    :type streaming: bool
+    :rtype: Level
+    :raises KeyError: Если уровня с таким номером нет.
+    """
+    return level_from_data(read_level(number, streaming), streaming)
+
+
+class LevelPool:
+    """
+    Уровни, готовые к игре без повторной сборки.
+
+    Каждый уровень строится один раз, а при следующем запросе возвращается к исходному
+    состоянию через `Level.reset`, что занимает доли миллисекунды. `prebuild` заранее читает
+    файлы уровня в фоновом потоке, например следующего, пока игрок проходит текущий, а игроки,
+    объекты и их поверхности создаются только в главном потоке при первом `get`.
+    Игроки строятся со скинами, выбранными в момент сборки, поэтому скины входят в ключ.
+    Хранится не больше `maxsize` уровней, давно не запрошенные вытесняются.
+
+    :param maxsize: Максимальное количество хранимых уровней.
+    :type maxsize: int
+    """
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self._levels = OrderedDict()
+        self._executor = None
+
+    def _store(self, key, level):
+        self._levels[key] = level
+        self._levels.move_to_end(key)
+        while len(self._levels) > self.maxsize:
+            _, evicted = self._levels.popitem(last=False)
+            if isinstance(evicted, Future):
+                evicted.add_done_callback(lambda future: self._close(self._finished(future)))
+            else:
+                self._close(evicted)
+
+    @staticmethod
+    def _finished(future):
+        if future.cancelled() or future.exception() is not None:
+            return None
+        return future.result()
+
+    @staticmethod
+    def _close(level):
+        if isinstance(level, StreamingLevel):
+            level.close()
+        elif isinstance(level, tuple):
+            level[1].close()
+
+    def prebuild(self, number, streaming=False):
+        """
+        Начинает читать уровень `number` в фоновом потоке, если его ещё нет в пуле.
+        Несуществующие номера уровней пропускаются.
+        """
+        key = (number, streaming, skin, skin_2)
+        if number not in LEVELS or key in self._levels:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="prebuild")
+        self._store(key, self._executor.submit(read_level, number, streaming))
+
+    def get(self, number, streaming=False):
+        """
+        Возвращает уровень `number` в исходном состоянии: из пула, собранный из данных,
+        прочитанных в фоне, или построенный заново.
+
+        :rtype: Level
+        :raises KeyError: Если уровня с таким номером нет.
+        """
+        key = (number, streaming, skin, skin_2)
+        level = self._levels.get(key)
+        if level is None:
+            level = build_level(number, streaming)
+        elif isinstance(level, Future):
+            level = level_from_data(level.result(), streaming)
+        level.reset()
+        self._store(key, level)
+        return level
+
+    def __contains__(self, key):
+        return key in self._levels
+
+    def __len__(self):
+        return len(self._levels)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        for level in self._levels.values():
+            if isinstance(level, Future):
+                level = self._finished(level) if level.done() else None
+            if level is not None:
+                self._close(level)
+        self._levels.clear()
+
+
+level_pool = LevelPool()
+
+
+def run_level(window, level, controls=None, on_tick=None, speed=1, profiler=None, rewind=None, measure_all=True):
+    """
+    Играет уровень в окне с фиксированным шагом физики.
+
+    Логика уровня всегда выполняется с частотой `FPS` тактов в секунду, а кадры выводятся
+    с частотой `RENDER_FPS` (0 — без ограничения). Накопитель времени решает, сколько шагов
+    физики выполнить за кадр: при медленной отрисовке пропущенные шаги догоняются
+    (но не больше чем на `MAX_FRAME_TIME` секунд за кадр), а при быстрой — игроки и камера
+    интерполируются между двумя последними шагами.
+
+    Клавиша F3 включает и выключает таблицу времени фаз кадра. Пока таблица скрыта и
+    профилировщик не передан, время фаз не замеряется.
+
+    :param window: Окно для отрисовки.
+    :type window: pygame.Surface
+    :param level: Уровень.
+    :type level: Level
+    :param controls: Источник ввода (по умолчанию клавиатура).
+    :type controls: LiveInput or ScriptedInput or None
+    :param on_tick: Функция `on_tick(level, controls)`, вызываемая после каждого такта.
+    :type on_tick: callable or None
+    :param speed: Во сколько раз игра идёт быстрее реального времени.
+    :type speed: float
+    :param profiler: Профилировщик, который замеряет каждый кадр независимо от F3.
+    :type profiler: FrameProfiler or None
+    :param rewind: Буфер перемотки: в него записывается каждый такт, а клавиши перемотки
+        и быстрых сохранений возвращают уровень к записанному состоянию.
+    :type rewind: RewindBuffer or None
+    :param measure_all: Замерять переданным профилировщиком каждый кадр. Если False, он
+        заполняется, только пока таблица F3 на экране.
+    :type measure_all: bool
+    :returns: Итог уровня: "win", "lose" или "quit".
+    :rtype: str
+    """
     clock = pygame.time.Clock()
-    background, bg_image = get_background("Green.png")
-
-    start_time = pygame.time.get_ticks()
-    round_time = 100
-
-    offset_x = -1500
-    scroll_area_width = 500
-
-    block_size = 96
-
-    player = Player(-900, 500, 50, 50)
-    player_2 = Player_2(-800, 500, 50, 50)
-
-    coll_mobs = 0
-    dead_mobs = 0
-    eat_buff = 0
-    fruits_collected = 0
-
-    floor = [
-        Block(
-            i * block_size,
-            HEIGHT - block_size if not (
-                    -1 <= i <= 1 or 6 <= i <= 8 or 10 <= i <= 15 or 21 <= i <= 23 or 25 <= i <= 26 or 27 <= i <= 28) else HEIGHT,
-            block_size
-        )
-        for i in range(-WIDTH // block_size, (WIDTH * 3) // block_size)
-    ]
-
-    platformm103 = Block(block_size * -10, HEIGHT - block_size * 3, block_size)
-    platformm95 = Block(block_size * -8, HEIGHT - block_size * 5, block_size)
-    platformm112 = Block(block_size * -11, HEIGHT - block_size * 2, block_size)
-    platformm113 = Block(block_size * -11, HEIGHT - block_size * 3, block_size)
-    platformm114 = Block(block_size * -11, HEIGHT - block_size * 4, block_size)
-    platformm115 = Block(block_size * -11, HEIGHT - block_size * 5, block_size)
-    platformm116 = Block(block_size * -11, HEIGHT - block_size * 6, block_size)
-    platformm117 = Block(block_size * -11, HEIGHT - block_size * 7, block_size)
-    platform22 = Block(block_size * 2, HEIGHT - block_size * 2, block_size)
-    platform54 = Block(block_size * 5, HEIGHT - block_size * 4, block_size)
-    platform96 = Block(block_size * 9, HEIGHT - block_size * 6, block_size)
-    platform134 = Block(block_size * 13, HEIGHT - block_size * 4, block_size)
-    platform162 = Block(block_size * 16, HEIGHT - block_size * 2, block_size)
-    platform196 = Block(block_size * 19, HEIGHT - block_size * 6, block_size)
-    platform204 = Block(block_size * 20, HEIGHT - block_size * 4, block_size)
-    platform301 = Block(block_size * 30, HEIGHT - block_size * 1, block_size)
-    platform302 = Block(block_size * 30, HEIGHT - block_size * 2, block_size)
-    platform303 = Block(block_size * 30, HEIGHT - block_size * 3, block_size)
-    platform304 = Block(block_size * 30, HEIGHT - block_size * 4, block_size)
-    platform305 = Block(block_size * 30, HEIGHT - block_size * 5, block_size)
-    platform306 = Block(block_size * 30, HEIGHT - block_size * 6, block_size)
-    platform307 = Block(block_size * 30, HEIGHT - block_size * 7, block_size)
-
-    apple1 = Fruit(block_size * 9, HEIGHT - block_size * 0.85 - 48, 32, 32)
-    apple2 = Fruit(block_size * 19, HEIGHT - block_size * 5.85 - 48, 32, 32)
-    apple3 = Fruit(block_size * 29, HEIGHT - block_size * 0.85 - 48, 32, 32)
-
-    mob1 = Mob(block_size * -4, HEIGHT - block_size * 0.85 - 82, 64, 64)
-    mob2 = Mob(block_size * 5, HEIGHT - block_size * 0.85 - 82, 64, 64)
-
-    buff1 = Buff(block_size * -8 + 16, HEIGHT - block_size * 4.85 - 82, 64, 64)
-
-    objects = [*floor, apple1, apple2, apple3, mob1, mob2, buff1, platformm103, platformm95, platform196, platform204,
-               platform301, platform302, platform303, platform304, platform305, platform306, platform307, platformm112,
-               platformm113, platformm114, platformm115, platformm116, platformm117, platform22, platform54, platform96,
-               platform134, platform162]
-
-    run = True
-    while run:
-        clock.tick(FPS)
-
-        seconds_passed = (pygame.time.get_ticks() - start_time) / 1000
-        remaining_time = round_time - seconds_passed
-        if remaining_time <= 0:
-            show_game_over(window)
-            run = False
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run = False
-                break
+    if controls is None:
+        controls = LiveInput()
+    recording = profiler is not None and measure_all
+    if profiler is None:
+        profiler = FrameProfiler()
+    show_overlay = False
+    active = recording
+    level.profiler = profiler if active else None
+
+    background = resources.background(level.background, BACKGROUND_PARALLAX)
+    dirty = DirtyRects(DIRTY_RECTS)
+    hud = Hud()
+
+    step_time = 1 / (FPS * speed)
+    accumulator = step_time
+    pressed = []
+    quit_requested = False
+    previous = time.perf_counter()
+
+    while level.outcome is None:
+        if active:
+            profiler.begin_frame()
+        clock.tick(RENDER_FPS)
+        now = time.perf_counter()
+        accumulator += min(now - previous, MAX_FRAME_TIME)
+        previous = now
+        if active:
+            profiler.mark("wait")
+
+        toggle = False
+        if not controls.per_tick:
+            polled = controls.poll()
+            pressed.extend(polled.pressed)
+            quit_requested |= polled.quit
+            toggle = pygame.K_F3 in polled.pressed
+            if active:
+                profiler.mark("events")
+        while accumulator >= step_time and level.outcome is None:
+            if controls.per_tick:
+                tick_input = controls.poll()
+                toggle ^= pygame.K_F3 in tick_input.pressed
+                if active:
+                    profiler.mark("events")
+            else:
+                tick_input = TickInput(tuple(pressed), polled.held, quit_requested)
+                pressed.clear()
+                quit_requested = False
+            accumulator -= step_time
+            if rewind is not None and rewind.control(level, tick_input):
+                continue
+            level.time = level.tick / FPS
+            level.step(tick_input)
+            if on_tick is not None:
+                on_tick(level, tick_input)
+            if rewind is not None:
+                rewind.record(level)
+
+        alpha = min(accumulator / step_time, 1)
+        draw(window, background, None, level.player, level.player_2, level.objects, level.render_offset(alpha),
+             level.fruits_collected, level.terrain, dirty, hud, level.remaining_time, alpha,
+             profiler if active else None, profiler.overlay() if show_overlay else None)
+
+        if toggle:
+            show_overlay = not show_overlay
+            active = recording or show_overlay
+            level.profiler = profiler if active else None
+
+    if level.outcome == "win":
+        show_you_win(window)
+    elif level.outcome == "lose":
+        show_game_over(window)
+    return level.outcome
+
+
+HeadlessResult = namedtuple("HeadlessResult", ["outcome", "ticks", "seconds", "ticks_per_second"])
+
+
+def run_headless(level, controls=None, max_ticks=None, on_tick=None):
+    """
+    Прогоняет логику уровня без отрисовки и без ограничения частоты кадров.
+
+    Время раунда считается по тактам (`tick / FPS`), поэтому результат не зависит от
+    скорости машины. Для работы без окна перед импортом модуля нужно выбрать драйвер
+    SDL "dummy" (это делает флаг командной строки `--headless`).
+
+    :param level: Уровень.
+    :type level: Level
+    :param controls: Источник ввода (по умолчанию игроки ничего не нажимают).
+    :type controls: ScriptedInput or None
+    :param max_ticks: Максимальное число тактов (по умолчанию длительность раунда).
+    :type max_ticks: int or None
+    :param on_tick: Функция `on_tick(level, controls)`, вызываемая после каждого такта.
+    :type on_tick: callable or None
+    :rtype: HeadlessResult
+    """
+    if controls is None:
+        controls = ScriptedInput(())
+    if max_ticks is None:
+        max_ticks = int(level.round_time * FPS) + 1
+
+    start = time.perf_counter()
+    while level.outcome is None and level.tick < max_ticks:
+        tick_input = controls.poll()
+        level.time = level.tick / FPS
+        level.step(tick_input)
+        if on_tick is not None:
+            on_tick(level, tick_input)
+    seconds = time.perf_counter() - start
+
+    ticks_per_second = level.tick / seconds if seconds else float("inf")
+    return HeadlessResult(level.outcome, level.tick, seconds, ticks_per_second)
+
+
+def state_hash(level):
+    """
+    Считает контрольную сумму состояния уровня после такта.
+
+    В сумму входят положение, скорости, счётчики и кадр анимации обоих игроков, камера,
+    счётчики уровня и число оставшихся объектов вместе с тайлами земли.
+
+    :rtype: int
+    """
+    parts = []
+    for player in (level.player, level.player_2):
+        parts.append(_PLAYER_STATE.pack(*player.rect, float(player.x_vel), float(player.y_vel), player.fall_count,
+                                        player.jump_count, player.hit, player.hit_count, player.animation_count,
+                                        player.direction == "left"))
+    parts.append(_LEVEL_STATE.pack(int(level.offset_x), level.fruits_collected, level.coll_mobs, level.dead_mobs,
+                                   level.eat_buff, len(level.objects) + len(level.terrain), level.tick,
+                                   OUTCOMES.index(level.outcome)))
+    return zlib.crc32(b"".join(parts))
 
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_w and player.jump_count < 2:
-                    player.jump()
-                if event.key == pygame.K_SPACE and player_2.jump_count < 2:
-                    player_2.jump()
-                if event.key == pygame.K_ESCAPE:
-                    run = False
-                if fruits_collected == 3 and dead_mobs == 2:
-                    show_you_win(window)
-                    run = False
-                if coll_mobs >= 1:
-                    show_game_over(window)
-                    run = False
-
-        if (player.rect.bottom > 630) or (player_2.rect.bottom > 630):
-            show_game_over(window)
-            run = False
-
-        player.loop(FPS)
-        player_2.loop(FPS)
-
-        for obj in objects[:]:
-            if isinstance(obj, Fruit) and (pygame.sprite.collide_mask(player, obj)):
-                objects.remove(obj)
-                fruits_collected += 1
-        
-        for obj in objects[:]:
-            if isinstance(obj, Mob) and (pygame.sprite.collide_mask(player, obj) or pygame.sprite.collide_mask(player_2, obj)) and buff1 in objects:
-                coll_mobs += 1
-
-        for obj in objects[:]:
-            if isinstance(obj, Mob) and (pygame.sprite.collide_mask(player_2, obj)) and buff1 not in objects:
-                objects.remove(obj)
-                dead_mobs += 1
-        
-        for obj in objects[:]:
-            if isinstance(obj, Mob) and (pygame.sprite.collide_mask(player, obj)) and buff1 not in objects:
-                coll_mobs += 1
-
-        for obj in objects[:]:
-            if isinstance(obj, Buff) and (pygame.sprite.collide_mask(player_2, obj)):
-                objects.remove(obj)
-                eat_buff += 1
-
-        handle_move(player, player_2, objects)
-        handle_vertical_collision(player, objects, player.y_vel)
-        handle_vertical_collision(player_2, objects, player_2.y_vel)
-        draw(window, background, bg_image, player, player_2, objects, offset_x, fruits_collected)
-
-        if ((player.rect.right - offset_x >= WIDTH - scroll_area_width) and player.x_vel > 0) or (
-                (player.rect.left - offset_x <= scroll_area_width) and player.x_vel < 0):
-            offset_x += player.x_vel
+
+OUTCOMES = ("win", "lose", "quit", None)
+_PLAYER_STATE = struct.Struct("<4idd2i?2i?")
+_LEVEL_STATE = struct.Struct("<8i")
+
+
+class ReplayDivergence(Exception):
+    """
+    Состояние уровня при воспроизведении разошлось с записанным.
+
+    :param tick: Номер такта, на котором обнаружено расхождение.
+    :type tick: int
+    """
+    def __init__(self, tick, expected, actual):
+        super().__init__(f"replay diverged at tick {tick}: expected state {expected:08x}, got {actual:08x}")
+        self.tick = tick
+        self.expected = expected
+        self.actual = actual
+
+
+class InputLog:
+    """
+    Запись ввода игроков по тактам вместе с контрольной суммой состояния после каждого такта.
+
+    Запись передаётся в `run_level` или `run_headless` как `on_tick=log.record`, а при
+    воспроизведении те же такты подаются через `ScriptedInput(log.inputs)` и проверяются
+    методом `verify`.
+
+    :param level: Номер уровня.
+    :type level: int
+    :param streaming: Играется ли уровень в потоковом режиме.
+    :type streaming: bool
+    :param skins: Скины первого и второго игрока (по умолчанию выбранные сейчас). От скина
+        зависят хитбокс и маски игрока, поэтому запись воспроизводится с теми же скинами.
+    :type skins: tuple of str or None
+    """
+    MAGIC = b"INPT"
+    VERSION = 2
+    _HEADER = struct.Struct("<4sHH?I32s32s")
+    _TICK = struct.Struct("<BB?I")
+
+    def __init__(self, level, streaming=False, skins=None):
+        self.level = level
+        self.streaming = streaming
+        self.skins = skins if skins is not None else (skin, skin_2)
+        self.inputs = []
+        self.hashes = []
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def record(self, level, controls):
+        self.inputs.append(TickInput(tuple(key for key in controls.pressed if key in CONTROL_KEYS),
+                                     KeyState(key for key in controls.held if key in CONTROL_KEYS),
+                                     controls.quit))
+        self.hashes.append(state_hash(level))
+
+    def verify(self, level, controls):
+        """
+        Сверяет состояние уровня после такта с записанным.
+
+        :raises ReplayDivergence: Если контрольные суммы не совпадают.
+        """
+        tick = level.tick - 1
+        if tick >= len(self.hashes):
+            return
+        actual = state_hash(level)
+        if self.hashes[tick] != actual:
+            raise ReplayDivergence(tick, self.hashes[tick], actual)
+
+    def save(self, path):
+        parts = [self._HEADER.pack(self.MAGIC, self.VERSION, self.level, self.streaming, len(self),
+                                   *(name.encode() for name in self.skins))]
+        for controls, digest in zip(self.inputs, self.hashes):
+            held = sum(1 << i for i, key in enumerate(CONTROL_KEYS) if key in controls.held)
+            parts.append(self._TICK.pack(held, len(controls.pressed), controls.quit, digest))
+            parts.append(bytes(CONTROL_KEYS.index(key) for key in controls.pressed))
+        with open(path, "wb") as file:
+            file.write(b"".join(parts))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Загружает запись, сохранённую методом `save`.
+
+        :rtype: InputLog
+        :raises ValueError: Если файл повреждён или записан другой версией.
+        """
+        with open(path, "rb") as file:
+            blob = file.read()
+        try:
+            magic, version, level, streaming, count, name, name_2 = cls._HEADER.unpack_from(blob)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError("incompatible input log")
+            log = cls(level, streaming, (name.rstrip(b"\0").decode(), name_2.rstrip(b"\0").decode()))
+            offset = cls._HEADER.size
+            for _ in range(count):
+                held, n_pressed, quit_requested, digest = cls._TICK.unpack_from(blob, offset)
+                offset += cls._TICK.size
+                pressed = tuple(CONTROL_KEYS[i] for i in blob[offset:offset + n_pressed])
+                offset += n_pressed
+                log.inputs.append(TickInput(pressed, KeyState(key for i, key in enumerate(CONTROL_KEYS)
+                                                              if held & (1 << i)), quit_requested))
+                log.hashes.append(digest)
+        except (struct.error, IndexError) as error:
+            raise ValueError("truncated input log") from error
+        return log
+
+
+REWIND_SECONDS = 10
+REWIND_STEP = 3
+REWIND_KEYFRAME = FPS
+REWIND_KEY = pygame.K_BACKSPACE
+QUICKSAVE_KEY = pygame.K_F5
+QUICKLOAD_KEY = pygame.K_F9
+
+SaveState = namedtuple("SaveState", ["state", "consumed"])
+
+
+class RewindBuffer:
+    """
+    Кольцевой буфер состояний уровня за последние `seconds` секунд для перемотки назад.
+
+    После каждого такта в буфер записываются камера, счётчики уровня, положение,
+    скорости и счётчики обоих игроков и номера подобранных объектов. Раз в `keyframe`
+    тактов состояние хранится целиком (ключевой кадр, около 170 байт), а в остальных
+    тактах — только отличающиеся от ключевого кадра 32-битные слова и объекты,
+    подобранные после него. Поэтому любой такт восстанавливается за одно наложение
+    разницы, а память буфера ограничена.
+
+    Буфер передаётся в `run_level` как `rewind`; тот же буфер сохраняет и загружает
+    состояние целиком (`save_state` и `load_state`) для быстрых сохранений при тестировании.
+
+    :param seconds: Сколько секунд игры хранить.
+    :type seconds: float
+    :param keyframe: Через сколько тактов записывать ключевой кадр.
+    :type keyframe: int
+    """
+    _PLAYER = "4iid9i"
+    _FRAME = struct.Struct("<7idi" + _PLAYER * 2)
+    _LEVEL_FIELDS = ("offset_x", "prev_offset_x", "fruits_collected", "coll_mobs", "dead_mobs", "eat_buff", "tick",
+                     "time")
+    _PLAYER_FIELDS = ("x_vel", "y_vel", "fall_count", "jump_count", "hit_count", "animation_count")
+    _NO_FRAME = -1
+
+    def __init__(self, seconds=REWIND_SECONDS, keyframe=REWIND_KEYFRAME):
+        self.keyframe = keyframe
+        self._entries = deque(maxlen=max(int(seconds * FPS), 1))
+        self._key = None
+        self._since_key = 0
+        self._tick = None
+        self._frames = []
+        self._frame_ids = {}
+        self.saved = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def seconds(self):
+        return len(self._entries) / FPS
+
+    @property
+    def nbytes(self):
+        """
+        Примерный размер упакованных состояний в байтах (ключевые кадры и разницы).
+        """
+        keys = {id(key): key for key, _, _ in self._entries}
+        return (sum(len(words) * words.itemsize + len(consumed) * 4 for words, consumed in keys.values())
+                + sum(len(delta) + len(added) * 4 for _, delta, added in self._entries))
+
+    def clear(self):
+        self._entries.clear()
+        self._key = None
+
+    def _frame_id(self, player):
+        sprite = getattr(player, "sprite", None)
+        if sprite is None:
+            return self._NO_FRAME
+        frame_id = self._frame_ids.get(sprite)
+        if frame_id is None:
+            frame_id = self._frame_ids[sprite] = len(self._frames)
+            self._frames.append((sprite, player.sprite_mask))
+        return frame_id
+
+    def _pack(self, level):
+        values = [getattr(level, name) for name in self._LEVEL_FIELDS]
+        values.append(OUTCOMES.index(level.outcome))
+        for player in (level.player, level.player_2):
+            values.extend(player.rect)
+            values.extend(getattr(player, name) for name in self._PLAYER_FIELDS)
+            values += [player.hit, player.direction == "right", *player.prev_pos, self._frame_id(player)]
+        return self._FRAME.pack(*values)
+
+    def _apply(self, level, state, consumed):
+        values = self._FRAME.unpack(state)
+        for name, value in zip(self._LEVEL_FIELDS, values):
+            setattr(level, name, value)
+        level.outcome = OUTCOMES[values[8]]
+        fields = len(self._PLAYER_FIELDS)
+        for player, offset in ((level.player, 9), (level.player_2, 24)):
+            player.rect = pygame.Rect(values[offset:offset + 4])
+            for name, value in zip(self._PLAYER_FIELDS, values[offset + 4:offset + 4 + fields]):
+                setattr(player, name, value)
+            hit, right, x, y, frame_id = values[offset + 4 + fields:offset + 15]
+            player.hit = bool(hit)
+            player.direction = "right" if right else "left"
+            player.prev_pos = (x, y)
+            if frame_id != self._NO_FRAME:
+                player.sprite, player.sprite_mask = self._frames[frame_id]
+                player.mask = player.sprite_mask
+        level.restore_consumed(consumed)
+
+    def record(self, level, controls=None):
+        """
+        Записывает состояние уровня после такта. Подходит как `on_tick` для `run_level`
+        и `run_headless`. Если уровень начался заново (номер такта не вырос), буфер
+        очищается.
+        """
+        entries = self._entries
+        if entries and level.tick <= self._tick:
+            self.clear()
+        self._tick = level.tick
+        words = array("i", self._pack(level))
+        key = self._key
+        if key is None or self._since_key >= self.keyframe or len(level.consumed) < len(key[1]):
+            self._key = (words, frozenset(level.consumed))
+            self._since_key = 1
+            entries.append((self._key, b"", ()))
+            return
+
+        self._since_key += 1
+        key_words, key_consumed = key
+        changed = [index for index, (word, key_word) in enumerate(zip(words, key_words)) if word != key_word]
+        delta = bytes(changed) + array("i", [words[index] for index in changed]).tobytes()
+        added = tuple(level.consumed - key_consumed) if len(level.consumed) != len(key_consumed) else ()
+        entries.append((key, delta, added))
+
+    def _decode(self, entry):
+        (key_words, key_consumed), delta, added = entry
+        words = array("i", key_words)
+        count = len(delta) // 5
+        values = array("i")
+        values.frombytes(delta[count:])
+        for index, value in zip(delta[:count], values):
+            words[index] = value
+        return words.tobytes(), key_consumed.union(added)
+
+    def rewind(self, level, ticks):
+        """
+        Возвращает уровень на `ticks` тактов назад (но не дальше самого старого записанного
+        такта). Более поздние записи отбрасываются, и игра продолжается с этого места.
+
+        :returns: Номер такта, к которому вернулся уровень, или None, если буфер пуст.
+        :rtype: int or None
+        """
+        entries = self._entries
+        if not entries:
+            return None
+        for _ in range(min(ticks, len(entries) - 1)):
+            entries.pop()
+        self._apply(level, *self._decode(entries[-1]))
+        self._tick = level.tick
+        self._key = None
+        return level.tick
+
+    def save_state(self, level):
+        """
+        Сохраняет состояние уровня целиком.
+
+        :rtype: SaveState
+        """
+        return SaveState(self._pack(level), frozenset(level.consumed))
+
+    def load_state(self, level, state):
+        """
+        Возвращает уровень в состояние, сохранённое `save_state` этим же буфером, и
+        очищает историю перемотки.
+
+        :type state: SaveState
+        """
+        self._apply(level, *state)
+        self.clear()
+
+    def control(self, level, controls):
+        """
+        Обрабатывает клавиши перемотки и быстрых сохранений: `REWIND_KEY` возвращает игру
+        на `REWIND_STEP` секунд назад, `QUICKSAVE_KEY` сохраняет состояние, а
+        `QUICKLOAD_KEY` загружает последнее сохранённое.
+
+        :param controls: Ввод игроков на этом такте.
+        :type controls: TickInput
+        :returns: Заменено ли состояние уровня (тогда такт не выполняется).
+        :rtype: bool
+        """
+        replaced = False
+        for key in controls.pressed:
+            if key == REWIND_KEY:
+                replaced |= self.rewind(level, REWIND_STEP * FPS) is not None
+            elif key == QUICKSAVE_KEY:
+                self.saved = self.save_state(level)
+            elif key == QUICKLOAD_KEY and self.saved is not None:
+                self.load_state(level, self.saved)
+                replaced = True
+        return replaced
+
+
+def record_level(window, number, path, streaming=False, profiler=None, level=None, measure_all=True):
+    """
+    Играет уровень с клавиатуры и сохраняет запись ввода в файл `path`.
+
+    :param level: Уровень `number` в исходном состоянии (по умолчанию строится заново).
+    :type level: Level or None
+    :rtype: str
+    """
+    owned = level is None
+    if owned:
+        level = build_level(number, streaming)
+    log = InputLog(number, streaming)
+    try:
+        return run_level(window, level, on_tick=log.record, profiler=profiler, measure_all=measure_all)
+    finally:
+        log.save(path)
+        if owned and isinstance(level, StreamingLevel):
+            level.close()
+
+
+def replay(log, window=None, speed=1):
+    """
+    Воспроизводит запись ввода и проверяет совпадение состояния на каждом такте.
+
+    Без окна запись прогоняется без отрисовки с максимальной скоростью, а с окном —
+    в `speed` раз быстрее реального времени. Если запись оборвалась раньше, чем уровень
+    закончился, воспроизведение в окне завершается итогом "quit". Игроки строятся со скинами
+    из записи, а выбранные скины после этого не меняются.
+
+    :param log: Запись ввода.
+    :type log: InputLog
+    :param window: Окно для отрисовки или None для прогона без окна.
+    :type window: pygame.Surface or None
+    :param speed: Скорость воспроизведения в окне.
+    :type speed: float
+    :returns: Результат прогона без окна или итог уровня при игре в окне.
+    :rtype: HeadlessResult or str
+    :raises ReplayDivergence: Если состояние разошлось с записанным.
+    """
+    global skin, skin_2
+    selected = skin, skin_2
+    skin, skin_2 = log.skins
+    try:
+        level = build_level(log.level, log.streaming)
+    finally:
+        skin, skin_2 = selected
+    try:
+        if window is None:
+            return run_headless(level, ScriptedInput(log.inputs), max_ticks=len(log), on_tick=log.verify)
+        controls = ScriptedInput(log.inputs + [TickInput((), KeyState(), True)])
+        return run_level(window, level, controls, on_tick=log.verify, speed=speed)
+    finally:
+        if isinstance(level, StreamingLevel):
+            level.close()
+
+
+def play_level(window, number):
+    """
+    Играет уровень `number`, а после победы сразу переходит к следующему, пока уровни
+    не закончатся. Уровни берутся из `level_pool`, следующий собирается в фоне, пока
+    идёт текущий.
+
+    :returns: Итог последнего сыгранного уровня.
+    :rtype: str
+    """
+    while True:
+        level = level_pool.get(number, STREAM_LEVELS)
+        level_pool.prebuild(number + 1, STREAM_LEVELS)
+        outcome = _play(window, number, level)
+        if outcome != "win" or number + 1 not in LEVELS:
+            return outcome
+        number += 1
+
+
+def _play(window, number, level):
+    # С --profile замеряется каждый кадр, без него — только кадры с таблицей F3. Если что-то
+    # замерено, после уровня время фаз сохраняется в CSV.
+    name = time.strftime(f"level{number}-%Y%m%d-%H%M%S")
+    profiler = FrameProfiler()
+    measure_all = PROFILE_DIR is not None
+    try:
+        if RECORD_DIR is None:
+            return run_level(window, level, profiler=profiler, rewind=RewindBuffer(), measure_all=measure_all)
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        return record_level(window, number, join(RECORD_DIR, name + ".inpt"), STREAM_LEVELS, profiler, level,
+                            measure_all)
+    finally:
+        if profiler.frames:
+            directory = PROFILE_DIR if PROFILE_DIR is not None else DEFAULT_PROFILE_DIR
+            os.makedirs(directory, exist_ok=True)
+            profiler.export_csv(join(directory, name + ".csv"))
+
+
+def level1(window):
+    return play_level(window, 1)
+
+
+def level2(window):
+    return play_level(window, 2)
 
 
 def level3(window):
-    clock = pygame.time.Clock()
+    return play_level(window, 3)
 
-    background, bg_image = get_background("Gray.png")
-
-    block_size = 96
-
-    player = Player(-920, 500, 50, 50)
-    player_2 = Player_2(-960, 500, 50, 50)
-
-    offset_x = -1500
-    scroll_area_width = 500
-
-    start_time = pygame.time.get_ticks()
-    round_time = 100
-
-    coll_mobs = 0
-    dead_mobs = 0
-    eat_buff = 0
-    fruits_collected = 0
-
-    floor = [
-        Block(
-            i * block_size,
-            HEIGHT - block_size if not (
-                    -9 <= i <= -8 or -6 <= i <= -5 or 0 <= i <= 3 or 12 <= i <= 14 or 16 <= i <= 18 or 27 <= i <= 30 or 32 <= i <= 35) else HEIGHT,
-            block_size
-        )
-        for i in range(-WIDTH // block_size, (WIDTH * 4) // block_size)
-    ]
-
-
-    platform4 = Block(block_size * 23, HEIGHT - block_size * 3, block_size)
-    platform5 = Block(block_size * 21, HEIGHT - block_size * 5, block_size)
-    platform93 = Block(block_size * 9, HEIGHT - block_size * 3, block_size)
-    platformm112 = Block(block_size * -11, HEIGHT - block_size * 2, block_size)
-    platformm113 = Block(block_size * -11, HEIGHT - block_size * 3, block_size)
-    platformm114 = Block(block_size * -11, HEIGHT - block_size * 4, block_size)
-    platformm115 = Block(block_size * -11, HEIGHT - block_size * 5, block_size)
-    platformm116 = Block(block_size * -11, HEIGHT - block_size * 6, block_size)
-    platformm117 = Block(block_size * -11, HEIGHT - block_size * 7, block_size)
-    platformm402 = Block(block_size * 40, HEIGHT - block_size * 2, block_size)
-    platformm403 = Block(block_size * 40, HEIGHT - block_size * 3, block_size)
-    platformm404 = Block(block_size * 40, HEIGHT - block_size * 4, block_size)
-    platformm405 = Block(block_size * 40, HEIGHT - block_size * 5, block_size)
-    platformm406 = Block(block_size * 40, HEIGHT - block_size * 6, block_size)
-    platformm407 = Block(block_size * 40, HEIGHT - block_size * 7, block_size)
-
-    apple1 = Fruit(block_size * 31 + 32, HEIGHT - block_size - 32, 32, 32)
-    apple2 = Fruit(block_size * 9 + 32, HEIGHT - block_size * 3 - 32, 32, 32)
-    apple3 = Fruit(block_size * 23 + 32, HEIGHT - block_size * 3 - 32, 32, 32)
-
-    mob1 = Mob(block_size * 7, HEIGHT - block_size - 64, 64, 64)
-    mob2 = Mob(block_size * 21, HEIGHT - block_size - 64, 64, 64)
-    mob3 = Mob(block_size * 39, HEIGHT - block_size - 64, 64, 64)
-
-    buff1 = Buff(block_size * 21 + 16, HEIGHT - block_size * 6 - 64, 64, 64)
-
-    objects = [*floor, buff1, mob1, mob2, mob3, apple1, apple2, apple3, platformm112, platformm113, platformm114,
-               platformm115, platformm116, platformm117, platform93, platform4, platform5, platformm402, platformm403,
-               platformm404, platformm405, platformm406, platformm407]
-
-    run2 = True
-    while run2:
-        clock.tick(FPS)
-
-        seconds_passed = (pygame.time.get_ticks() - start_time) / 1000
-        remaining_time = round_time - seconds_passed
-        if remaining_time <= 0:
-            show_game_over(window)
-            run2 = False
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run2 = False
+
+MENU_LEVEL_BUTTONS = {1: (150, 280), 2: (250, 280), 3: (350, 280)}
+MENU_SKIN_BUTTONS = {"MaskDude": 550, "NinjaFrog": 650, "PinkMan": 750, "VirtualGuy": 850}
+MENU_IDLE_WAIT = 250
+MENU_LOADING_WAIT = 16
+MENU_HOVER_COLOR = (120, 120, 120)
+MENU_SELECTED_COLOR = (255, 255, 255)
+PRELOAD_WORKERS = 4
+PRELOAD_SLICE = 0.004
+
+
+def _read_level(path):
+    level_data = load_level_data(path)
+    return level_data, pygame.image.load(join("assets", "Background", level_data.background))
+
+
+class AssetPreloader:
+    """
+    Фоновая загрузка ресурсов игры, пока показано меню.
+
+    Листы спрайтов скинов, изображения земли, предметов и фонов, а также данные уровней
+    читаются и декодируются в пуле потоков. `convert_alpha`, нарезка кадров в атлас
+    и масштабирование требуют дисплея, поэтому доделываются в главном потоке: `step`
+    обрабатывает готовые задания по порядку, пока не истечёт бюджет времени кадра.
+    Результаты попадают в `sprite_cache` и `resources`, так что уровень потом строится
+    без обращения к диску.
+
+    Задания скинов ставятся в очередь первыми, чтобы кнопки меню можно было показать,
+    дождавшись только их (`finish(preloader.skin_jobs)`).
+
+    :param levels: Файлы уровней по номерам.
+    :type levels: dict
+    :param skins: Скины персонажей.
+    :type skins: iterable of str
+    :param workers: Число потоков декодирования.
+    :type workers: int
+    """
+    def __init__(self, levels=LEVELS, skins=MENU_SKIN_BUTTONS, workers=PRELOAD_WORKERS):
+        self.levels = levels
+        self.skins = list(skins)
+        self.workers = workers
+        self.done = 0
+        self.total = 0
+        self.skin_jobs = 0
+        self._pending = deque()
+        self._sheets = {}
+        self._executor = None
+
+    def start(self):
+        if self._executor is not None:
+            return
+        init_display()
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="preload")
+        for name in self.skins:
+            if ("MainCharacters", name, 32, 32, True) in sprite_cache:
+                continue
+            files = sprite_sheet_files("MainCharacters", name)
+            self._sheets[name] = {}
+            for path in files:
+                self._submit(self._finish_sheet, pygame.image.load, path, name, len(files))
+        self.skin_jobs = self.total
+        for path in (TERRAIN_IMAGE, FRUIT_IMAGE, MOB_IMAGE, BUFF_IMAGE):
+            self._submit(self._finish_image, pygame.image.load, path)
+        for path in self.levels.values():
+            self._submit(self._finish_level, _read_level, path)
+        if not self._pending:
+            self._executor.shutdown(wait=False)
+
+    def _submit(self, finish, func, path, *args):
+        self._pending.append((self._executor.submit(func, path), finish, (path, *args)))
+        self.total += 1
+
+    def _finish_sheet(self, image, path, name, count):
+        sheets = self._sheets[name]
+        sheets[os.path.basename(path)] = image.convert_alpha()
+        if len(sheets) == count:
+            sprite_cache.put(("MainCharacters", name, 32, 32, True), slice_sprite_sheets(sheets, 32, 32, True))
+            del self._sheets[name]
+
+    def _finish_image(self, image, path):
+        resources.put_image(path, image.convert_alpha())
+
+    def _finish_level(self, result, path):
+        level_data, background = result
+        resources.put_image(join("assets", "Background", level_data.background), background.convert_alpha())
+        resources.background(level_data.background, BACKGROUND_PARALLAX)
+        resources.block(level_data.block_size)
+        for image, rects in ((FRUIT_IMAGE, level_data.fruits), (MOB_IMAGE, level_data.mobs),
+                             (BUFF_IMAGE, level_data.buffs)):
+            for size in {(width, height) for _, _, width, height in rects}:
+                resources.scaled(image, size)
+
+    def _finish_next(self):
+        future, finish, args = self._pending.popleft()
+        finish(future.result(), *args)
+        self.done += 1
+        if not self._pending:
+            self._executor.shutdown(wait=False)
+
+    def step(self, budget=PRELOAD_SLICE):
+        """
+        Доделывает в главном потоке уже декодированные задания, пока не истечёт `budget`
+        секунд. Хотя бы одно готовое задание обрабатывается всегда.
+
+        :returns: Все ли ресурсы загружены.
+        :rtype: bool
+        """
+        deadline = time.perf_counter() + budget
+        while self._pending and self._pending[0][0].done():
+            self._finish_next()
+            if time.perf_counter() >= deadline:
                 break
+        return self.finished
+
+    def finish(self, count=None):
+        """
+        Дожидается декодирования и доделывает первые `count` заданий из всех поставленных
+        (по умолчанию все).
+        """
+        count = self.total if count is None else count
+        while self._pending and self.done < count:
+            self._finish_next()
 
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_w and player.jump_count < 2:
-                    player.jump()
-                if event.key == pygame.K_SPACE and player_2.jump_count < 2:
-                    player_2.jump()
-                if event.key == pygame.K_ESCAPE:
-                    run2 = False
-            if fruits_collected == 3 and dead_mobs == 3:
-                show_you_win(window)
-                run2 = False
-            if coll_mobs >= 1:
-                show_game_over(window)
-                run2 = False
-
-        if (player.rect.bottom > 645) or (player_2.rect.bottom > 645):
-            show_game_over(window)
-            run2 = False
-
-        player.loop(FPS)
-        player_2.loop(FPS)
-
-        for obj in objects[:]:
-            if isinstance(obj, Fruit) and (pygame.sprite.collide_mask(player, obj)):
-                objects.remove(obj)
-                fruits_collected += 1
-        for obj in objects[:]:
-            if isinstance(obj, Mob) and (pygame.sprite.collide_mask(player, obj) or pygame.sprite.collide_mask(player_2, obj)) and buff1 in objects:
-                coll_mobs += 1
-
-        for obj in objects[:]:
-            if isinstance(obj, Mob) and (pygame.sprite.collide_mask(player_2, obj)) and buff1 not in objects:
-                objects.remove(obj)
-                dead_mobs += 1
-
-        for obj in objects[:]:
-            if isinstance(obj, Mob) and (pygame.sprite.collide_mask(player, obj)) and buff1 not in objects:
-                coll_mobs += 1
-
-        for obj in objects[:]:
-            if isinstance(obj, Buff) and (pygame.sprite.collide_mask(player_2, obj)):
-                objects.remove(obj)
-                eat_buff += 1
-
-        handle_move(player, player_2, objects)
-        handle_vertical_collision(player, objects, player.y_vel)
-        handle_vertical_collision(player_2, objects, player_2.y_vel)
-        draw(window, background, bg_image, player, player_2, objects, offset_x, fruits_collected)
-
-        if ((player.rect.right - offset_x >= WIDTH - scroll_area_width) and player.x_vel > 0) or (
-                (player.rect.left - offset_x <= scroll_area_width) and player.x_vel < 0):
-            offset_x += player.x_vel
-
-
-level1_img = pygame.image.load("assets/Menu/Levels/01.png")
-level1_button = Button(150, 280, level1_img, 4)
-
-level2_img = pygame.image.load("assets/Menu/Levels/02.png")
-level2_button = Button(250, 280, level2_img, 4)
-
-level3_img = pygame.image.load("assets/Menu/Levels/03.png")
-level3_button = Button(350, 280, level3_img, 4)
-
-level41_img = pygame.image.load("assets/MainCharacters/MaskDude/jump.png")
-skin1_button = Button(550, 280, level41_img, 2)
-skin1_button_2 = Button(550, 380, level41_img, 2)
-
-level42_img = pygame.image.load("assets/MainCharacters/NinjaFrog/jump.png")
-skin2_button = Button(650, 280, level42_img, 2)
-skin2_button_2 = Button(650, 380, level42_img, 2)
-
-level43_img = pygame.image.load("assets/MainCharacters/PinkMan/jump.png")
-skin3_button = Button(750, 280, level43_img, 2)
-skin3_button_2 = Button(750, 380, level43_img, 2)
-
-level44_img = pygame.image.load("assets/MainCharacters/VirtualGuy/jump.png")
-skin4_button = Button(850, 280, level44_img, 2)
-skin4_button_2 = Button(850, 380, level44_img, 2)
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
 
-run_52 = True
+    @property
+    def progress(self):
+        return self.done / self.total if self.total else 1.0
 
-if __name__ == "__main__":
-    while run_52:
+    @property
+    def finished(self):
+        return self._executor is not None and not self._pending
+
+
+class App:
+    """
+    Приложение: окно игры и кнопки меню.
+
+    Импорт модуля не инициализирует pygame и не открывает окно. Окно создаётся при первом
+    обращении к `window`, а изображения кнопок загружаются при первом обращении к кнопкам
+    меню, поэтому тесты, инструменты и прогоны без окна, которые только импортируют
+    модуль, за это не платят.
+
+    :param size: Размер окна.
+    :type size: tuple
+    :param caption: Заголовок окна.
+    :type caption: str
+    """
+    def __init__(self, size=(WIDTH, HEIGHT), caption="Platformer"):
+        self.size = size
+        self.caption = caption
+        self._window = None
+        self._level_buttons = None
+        self._skin_buttons = None
+
+    @property
+    def window(self):
+        if self._window is None:
+            pygame.init()
+            pygame.display.set_caption(self.caption)
+            self._window = pygame.display.set_mode(self.size)
+        return self._window
+
+    @property
+    def level_buttons(self):
+        if self._level_buttons is None:
+            self._level_buttons = {
+                number: Button(x, y, pygame.image.load(join("assets", "Menu", "Levels", f"{number:02}.png")), 4)
+                for number, (x, y) in MENU_LEVEL_BUTTONS.items()}
+        return self._level_buttons
+
+    @property
+    def skin_buttons(self):
+        if self._skin_buttons is None:
+            buttons = {}
+            for name, x in MENU_SKIN_BUTTONS.items():
+                image = get_character_sprites(name)["jump_right"][0]
+                buttons[(1, name)] = Button(x, 280, image, 1)
+                buttons[(2, name)] = Button(x, 380, image, 1)
+            self._skin_buttons = buttons
+        return self._skin_buttons
+
+    def buttons(self):
+        return list(self.level_buttons.values()) + list(self.skin_buttons.values())
+
+
+app = App()
+
+
+class Menu:
+    """
+    Главное меню, управляемое событиями.
+
+    Цикл меню спит в `pygame.event.wait` до прихода события (или до истечения
+    `MENU_IDLE_WAIT` мс), проверяет попадание в кнопки один раз на событие мыши
+    и перерисовывает экран, только когда меняется кнопка под курсором, выбранный скин
+    или процент фоновой загрузки. Пока `preloader` не закончил работу, меню просыпается
+    каждый кадр и доделывает очередную порцию ресурсов.
+
+    :param app: Приложение с окном и кнопками меню.
+    :type app: App
+    :param preloader: Фоновый загрузчик ресурсов (по умолчанию None).
+    :type preloader: AssetPreloader or None
+    """
+    def __init__(self, app, preloader=None):
+        self.app = app
+        self.preloader = preloader
+        self.items = [(("skin", player, name), button) for (player, name), button in app.skin_buttons.items()]
+        self.items += [(("level", number), button) for number, button in app.level_buttons.items()]
+        self.hovered = None
+        self.running = True
+        self.dirty = DirtyRects(DIRTY_RECTS)
+        self.changed = True
+        self._progress = None
+
+    def item_at(self, pos):
+        for action, button in self.items:
+            if button.rect.collidepoint(pos):
+                return action
+        return None
+
+    def selected(self, action):
+        return action[0] == "skin" and (skin, skin_2)[action[1] - 1] == action[2]
+
+    def select_skin(self, player, name):
+        global skin, skin_2
+        if player == 1:
+            skin = name
+        else:
+            skin_2 = name
+        print(name)
+
+    def handle(self, event):
+        """
+        Обрабатывает одно событие.
+
+        :returns: Номер уровня, если нажата кнопка уровня, иначе None.
+        :rtype: int or None
+        """
+        if event.type == pygame.QUIT:
+            self.running = False
+        elif event.type == pygame.MOUSEMOTION:
+            hovered = self.item_at(event.pos)
+            if hovered != self.hovered:
+                self.hovered = hovered
+                self.changed = True
+        elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            action = self.item_at(event.pos)
+            if action is None:
+                return None
+            if action[0] == "level":
+                return action[1]
+            if not self.selected(action):
+                self.select_skin(*action[1:])
+                self.changed = True
+        return None
+
+    def draw(self, window):
         window.fill("Black")
+        self.dirty.begin(0)
+        for action, button in self.items:
+            window.blit(button.image, button.rect)
+            hovered, selected = action == self.hovered, self.selected(action)
+            frame = button.rect.inflate(8, 8)
+            if selected:
+                pygame.draw.rect(window, MENU_SELECTED_COLOR, frame, 3)
+            elif hovered:
+                pygame.draw.rect(window, MENU_HOVER_COLOR, frame, 2)
+            self.dirty.add((button, hovered, selected), frame)
+        if self._progress is not None:
+            text = text_cache.render(f"Loading {self._progress}%", *HUD_FONT, HUD_COLOR)
+            self.dirty.add(("preload", text), window.blit(text, (20, HEIGHT - 60)))
+
+        regions = self.dirty.regions(window.get_rect())
+        if regions is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(regions)
+        self.changed = False
+
+    def _step_preloader(self):
+        if self.preloader is None:
+            return False
+        loading = not self.preloader.step()
+        progress = int(self.preloader.progress * 100) if loading else None
+        if progress != self._progress:
+            self._progress = progress
+            self.changed = True
+        return loading
+
+    def run(self):
+        window = self.app.window
+        loading = self._step_preloader()
+        while self.running:
+            if self.changed:
+                self.draw(window)
+            if not loading:
+                timeout = MENU_IDLE_WAIT
+            elif RENDER_FPS:
+                timeout = max(1, 1000 // RENDER_FPS)
+            else:
+                timeout = MENU_LOADING_WAIT
+            event = pygame.event.wait(timeout)
+            for event in [event, *pygame.event.get()]:
+                number = self.handle(event)
+                if number is not None:
+                    if self.preloader is not None:
+                        self.preloader.finish()
+                    play_level(window, number)
+                    pygame.event.clear()
+                    self.dirty.invalidate()
+                    self.changed = True
+                    break
+            loading = self._step_preloader()
 
-        if skin4_button.draw(window):
-            skin = "VirtualGuy"
-            print(skin)
-        if skin4_button_2.draw(window):
-            skin_2 = "VirtualGuy"
-            print(skin_2)
-        
-
-        if skin3_button.draw(window):
-            skin = "PinkMan"
-            print(skin)
-        if skin3_button_2.draw(window):
-            skin_2 = "PinkMan"
-            print(skin_2)
-
-        if skin1_button.draw(window):
-            skin = "MaskDude"
-            print(skin)
-        if skin1_button_2.draw(window):
-            skin_2 = "MaskDude"
-            print(skin_2)
-        if skin2_button.draw(window):
-            skin = "NinjaFrog"
-            print(skin)
-        if skin2_button_2.draw(window):
-            skin_2 = "NinjaFrog"
-            print(skin_2)
-
-        if level1_button.draw(window):
-            run_game = True
-            while run_game:
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        run_game = False
-                        run = False
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_ESCAPE:
-                            run_game = False
-                pygame.display.update()
-
-                level1(window)
-                run_game = False
-
-        if level2_button.draw(window):
-            run_game2 = True
-            while run_game2:
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        run_game = False
-                        run = False
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_ESCAPE:
-                            run_game2 = False
-                pygame.display.update()
-
-                level2(window)
-                run_game2 = False
-
-        if level3_button.draw(window):
-            run_game3 = True
-            while run_game3:
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        run_game = False
-                        run = False
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_ESCAPE:
-                            run_game3 = False
-                pygame.display.update()
-
-                level3(window)
-                run_game3 = False
+run_52 = True
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run_52 = False
-        pygame.display.update()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Platformer")
+    parser.add_argument("--headless", type=int, choices=sorted(LEVELS), metavar="LEVEL",
+                        help="прогнать уровень без окна и ограничения FPS и вывести число тактов в секунду")
+    parser.add_argument("--ticks", type=int, default=None,
+                        help="максимальное число тактов в режиме --headless")
+    parser.add_argument("--stream", action="store_true",
+                        help="подгружать участки уровня из файла по мере движения камеры")
+    parser.add_argument("--record", metavar="DIR", default=None,
+                        help="сохранять запись ввода каждого сыгранного уровня в каталог DIR")
+    parser.add_argument("--profile", metavar="DIR", default=None,
+                        help="замерять время фаз каждого кадра и сохранять его в CSV в каталог DIR; без флага "
+                             f"в CSV в каталог {DEFAULT_PROFILE_DIR} попадают кадры, замеренные с таблицей F3")
+    parser.add_argument("--replay", metavar="PATH", default=None,
+                        help="воспроизвести запись ввода и проверить совпадение состояния")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="показать воспроизведение в окне с этой скоростью (без неё — без окна)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.headless is not None:
+        level = build_level(args.headless, args.stream)
+        try:
+            result = run_headless(level, max_ticks=args.ticks)
+        finally:
+            if isinstance(level, StreamingLevel):
+                level.close()
+        print(f"level {args.headless}: {result.outcome or 'running'} after {result.ticks} ticks, "
+              f"{result.seconds:.3f} s, {result.ticks_per_second:.0f} ticks/s")
+        run_52 = False
+    if args.replay is not None:
+        log = InputLog.load(args.replay)
+        if args.speed is None:
+            result = replay(log)
+            print(f"{args.replay}: level {log.level}, {result.ticks} ticks verified, "
+                  f"{result.ticks_per_second:.0f} ticks/s")
+        else:
+            print(f"{args.replay}: level {log.level}, {replay(log, app.window, args.speed)}")
+        run_52 = False
+    STREAM_LEVELS = args.stream
+    RECORD_DIR = args.record
+    PROFILE_DIR = args.profile
+
+    if run_52:
+        preloader = AssetPreloader()
+        preloader.start()
+        preloader.finish(preloader.skin_jobs)
+        try:
+            Menu(app, preloader).run()
+        finally:
+            preloader.close()
+            level_pool.close()
     pygame.quit()
     quit()
     main()
\ No newline at end of file
@@ -0,0 +1,206 @@
+"""
+Бенчмарки горячих путей игры: столкновения, движение, отрисовка, загрузка спрайтов
+построение и сброс уровня на синтетических уровнях из 1 000, 10 000 и 100 000 объектов.
+
+Результаты записываются в JSON и сравниваются с порогами из `bench_thresholds.json`;
+если медиана какого-нибудь замера превысила порог, скрипт завершается с кодом 1.
+
+    python tutorial_bench.py
+    python tutorial_bench.py --sizes 1000 10000 --out bench_results.json
+    python tutorial_bench.py --save-thresholds
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+from tutorial import HEIGHT, LevelData, PLAYER_VEL, WIDTH, Background, Hud, KeyState, NO_INPUT, \
+    TextureAtlas, app, build_level_from_data, draw, handle_move, load_sprite_sheets, sweep
+
+SIZES = (1000, 10000, 100000)
+MOBS = 300
+THRESHOLDS_FILE = "bench_thresholds.json"
+RESULTS_FILE = "bench_results.json"
+THRESHOLD_HEADROOM = 3
+THRESHOLD_FLOOR_MS = 0.1
+
+
+def synthetic_level(objects, mobs=MOBS, block_size=96):
+    """
+    Строит данные уровня примерно из `objects` объектов: пол и платформы из блоков,
+    фрукты (десятая часть объектов), `mobs` мобов и один бафф. Игроки появляются на полу
+    у левого края, мобы и фрукты начинаются за первым экраном.
+
+    :param objects: Общее число объектов уровня.
+    :type objects: int
+    :param mobs: Число мобов.
+    :type mobs: int
+    :param block_size: Размер блока.
+    :type block_size: int
+    :rtype: LevelData
+    """
+    fruits = objects // 10
+    blocks = objects - fruits - mobs - 1
+    floor = (blocks + 1) // 2
+    floor_y = HEIGHT - block_size
+    tiles = [(i * block_size, floor_y) for i in range(floor)]
+    tiles += [(i * block_size, floor_y - block_size * 3) for i in range(blocks - floor)]
+
+    length = floor * block_size - WIDTH
+    fruit_rects = [(WIDTH + i * length // max(fruits, 1), floor_y - block_size * 2, 32, 32) for i in range(fruits)]
+    mob_rects = [(WIDTH + i * length // max(mobs, 1), floor_y - 64, 64, 64) for i in range(mobs)]
+    buff_rects = [(floor * block_size - block_size, floor_y - 64, 64, 64)]
+
+    return LevelData("Pink.png", block_size, 100, HEIGHT + 500, fruits, mobs, (100, floor_y - 50),
+                     (200, floor_y - 50), tiles, fruit_rects, mob_rects, buff_rects)
+
+
+def measure(func, repeat=7, number=1):
+    """
+    Замеряет время вызова `func`, как это делает `timeit`: после разогревочного вызова
+    выполняет `repeat` серий по `number` вызовов с отключённым сборщиком мусора.
+
+    :returns: Минимальное и медианное время одного вызова в миллисекундах.
+    :rtype: dict
+    """
+    func()
+    timings = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            timings.append((time.perf_counter() - start) / number * 1000)
+    finally:
+        if enabled:
+            gc.enable()
+    return {"min_ms": min(timings), "median_ms": statistics.median(timings), "repeat": repeat, "number": number}
+
+
+def bench_level(objects, repeat=7):
+    """
+    Замеряет построение уровня из `objects` объектов и горячие пути одного кадра на нём.
+
+    :rtype: dict
+    """
+    data = synthetic_level(objects)
+    results = {"build_level": measure(lambda: build_level_from_data(data), max(repeat // 2, 1))}
+
+    level = build_level_from_data(data)
+    results["level_reset"] = measure(level.reset, repeat, 10)
+    level.offset_x = 0
+    level.step(NO_INPUT)
+    player, player_2, terrain = level.player, level.player_2, level.terrain
+    held = KeyState({pygame.K_d, pygame.K_RIGHT})
+    window = app.window
+    background = Background(data.background)
+    hud = Hud()
+
+    # Падение с разбега на пол: проход по X ни во что не упирается, проход по Y — в блоки пола.
+    # Для списка перебираются все блоки уровня.
+    box = player.collision_rect().move(0, -200)
+    blocks = list(terrain)
+    results["sweep"] = measure(lambda: sweep(box, PLAYER_VEL * 2, 300, terrain), repeat, 100)
+    results["sweep_list"] = measure(lambda: sweep(box, PLAYER_VEL * 2, 300, blocks), repeat)
+    results["handle_move"] = measure(lambda: handle_move(player, player_2, terrain, held), repeat, 100)
+    results["level_step"] = measure(lambda: level.step(NO_INPUT), repeat, 10)
+    results["draw"] = measure(lambda: draw(window, background, None, player, player_2, level.objects, 0, 0, terrain,
+                                           hud=hud), repeat, 10)
+    return results
+
+
+def run(sizes=SIZES, repeat=7):
+    """
+    Выполняет все бенчмарки.
+
+    :returns: Результаты в виде {"имя/размер": замер} и сведения об окружении.
+    :rtype: dict
+    """
+    # Каждый замер загружает листы в новый атлас, как при первом запуске. Во втором
+    # замере дополнительно строятся все отражённые кадры.
+    def load_mirrored():
+        sheets = load_sprite_sheets("MainCharacters", "MaskDude", 32, 32, True, TextureAtlas())
+        return [sheets[name] for name in sheets]
+
+    benchmarks = {
+        "load_sprite_sheets": measure(
+            lambda: load_sprite_sheets("MainCharacters", "MaskDude", 32, 32, True, TextureAtlas()), repeat),
+        "load_sprite_sheets_mirrored": measure(load_mirrored, repeat),
+    }
+    for objects in sizes:
+        for name, result in bench_level(objects, repeat).items():
+            benchmarks[f"{name}/{objects}"] = result
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "machine": platform.machine(),
+        "benchmarks": benchmarks,
+    }
+
+
+def check_thresholds(results, thresholds):
+    """
+    Сравнивает медианы замеров с порогами.
+
+    :param results: Результаты `run`.
+    :type results: dict
+    :param thresholds: Пороги в миллисекундах: {"имя/размер": мс}.
+    :type thresholds: dict
+    :returns: Превышения в виде (имя, медиана, порог).
+    :rtype: list
+    """
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        limit = thresholds.get(name)
+        if limit is not None and result["median_ms"] > limit:
+            regressions.append((name, result["median_ms"], limit))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки платформера")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES),
+                        help="размеры синтетических уровней (число объектов)")
+    parser.add_argument("--repeat", type=int, default=7, help="число серий в каждом замере")
+    parser.add_argument("--out", default=RESULTS_FILE, help="файл для результатов в формате JSON")
+    parser.add_argument("--thresholds", default=THRESHOLDS_FILE, help="файл с порогами в миллисекундах")
+    parser.add_argument("--save-thresholds", action="store_true",
+                        help=f"записать новые пороги: медиана, умноженная на {THRESHOLD_HEADROOM}, "
+                             f"но не меньше {THRESHOLD_FLOOR_MS} мс")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run(args.sizes, args.repeat)
+    with open(args.out, "w") as file:
+        json.dump(results, file, indent=2)
+
+    for name, result in results["benchmarks"].items():
+        print(f"{name:36} {result['median_ms']:10.3f} ms  (min {result['min_ms']:.3f})")
+
+    if args.save_thresholds:
+        thresholds = {name: round(max(result["median_ms"] * THRESHOLD_HEADROOM, THRESHOLD_FLOOR_MS), 3)
+                      for name, result in results["benchmarks"].items()}
+        with open(args.thresholds, "w") as file:
+            json.dump(thresholds, file, indent=2, sort_keys=True)
+        sys.exit(0)
+
+    if os.path.exists(args.thresholds):
+        with open(args.thresholds) as file:
+            regressions = check_thresholds(results, json.load(file))
+        for name, median, limit in regressions:
+            print(f"REGRESSION {name}: {median:.3f} ms > {limit:.3f} ms")
+        sys.exit(1 if regressions else 0)
@@ -1,45 +1,59 @@
 import pygame
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, call
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 from os.path import join
-from tutorial import flip, get_block, get_background, handle_vertical_collision, WIDTH, HEIGHT, Button
+from tutorial_bench import synthetic_level, check_thresholds
+import tutorial
+from tutorial import flip, get_block, get_background, sweep, WIDTH, HEIGHT, Button, SpriteCache, \
+    ResourceManager, Block, Fruit, SpatialHash, DirtyRects, Player, Player_2, draw, render_scene, \
+    TextCache, Hud, text_cache, Background, EntityStore, np, build_level, run_headless, ScriptedInput, \
+    TickInput, KeyState, NO_INPUT, run_level, FPS, parse_level, compile_level, read_compiled_level, \
+    load_level_data, build_level_from_data, Mob, Buff, write_chunk_file, ChunkFile, StreamingLevel, \
+    load_streaming_level, InputLog, ReplayDivergence, replay, FrameProfiler, \
+    ObjectRegistry, handle_move, TileMap, TextureAtlas, load_sprite_sheets, App, \
+    AssetPreloader, LEVELS, Menu, LevelPool, state_hash, play_level, RewindBuffer, REWIND_KEY, QUICKSAVE_KEY, \
+    QUICKLOAD_KEY
 
 
 class TestFunctions(unittest.TestCase):
 
-    @patch("pygame.sprite.collide_mask")
-    def test_handle_vertical_collision_positive(self, mock_collide_mask):
-        self.player = MagicMock()
-        self.player.rect = pygame.Rect(0, 0, 50, 50)
-        self.obj = MagicMock()
-        self.obj.rect = pygame.Rect(0, 50, 50, 50)
-        mock_collide_mask.return_value = True
+    def test_sweep_stops_at_wall(self):
+        wall = MagicMock()
+        wall.rect = pygame.Rect(100, 0, 50, 50)
 
-        dy = 10
-        result = handle_vertical_collision(self.player, [self.obj], dy)
+        rect, hit_x, hit_y = sweep(pygame.Rect(0, 0, 50, 50), 80, 0, [wall])
 
-        self.assertEqual(result, [self.obj])
+        self.assertEqual(rect.right, wall.rect.left)
+        self.assertIs(hit_x, wall)
+        self.assertIsNone(hit_y)
 
-        self.assertEqual(self.player.rect.bottom, self.obj.rect.top)
-        self.player.landed.assert_called_once()
-        self.player.hit_head.assert_not_called()
+    def test_sweep_does_not_tunnel_through_thin_block(self):
+        floor = MagicMock()
+        floor.rect = pygame.Rect(0, 100, 50, 10)
+        below = MagicMock()
+        below.rect = pygame.Rect(0, 300, 50, 50)
 
-    @patch("pygame.sprite.collide_mask")
-    def test_handle_vertical_collision_negative(self, mock_collide_mask):
-        self.player = MagicMock()
-        self.player.rect = pygame.Rect(0, 0, 50, 50)
-        self.obj = MagicMock()
-        self.obj.rect = pygame.Rect(0, 100, 50, 50)
-        mock_collide_mask.return_value = False
+        rect, hit_x, hit_y = sweep(pygame.Rect(0, 0, 50, 50), 0, 400, [below, floor])
 
-        dy = 10
-        result = handle_vertical_collision(self.player, [self.obj], dy)
+        self.assertEqual(rect.bottom, floor.rect.top)
+        self.assertIs(hit_y, floor)
+        self.assertIsNone(hit_x)
 
-        self.assertEqual(result, [])
+    def test_sweep_lifts_rect_out_of_floor_when_falling(self):
+        floor = MagicMock()
+        floor.rect = pygame.Rect(0, 40, 200, 50)
 
-        self.player.landed.assert_not_called()
-        self.player.hit_head.assert_not_called()
+        rect, _, hit_y = sweep(pygame.Rect(0, 0, 50, 50), 5, 1, [floor])
 
+        self.assertEqual(rect.topleft, (5, -10))
+        self.assertIs(hit_y, floor)
 
     @patch("pygame.image.load")
     @patch("pygame.Surface")
@@ -139,6 +153,1254 @@ class TestFunctions(unittest.TestCase):
         self.assertFalse(action)
 
 
+class TestSpriteCache(unittest.TestCase):
+
+    @patch("tutorial.load_sprite_sheets")
+    def test_sprite_cache_shares_frames(self, mock_load):
+        mock_load.return_value = {"idle_right": [pygame.Surface((64, 64))]}
+        cache = SpriteCache(maxsize=2)
+
+        first = cache.get("MainCharacters", "MaskDude", 32, 32, True)
+        second = cache.get("MainCharacters", "MaskDude", 32, 32, True)
+
+        self.assertIs(first, second)
+        self.assertIsInstance(first["idle_right"], tuple)
+        mock_load.assert_called_once_with("MainCharacters", "MaskDude", 32, 32, True)
+        with self.assertRaises(TypeError):
+            first["idle_left"] = ()
+
+    @patch("tutorial.load_sprite_sheets")
+    def test_sprite_cache_builds_mask_per_frame(self, mock_load):
+        frame = pygame.Surface((64, 64), pygame.SRCALPHA)
+        frame.fill((255, 0, 0, 255), pygame.Rect(0, 0, 8, 8))
+        mock_load.return_value = {"idle_right": [frame, pygame.Surface((64, 64), pygame.SRCALPHA)]}
+        cache = SpriteCache()
+
+        masks = cache.masks("MainCharacters", "MaskDude", 32, 32, True)
+
+        self.assertIs(masks, cache.masks("MainCharacters", "MaskDude", 32, 32, True))
+        self.assertEqual(len(masks["idle_right"]), 2)
+        self.assertEqual(masks["idle_right"][0].count(), 64)
+        self.assertEqual(masks["idle_right"][1].count(), 0)
+        mock_load.assert_called_once()
+
+    @patch("tutorial.load_sprite_sheets")
+    def test_sprite_cache_evicts_least_recently_used(self, mock_load):
+        mock_load.return_value = {}
+        cache = SpriteCache(maxsize=2)
+
+        cache.get("MainCharacters", "MaskDude", 32, 32, True)
+        cache.get("MainCharacters", "NinjaFrog", 32, 32, True)
+        cache.get("MainCharacters", "MaskDude", 32, 32, True)
+        cache.get("MainCharacters", "PinkMan", 32, 32, True)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIn(("MainCharacters", "MaskDude", 32, 32, True), cache)
+        self.assertNotIn(("MainCharacters", "NinjaFrog", 32, 32, True), cache)
+
+
+class TestTextureAtlas(unittest.TestCase):
+
+    def test_regions_are_packed_into_pages(self):
+        atlas = TextureAtlas((128, 128))
+
+        regions = [atlas.allocate((64, 64)) for _ in range(5)]
+        large = atlas.allocate((200, 50))
+
+        self.assertEqual(len({id(region.get_parent()) for region in regions[:4]}), 1)
+        self.assertEqual([region.get_offset() for region in regions[:4]], [(0, 0), (64, 0), (0, 64), (64, 64)])
+        self.assertIsNot(regions[4].get_parent(), regions[0].get_parent())
+        self.assertEqual(large.get_size(), (200, 50))
+        self.assertEqual(len(atlas), 3)
+
+    def test_sprite_sheets_are_sliced_into_atlas(self):
+        atlas = TextureAtlas()
+
+        sheets = load_sprite_sheets("MainCharacters", "MaskDude", 32, 32, True, atlas)
+
+        frame = sheets["idle_right"][0]
+        self.assertEqual(frame.get_size(), (64, 64))
+        self.assertIn(frame.get_parent(), atlas.pages)
+
+    def test_left_frames_are_mirrored_on_first_use(self):
+        atlas = TextureAtlas()
+        sheets = load_sprite_sheets("MainCharacters", "MaskDude", 32, 32, True, atlas)
+
+        self.assertIn("run_left", sheets)
+        self.assertFalse(sheets.built("run_left"))
+        left = sheets["run_left"]
+
+        self.assertTrue(sheets.built("run_left"))
+        self.assertIs(sheets["run_left"], left)
+        for frame, right in zip(left, sheets["run_right"]):
+            expected = pygame.transform.flip(right, True, False)
+            self.assertEqual(pygame.image.tobytes(frame, "RGBA"), pygame.image.tobytes(expected, "RGBA"))
+
+
+class TestResourceManager(unittest.TestCase):
+
+    def test_blocks_share_surface_and_mask(self):
+        first = Block(0, 0, 96)
+        second = Block(96, 0, 96)
+
+        self.assertIs(first.image, second.image)
+        self.assertIs(first.mask, second.mask)
+        self.assertEqual(first.image.get_size(), (96, 96))
+
+    @patch("pygame.image.load")
+    def test_scaled_loads_source_once(self, mock_image_load):
+        mock_image_load.return_value = pygame.Surface((32, 32), pygame.SRCALPHA)
+        manager = ResourceManager()
+
+        small = manager.scaled("fruit.png", (32, 32))
+        again = manager.scaled("fruit.png", (32, 32))
+        large = manager.scaled("fruit.png", (64, 64))
+
+        mock_image_load.assert_called_once_with("fruit.png")
+        self.assertIs(small, again)
+        self.assertEqual(large[0].get_size(), (64, 64))
+        self.assertEqual(len(manager), 2)
+
+
+class TestSpatialHash(unittest.TestCase):
+
+    def make_object(self, x, y, size=96):
+        obj = MagicMock()
+        obj.rect = pygame.Rect(x, y, size, size)
+        return obj
+
+    def test_near_returns_only_overlapped_cells(self):
+        close = self.make_object(0, 0)
+        far = self.make_object(96 * 100, 0)
+        grid = SpatialHash([close, far])
+
+        self.assertEqual(grid.near(pygame.Rect(10, 10, 50, 50)), [close])
+        self.assertEqual(grid.near(pygame.Rect(96 * 100, 10, 50, 50)), [far])
+
+    def test_near_keeps_insertion_order_and_removal(self):
+        first = self.make_object(0, 0)
+        second = self.make_object(64, 0)
+        grid = SpatialHash([second, first], cell_size=32)
+
+        self.assertEqual(grid.near(pygame.Rect(0, 0, 200, 100)), [second, first])
+
+        grid.remove(second)
+
+        self.assertNotIn(second, grid)
+        self.assertEqual(grid.near(pygame.Rect(0, 0, 200, 100)), [first])
+        self.assertEqual(len(grid), 1)
+
+    def test_sweep_checks_only_nearby_cells(self):
+        below = self.make_object(0, 50, 50)
+        far = self.make_object(5000, 50, 50)
+        grid = SpatialHash([below, far])
+
+        with patch.object(grid, "near", wraps=grid.near) as mock_near:
+            rect, _, hit_y = sweep(pygame.Rect(0, 0, 50, 50), 0, 10, grid)
+
+        self.assertIs(hit_y, below)
+        self.assertEqual(rect.bottom, 50)
+        mock_near.assert_called_once_with(pygame.Rect(0, 0, 50, 60))
+
+
+class TestSweptCollision(unittest.TestCase):
+
+    def test_fast_fall_lands_on_block(self):
+        block = Block(0, 300, 96)
+        player = Player(0, 0, 50, 50)
+        player.y_vel = 250
+
+        player.loop(FPS, [block])
+
+        self.assertEqual(player.collision_rect().bottom, block.rect.top)
+        self.assertEqual(player.y_vel, 0)
+        self.assertEqual(player.fall_count, 0)
+
+    def test_player_against_wall_does_not_accelerate_into_it(self):
+        player = Player(0, 0, 50, 50)
+        player_2 = Player_2(500, 0, 50, 50)
+        player.loop(FPS)
+        wall = Block(player.collision_rect().right, 0, 96)
+
+        handle_move(player, player_2, [wall], KeyState({pygame.K_d}))
+        self.assertEqual(player.x_vel, 0)
+
+        handle_move(player, player_2, [wall], KeyState({pygame.K_a}))
+        self.assertEqual(player.x_vel, -5)
+
+    def test_players_walk_along_level_floor(self):
+        level = build_level(1)
+        script = [TickInput((), KeyState({pygame.K_d, pygame.K_RIGHT}), False)] * 120
+
+        run_headless(level, ScriptedInput(script), max_ticks=len(script))
+
+        self.assertIsNone(level.outcome)
+        for player in (level.player, level.player_2):
+            self.assertEqual(player.collision_rect().bottom, HEIGHT - 96)
+            self.assertGreater(player.rect.x, player.prev_pos[0] - 1)
+
+
+class TestObjectRegistry(unittest.TestCase):
+
+    def test_objects_are_grouped_by_kind_in_order(self):
+        fruit, mob, buff = Fruit(0, 0, 32, 32), Mob(0, 0, 64, 64), Buff(0, 0, 64, 64)
+
+        registry = ObjectRegistry([mob, buff, fruit])
+
+        self.assertEqual(list(registry), [fruit, mob, buff])
+        self.assertEqual(list(registry.mobs), [mob])
+        registry.remove(mob)
+        registry.remove(mob)
+        self.assertNotIn(mob, registry)
+        self.assertEqual(len(registry), 2)
+
+    def test_visible_returns_objects_in_frame_in_registry_order(self):
+        fruit, mob, far = Fruit(900, 100, 32, 32), Mob(100, 100, 64, 64), Fruit(5000, 100, 32, 32)
+        registry = ObjectRegistry([mob, far, fruit])
+        frame = pygame.Rect(0, 0, WIDTH, HEIGHT)
+
+        self.assertEqual(registry.visible(frame), [fruit, mob])
+        registry.remove(fruit)
+        registry.add(Buff(4900, 100, 64, 64))
+        self.assertEqual(registry.visible(frame), [mob])
+        self.assertEqual(registry.visible(frame.move(4500, 0)), [far, *registry.buffs])
+
+    def test_step_checks_only_objects_under_players(self):
+        level = build_level(1)
+        level.step(NO_INPUT)
+        fruit = next(iter(level.objects.fruits))
+        level.player.rect.center = fruit.rect.center
+        checked = []
+
+        with patch("tutorial.pygame.sprite.collide_mask", side_effect=lambda a, b: checked.append((a, b))):
+            level.step(NO_INPUT)
+
+        self.assertIn((level.player, fruit), checked)
+        for player, obj in checked:
+            self.assertNotIsInstance(obj, Block)
+            self.assertTrue(player.rect.colliderect(obj.rect))
+
+    def test_collected_buff_is_no_longer_alive(self):
+        level = build_level(1)
+
+        self.assertTrue(level.buff_alive())
+        level.remove(level.buff)
+        self.assertFalse(level.buff_alive())
+        self.assertNotIn(level.buff, level.objects)
+
+
+class TestTileMap(unittest.TestCase):
+
+    def setUp(self):
+        self.tiles = [(i * 96, HEIGHT - 96) for i in range(-11, 60)] + [(96 * 5, HEIGHT - 96 * 4)]
+
+    def test_near_returns_only_tiles_under_rect(self):
+        terrain = TileMap.from_tiles(self.tiles, 96)
+
+        tiles = terrain.near(pygame.Rect(96 * 5 + 10, HEIGHT - 96 * 4 + 10, 20, 96 * 3))
+
+        self.assertEqual([tile.rect.topleft for tile in tiles], [(96 * 5, HEIGHT - 96 * 4), (96 * 5, HEIGHT - 96)])
+        self.assertEqual(terrain.near(pygame.Rect(96 * 100, 0, 50, 50)), [])
+        self.assertEqual(len(terrain), len(self.tiles))
+
+    def test_misaligned_tile_is_rejected(self):
+        with self.assertRaises(ValueError):
+            TileMap.from_tiles([(10, HEIGHT - 96)], 96)
+
+    def test_grid_grows_and_shrinks(self):
+        terrain = TileMap(96)
+
+        terrain.add(96 * 3, HEIGHT - 96)
+        terrain.add(-96 * 2, HEIGHT - 96 * 3)
+        terrain.add(96 * 40, HEIGHT)
+        self.assertEqual(len(terrain), 3)
+        self.assertEqual(sorted(tile.rect.topleft for tile in terrain),
+                         [(-96 * 2, HEIGHT - 96 * 3), (96 * 3, HEIGHT - 96), (96 * 40, HEIGHT)])
+
+        terrain.remove(96 * 3, HEIGHT - 96)
+        terrain.remove(96 * 500, HEIGHT - 96)
+        self.assertEqual(len(terrain), 2)
+        self.assertEqual(terrain.near(pygame.Rect(96 * 3, HEIGHT - 96, 96, 96)), [])
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_ids_share_memory_with_grid(self):
+        terrain = TileMap.from_tiles(self.tiles, 96)
+
+        ids = terrain.ids
+        self.assertEqual(ids.dtype, np.uint8)
+        self.assertEqual(ids.shape, (4, 71))
+        ids[0, 0] = TileMap.BLOCK
+        self.assertEqual(terrain.tile_at(-11, -4), TileMap.BLOCK)
+
+    def test_draw_matches_block_rendering(self):
+        terrain = TileMap.from_tiles(self.tiles, 96)
+        expected = pygame.Surface((WIDTH, HEIGHT))
+        drawn = pygame.Surface((WIDTH, HEIGHT))
+        offset_x = 350
+
+        for x, y in self.tiles:
+            Block(x, y, 96).draw(expected, offset_x)
+        terrain.draw(drawn, offset_x)
+
+        self.assertEqual(pygame.image.tobytes(expected, "RGB"), pygame.image.tobytes(drawn, "RGB"))
+
+
+class TestDirtyRects(unittest.TestCase):
+
+    def test_regions_track_changes(self):
+        dirty = DirtyRects()
+
+        dirty.begin(0)
+        dirty.add("player", (10, 10, 20, 20))
+        self.assertIsNone(dirty.regions())
+
+        dirty.begin(0)
+        dirty.add("player", (10, 10, 20, 20))
+        self.assertEqual(dirty.regions(), [])
+
+        dirty.begin(0)
+        dirty.add("player", (15, 10, 20, 20))
+        self.assertEqual(dirty.regions(), [pygame.Rect(10, 10, 25, 20)])
+
+        dirty.begin(5)
+        dirty.add("player", (15, 10, 20, 20))
+        self.assertIsNone(dirty.regions())
+
+    def test_disabled_tracker_always_requests_full_update(self):
+        dirty = DirtyRects(enabled=False)
+        for _ in range(2):
+            dirty.begin(0)
+            self.assertIsNone(dirty.regions())
+
+    def test_partial_draw_matches_full_render(self):
+        background, bg_image = get_background("Pink.png")
+        player = Player(100, 300, 50, 50)
+        player_2 = Player_2(300, 300, 50, 50)
+        fruit = Fruit(500, 400, 32, 32)
+        objects = [Block(i * 96, HEIGHT - 96, 96) for i in range(12)] + [fruit]
+        terrain = TileMap.from_tiles([block.rect.topleft for block in objects[:-1]], 96)
+        player.loop(60)
+        player_2.loop(60)
+        window = pygame.Surface((WIDTH, HEIGHT))
+        dirty = DirtyRects()
+
+        draw(window, background, bg_image, player, player_2, objects, 0, 0, terrain, dirty)
+        player.move(7, 3)
+        player.loop(60)
+        objects.remove(fruit)
+        draw(window, background, bg_image, player, player_2, objects, 0, 1, terrain, dirty)
+
+        expected = pygame.Surface((WIDTH, HEIGHT))
+        hud = [(text_cache.render("Fruits Collected: 1/3", "comicsans", 30, (255, 255, 255)), (10, 10))]
+        render_scene(expected, background, bg_image, player, player_2, objects, 0, hud, terrain)
+        self.assertEqual(pygame.image.tobytes(window, "RGB"), pygame.image.tobytes(expected, "RGB"))
+
+
+class TestTextCache(unittest.TestCase):
+
+    @patch("pygame.font.SysFont")
+    def test_font_loaded_once_and_text_rendered_once(self, mock_sysfont):
+        font = mock_sysfont.return_value
+        font.render.return_value = pygame.Surface((10, 10))
+        cache = TextCache()
+
+        first = cache.render("Fruits Collected: 0/3", "comicsans", 30, (255, 255, 255))
+        second = cache.render("Fruits Collected: 0/3", "comicsans", 30, (255, 255, 255))
+        cache.render("Fruits Collected: 1/3", "comicsans", 30, (255, 255, 255))
+
+        self.assertIs(first, second)
+        mock_sysfont.assert_called_once_with("comicsans", 30)
+        self.assertEqual(font.render.call_count, 2)
+
+    def test_digit_strip_matches_width_of_glyphs(self):
+        strip = text_cache.digits("comicsans", 30, (255, 255, 255))
+        font = text_cache.font("comicsans", 30)
+
+        surface = strip.render(90)
+
+        expected = font.render("9", True, (255, 255, 255)).get_width() + font.render("0", True, (255, 255, 255)).get_width()
+        self.assertEqual(surface.get_width(), expected)
+
+    def test_hud_rebuilds_only_on_change(self):
+        hud = Hud()
+
+        first = hud.update(0, 99.5)
+        second = hud.update(0, 99.1)
+        third = hud.update(1, 98.9)
+
+        self.assertEqual(len(first), 2)
+        self.assertIs(first[0][0], second[0][0])
+        self.assertIs(first[1][0], second[1][0])
+        self.assertIsNot(second[0][0], third[0][0])
+        self.assertIsNot(second[1][0], third[1][0])
+        self.assertEqual(len(hud.update(1)), 1)
+
+
+class TestBackground(unittest.TestCase):
+
+    def test_composed_background_matches_tiles(self):
+        tiles, image = get_background("Pink.png")
+        expected = pygame.Surface((WIDTH, HEIGHT))
+        for tile in tiles:
+            expected.blit(image, tile)
+        composed = pygame.Surface((WIDTH, HEIGHT))
+
+        Background("Pink.png").draw(composed, 1234)
+
+        self.assertEqual(pygame.image.tobytes(expected, "RGB"), pygame.image.tobytes(composed, "RGB"))
+
+    def test_parallax_wraps_by_tile_width(self):
+        background = Background("Pink.png", parallax=0.5)
+        first = pygame.Surface((WIDTH, HEIGHT))
+        second = pygame.Surface((WIDTH, HEIGHT))
+
+        background.draw(first, 10)
+        background.draw(second, 10 + background.tile_width * 2)
+
+        self.assertEqual(background.surface.get_width(), WIDTH + background.tile_width)
+        self.assertEqual(pygame.image.tobytes(first, "RGB"), pygame.image.tobytes(second, "RGB"))
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestEntityStore(unittest.TestCase):
+
+    def test_step_matches_player_loop(self):
+        players = [Player(-1000 + i * 37, 300 - i * 11, 50, 50) for i in range(5)]
+        players[1].move_right(5)
+        players[2].move_left(5)
+        players[3].make_hit()
+        players[4].jump()
+        store = EntityStore(capacity=2)
+        for player in players:
+            store.add_actor(player)
+
+        for tick in range(200):
+            if tick == 50:
+                players[0].jump()
+                store.jump([0])
+            if tick == 90:
+                players[2].landed()
+                store.landed([2])
+            for player in players:
+                player.loop(60)
+            store.step(60)
+
+        self.assertEqual(len(store), 5)
+        for index, player in enumerate(players):
+            self.assertEqual((store.x[index], store.y[index]), (player.rect.x, player.rect.y))
+            self.assertAlmostEqual(store.y_vel[index], player.y_vel)
+            self.assertEqual(store.fall_count[index], player.fall_count)
+            self.assertEqual(store.jump_count[index], player.jump_count)
+            self.assertEqual((bool(store.hit[index]), store.hit_count[index]), (player.hit, player.hit_count))
+
+    def test_step_matches_player_loop_on_open_ground(self):
+        players = [Player(-1000 + i * 137, -3000 - i * 11, 50, 50) for i in range(3)]
+        players[1].move_right(5)
+        players[2].move_left(5)
+        players[2].make_hit()
+        terrain = TileMap.from_tiles([(0, HEIGHT - 96)], 96)
+        store = EntityStore()
+        for player in players:
+            store.add_actor(player)
+
+        for tick in range(60):
+            if tick == 20:
+                players[0].jump()
+                store.jump([0])
+            for player in players:
+                player.loop(60, terrain)
+            store.step(60)
+
+        for index, player in enumerate(players):
+            self.assertLess(player.rect.bottom, HEIGHT - 96)
+            self.assertEqual((store.x[index], store.y[index]), (player.rect.x, player.rect.y))
+            self.assertAlmostEqual(store.y_vel[index], player.y_vel)
+            self.assertEqual((store.fall_count[index], store.jump_count[index]), (player.fall_count, player.jump_count))
+            self.assertEqual((bool(store.hit[index]), store.hit_count[index]), (player.hit, player.hit_count))
+
+    def test_write_back_copies_state(self):
+        store = EntityStore()
+        index = store.add(10, 20, 50, 50)
+        store.x_vel[index] = 5
+        store.step(60)
+        player = Player(0, 0, 50, 50)
+
+        store.write_back(index, player)
+
+        self.assertEqual((player.rect.x, player.rect.y), (15, 20))
+        self.assertEqual(player.fall_count, 1)
+
+
+class TestApp(unittest.TestCase):
+
+    def test_import_does_not_open_display(self):
+        code = "import pygame, tutorial; print(pygame.display.get_init(), pygame.display.get_surface())"
+        env = dict(os.environ, SDL_VIDEODRIVER="dummy")
+
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+
+        self.assertEqual(output.splitlines()[-1], "False None")
+
+    def test_menu_buttons_are_loaded_on_first_use(self):
+        app = App()
+
+        with patch("pygame.image.load", return_value=pygame.Surface((21, 22))) as mock_image_load:
+            mock_image_load.assert_not_called()
+            buttons = app.level_buttons
+
+        self.assertEqual(sorted(buttons), [1, 2, 3])
+        self.assertIs(app.level_buttons, buttons)
+        self.assertEqual(mock_image_load.call_count, 3)
+        self.assertEqual(len(app.buttons()), 3 + 8)
+
+
+class TestMenu(unittest.TestCase):
+
+    def setUp(self):
+        self.menu = Menu(App())
+        self.window = pygame.Surface((WIDTH, HEIGHT))
+        for name in ("skin", "skin_2"):
+            patcher = patch(f"tutorial.{name}", "MaskDude")
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def center(self, action):
+        return dict(self.menu.items)[action].rect.center
+
+    def test_hover_changes_only_when_button_under_cursor_changes(self):
+        with patch("pygame.display.update"):
+            self.menu.draw(self.window)
+        pos = self.center(("level", 2))
+
+        self.menu.handle(pygame.event.Event(pygame.MOUSEMOTION, pos=pos))
+        self.assertTrue(self.menu.changed)
+        self.assertEqual(self.menu.hovered, ("level", 2))
+        self.menu.changed = False
+        self.menu.handle(pygame.event.Event(pygame.MOUSEMOTION, pos=(pos[0] + 1, pos[1])))
+        self.assertFalse(self.menu.changed)
+        self.menu.handle(pygame.event.Event(pygame.MOUSEMOTION, pos=(5, 5)))
+        self.assertIsNone(self.menu.hovered)
+
+    def test_click_selects_skin_or_returns_level(self):
+        click = pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1, pos=self.center(("skin", 2, "PinkMan")))
+
+        with patch("builtins.print"):
+            self.assertIsNone(self.menu.handle(click))
+        self.assertEqual(tutorial.skin_2, "PinkMan")
+        self.assertEqual(tutorial.skin, "MaskDude")
+        self.assertTrue(self.menu.selected(("skin", 2, "PinkMan")))
+
+        click = pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1, pos=self.center(("level", 3)))
+        self.assertEqual(self.menu.handle(click), 3)
+
+    def test_redraw_updates_only_changed_buttons(self):
+        with patch("pygame.display.update") as mock_update:
+            self.menu.draw(self.window)
+            self.menu.handle(pygame.event.Event(pygame.MOUSEMOTION, pos=self.center(("level", 1))))
+            self.menu.draw(self.window)
+
+        self.assertEqual(mock_update.call_args_list[0], call())
+        regions = mock_update.call_args_list[1].args[0]
+        self.assertEqual(len(regions), 1)
+        self.assertTrue(regions[0].contains(dict(self.menu.items)[("level", 1)].rect))
+
+    @patch("pygame.event.get", return_value=[])
+    @patch("pygame.event.wait")
+    def test_run_sleeps_in_event_wait(self, mock_wait, mock_get):
+        mock_wait.side_effect = [pygame.event.Event(pygame.NOEVENT), pygame.event.Event(pygame.QUIT)]
+        self.menu.app = MagicMock(window=self.window)
+
+        with patch("pygame.display.update") as mock_update:
+            self.menu.run()
+
+        self.assertEqual([call.args for call in mock_wait.call_args_list], [(tutorial.MENU_IDLE_WAIT,)] * 2)
+        mock_update.assert_called_once()
+
+    @patch("tutorial.RENDER_FPS", 0)
+    @patch("pygame.event.get", return_value=[])
+    @patch("pygame.event.wait")
+    def test_uncapped_render_fps_waits_fixed_time_while_loading(self, mock_wait, mock_get):
+        mock_wait.side_effect = [pygame.event.Event(pygame.QUIT)]
+        self.menu.app = MagicMock(window=self.window)
+        self.menu.preloader = MagicMock(progress=0.5)
+        self.menu.preloader.step.return_value = False
+
+        with patch("pygame.display.update"):
+            self.menu.run()
+
+        mock_wait.assert_called_once_with(tutorial.MENU_LOADING_WAIT)
+
+
+class TestAssetPreloader(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in (("sprite_cache", SpriteCache()), ("resources", ResourceManager())):
+            patcher = patch(f"tutorial.{name}", value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_level_is_built_without_reading_images(self):
+        preloader = AssetPreloader(levels={1: LEVELS[1]}, skins=["MaskDude"], workers=2)
+        self.addCleanup(preloader.close)
+
+        preloader.start()
+        preloader.finish()
+
+        self.assertTrue(preloader.finished)
+        self.assertEqual(preloader.progress, 1.0)
+        with patch("pygame.image.load", side_effect=AssertionError("image loaded on level start")):
+            level = build_level(1)
+            tutorial.resources.background(level.background, tutorial.BACKGROUND_PARALLAX)
+
+    def test_step_finishes_decoded_jobs_in_slices(self):
+        preloader = AssetPreloader(levels={}, skins=["NinjaFrog"], workers=2)
+        self.addCleanup(preloader.close)
+        preloader.start()
+
+        steps = 0
+        while not preloader.step(budget=0):
+            self.assertLessEqual(preloader.done, steps + 1)
+            steps += 1
+
+        self.assertEqual(preloader.done, preloader.total)
+        self.assertEqual(preloader.skin_jobs, len(os.listdir(join("assets", "MainCharacters", "NinjaFrog"))))
+        self.assertIn(("MainCharacters", "NinjaFrog", 32, 32, True), tutorial.sprite_cache)
+
+
+class TestHeadless(unittest.TestCase):
+
+    def test_idle_level_runs_requested_ticks(self):
+        result = run_headless(build_level(1), max_ticks=120)
+
+        self.assertIsNone(result.outcome)
+        self.assertEqual(result.ticks, 120)
+        self.assertGreater(result.ticks_per_second, 0)
+
+    def test_headless_option_selects_dummy_driver_in_any_form(self):
+        code = "import os, sys; sys.argv[1:] = {!r}; import tutorial; print(os.environ.get('SDL_VIDEODRIVER'))"
+        env = {name: value for name, value in os.environ.items() if name != "SDL_VIDEODRIVER"}
+
+        for argv, expected in ((["--headless=2"], "dummy"), (["--replay=x.inpt"], "dummy"),
+                               (["--replay", "x.inpt", "--speed=2"], "None"), (["--headlessly"], "None")):
+            output = subprocess.run([sys.executable, "-c", code.format(argv)], capture_output=True, text=True,
+                                    env=env, cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+            self.assertEqual(output.splitlines()[-1], expected, argv)
+
+    def test_scripted_input_moves_player(self):
+        level = build_level(1)
+        start_x = level.player.rect.x
+        script = [NO_INPUT] * 30 + [TickInput((), KeyState([pygame.K_d]), False)] * 20
+
+        run_headless(level, ScriptedInput(script), max_ticks=50)
+
+        self.assertGreater(level.player.rect.x, start_x)
+        self.assertEqual(level.player.direction, "right")
+
+    def test_escape_quits_level(self):
+        script = [NO_INPUT, TickInput((pygame.K_ESCAPE,), KeyState(), False)]
+
+        result = run_headless(build_level(1), ScriptedInput(script), max_ticks=100)
+
+        self.assertEqual(result.outcome, "quit")
+        self.assertEqual(result.ticks, 2)
+
+
+class TestFixedTimestep(unittest.TestCase):
+
+    def test_render_pos_interpolates_between_steps(self):
+        player = Player(100, 200, 50, 50)
+        player.prev_pos = (100, 200)
+        player.rect.topleft = (110, 190)
+
+        self.assertEqual(player.render_pos(0), (100, 200))
+        self.assertEqual(player.render_pos(0.5), (105, 195))
+        self.assertEqual(player.render_pos(), (110, 190))
+
+    def test_slow_rendering_catches_up_on_physics_steps(self):
+        level = build_level(1)
+        frame_times = iter(i / 30 for i in range(100))
+        script = [NO_INPUT] * (3 + 3 * 2) + [TickInput((pygame.K_ESCAPE,), KeyState(), False)]
+
+        with patch("tutorial.time.perf_counter", lambda: next(frame_times)):
+            outcome = run_level(pygame.Surface((WIDTH, HEIGHT)), level, ScriptedInput(script))
+
+        self.assertEqual(outcome, "quit")
+        self.assertEqual(level.tick, 3 + 3 * 2 + 1)
+        self.assertEqual(level.time, (level.tick - 1) / FPS)
+
+
+    def test_quit_in_frame_without_physics_step_is_kept(self):
+        level = build_level(1)
+        # Кадры идут чаще тактов физики: на втором кадре шага нет, и закрытие окна
+        # должно дождаться следующего.
+        frame_times = iter(i / (FPS * 4) for i in range(100))
+        polls = iter([TickInput((), KeyState(), False), TickInput((), KeyState(), True)])
+        controls = MagicMock(per_tick=False)
+        controls.poll.side_effect = lambda: next(polls, NO_INPUT)
+
+        with patch("tutorial.time.perf_counter", lambda: next(frame_times)):
+            outcome = run_level(pygame.Surface((WIDTH, HEIGHT)), level, controls)
+
+        self.assertEqual(outcome, "quit")
+
+
+class TestFrameProfiler(unittest.TestCase):
+
+    def test_ring_buffer_keeps_last_frames(self):
+        clock = iter(range(100))
+        profiler = FrameProfiler(size=4)
+
+        with patch("tutorial.time.perf_counter", lambda: next(clock) / 1000):
+            for _ in range(6):
+                profiler.begin_frame()
+                profiler.mark("loop")
+                profiler.mark("loop")
+                profiler.mark("draw")
+
+        self.assertEqual(len(profiler), 4)
+        self.assertEqual([row[0] for row in profiler.rows()], [2, 3, 4, 5])
+        percentiles = profiler.percentiles()
+        self.assertAlmostEqual(percentiles["loop"][0], 2)
+        self.assertAlmostEqual(percentiles["frame"][2], 3)
+        self.assertEqual(percentiles["scan"], (0, 0, 0))
+
+    def test_run_level_exports_phases(self):
+        profiler = FrameProfiler()
+        script = [NO_INPUT] * 5 + [TickInput((pygame.K_ESCAPE,), KeyState(), False)]
+
+        run_level(pygame.Surface((WIDTH, HEIGHT)), build_level(1), ScriptedInput(script), profiler=profiler)
+
+        self.assertGreater(len(profiler), 0)
+        self.assertGreater(sum(row[FrameProfiler.PHASES.index("loop") + 1] for row in profiler.rows()), 0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = join(directory, "frames.csv")
+            profiler.export_csv(path)
+            with open(path) as file:
+                lines = file.read().splitlines()
+        self.assertEqual(lines[0], "frame," + ",".join(FrameProfiler.PHASES) + ",total")
+        self.assertEqual(len(lines), len(profiler) + 1)
+
+    def test_profiling_is_off_until_overlay_is_toggled(self):
+        quit_input = TickInput((pygame.K_ESCAPE,), KeyState(), False)
+        toggle = TickInput((pygame.K_F3,), KeyState(), False)
+
+        level = build_level(1)
+        with patch.object(FrameProfiler, "mark") as mock_mark:
+            run_level(pygame.Surface((WIDTH, HEIGHT)), level, ScriptedInput([NO_INPUT] * 20 + [quit_input]))
+        mock_mark.assert_not_called()
+        self.assertIsNone(level.profiler)
+
+        level = build_level(1)
+        with patch.object(FrameProfiler, "overlay", return_value=[]) as mock_overlay:
+            run_level(pygame.Surface((WIDTH, HEIGHT)), level, ScriptedInput([toggle] + [NO_INPUT] * 20 + [quit_input]))
+        mock_overlay.assert_called()
+        self.assertIsInstance(level.profiler, FrameProfiler)
+
+    def test_frames_measured_with_overlay_are_exported_after_level(self):
+        quit_input = TickInput((pygame.K_ESCAPE,), KeyState(), False)
+        toggle = TickInput((pygame.K_F3,), KeyState(), False)
+
+        for script, exported in (([NO_INPUT] * 5 + [quit_input], 0), ([toggle] + [NO_INPUT] * 5 + [quit_input], 1)):
+            def run(window, level, profiler=None, rewind=None, measure_all=True):
+                return run_level(window, level, ScriptedInput(script), profiler=profiler, measure_all=measure_all)
+
+            with tempfile.TemporaryDirectory() as directory, patch("tutorial.DEFAULT_PROFILE_DIR", directory), \
+                    patch("tutorial.run_level", side_effect=run), \
+                    patch.object(FrameProfiler, "overlay", return_value=[]):
+                tutorial._play(pygame.Surface((WIDTH, HEIGHT)), 1, build_level(1))
+                self.assertEqual(len(os.listdir(directory)), exported)
+
+
+class TestReplay(unittest.TestCase):
+
+    SCRIPT = ([TickInput((), KeyState({pygame.K_d}), False)] * 40
+              + [TickInput((pygame.K_w,), KeyState({pygame.K_a, pygame.K_RIGHT}), False)]
+              + [TickInput((), KeyState({pygame.K_a}), False)] * 40)
+
+    def record(self):
+        log = InputLog(1)
+        run_headless(build_level(1), ScriptedInput(self.SCRIPT), on_tick=log.record, max_ticks=len(self.SCRIPT))
+        return log
+
+    def test_saved_log_replays_identically(self):
+        log = self.record()
+        with tempfile.TemporaryDirectory() as directory:
+            path = join(directory, "level1.inpt")
+            log.save(path)
+            loaded = InputLog.load(path)
+
+        self.assertEqual(loaded.inputs, log.inputs)
+        self.assertEqual(loaded.hashes, log.hashes)
+        result = replay(loaded)
+        self.assertEqual(result.ticks, len(self.SCRIPT))
+
+    def test_replay_uses_recorded_skins(self):
+        # С хитбоксами MaskDude игроки упираются в стены по-другому, и этот сценарий расходится.
+        script = [TickInput((pygame.K_w, pygame.K_SPACE) if tick % 40 == 0 else (),
+                            KeyState({pygame.K_d, pygame.K_RIGHT}), False) for tick in range(600)]
+        with patch("tutorial.skin", "NinjaFrog"), patch("tutorial.skin_2", "PinkMan"):
+            log = InputLog(1)
+            run_headless(build_level(1), ScriptedInput(script), on_tick=log.record, max_ticks=len(script))
+        with tempfile.TemporaryDirectory() as directory:
+            path = join(directory, "level1.inpt")
+            log.save(path)
+            loaded = InputLog.load(path)
+
+        self.assertEqual(loaded.skins, ("NinjaFrog", "PinkMan"))
+        self.assertEqual(replay(loaded).ticks, len(log))
+        self.assertEqual((tutorial.skin, tutorial.skin_2), ("MaskDude", "MaskDude"))
+
+    def test_replay_closes_streaming_level(self):
+        log = InputLog(1, streaming=True)
+        run_headless(build_level(1, True), ScriptedInput(self.SCRIPT), on_tick=log.record, max_ticks=len(self.SCRIPT))
+
+        with patch.object(StreamingLevel, "close", autospec=True) as mock_close:
+            replay(log)
+
+        mock_close.assert_called_once()
+
+    def test_divergence_reports_first_bad_tick(self):
+        log = self.record()
+        log.inputs[10] = NO_INPUT
+
+        with self.assertRaises(ReplayDivergence) as caught:
+            replay(log)
+        self.assertEqual(caught.exception.tick, 10)
+
+    def test_replay_in_window_runs_faster_than_real_time(self):
+        log = self.record()
+        frame_times = iter(i / 30 for i in range(100))
+
+        with patch("tutorial.time.perf_counter", lambda: next(frame_times)):
+            outcome = replay(log, pygame.Surface((WIDTH, HEIGHT)), speed=4)
+
+        self.assertEqual(outcome, "quit")
+
+    def test_load_rejects_truncated_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = join(directory, "level1.inpt")
+            self.record().save(path)
+            with open(path, "r+b") as file:
+                file.truncate(40)
+            with self.assertRaises(ValueError):
+                InputLog.load(path)
+
+
+class TestBench(unittest.TestCase):
+
+    def test_synthetic_level_has_requested_size(self):
+        data = synthetic_level(1000, mobs=200)
+
+        level = build_level_from_data(data)
+        self.assertEqual(len(level.objects) + len(level.terrain), 1000)
+        self.assertEqual(sum(isinstance(obj, Mob) for obj in level.objects), 200)
+        self.assertTrue(all(x >= WIDTH for x, y, w, h in data.fruits + data.mobs))
+
+    def test_check_thresholds_reports_only_regressions(self):
+        results = {"benchmarks": {"collide/1000": {"median_ms": 0.5}, "draw/1000": {"median_ms": 2.0},
+                                  "new/1000": {"median_ms": 9.0}}}
+
+        regressions = check_thresholds(results, {"collide/1000": 1.0, "draw/1000": 1.5})
+
+        self.assertEqual(regressions, [("draw/1000", 2.0, 1.5)])
+
+
+class TestLevelFormat(unittest.TestCase):
+
+    LEVEL = {
+        "background": "Pink.png",
+        "block_size": 96,
+        "fall_limit": 630,
+        "win": {"fruits": 1, "mobs": 1},
+        "spawn": {"player": [-100, 300], "player_2": [0, 300]},
+        "floor": {"from": -2, "to": 3, "gaps": [[0, 1]]},
+        "tiles": [[2, 3]],
+        "fruits": [[10, 20, 32, 32]],
+        "mobs": [[100, 200, 64, 64]],
+        "buffs": [[300, 200, 64, 64]],
+    }
+
+    def test_parse_expands_floor_and_tiles(self):
+        data = parse_level(self.LEVEL)
+
+        self.assertEqual(data.tiles, [(-192, HEIGHT - 96), (-96, HEIGHT - 96), (0, HEIGHT), (96, HEIGHT),
+                                      (192, HEIGHT - 96), (192, HEIGHT - 288)])
+        self.assertEqual(data.round_time, 100)
+        self.assertEqual(data.spawn_2, (0, 300))
+
+    def test_fractional_coordinates_are_truncated(self):
+        level = dict(self.LEVEL, fruits=[[998.4, 429.2, 32, 32]],
+                     spawn={"player": [-1000.5, 300], "player_2": [0, 300]})
+
+        data = parse_level(level)
+
+        self.assertEqual(data.fruits, [(998, 429, 32, 32)])
+        self.assertEqual(data.spawn, (-1000, 300))
+        self.assertEqual(read_compiled_level(compile_level(data)), data)
+
+    def test_invalid_values_are_rejected(self):
+        for level in (dict(self.LEVEL, fruits=[[1, 2, 3]]), dict(self.LEVEL, fall_limit="630"),
+                      dict(self.LEVEL, background="x" * 65 + ".png")):
+            with self.assertRaises(ValueError):
+                parse_level(level)
+
+    def test_failed_compile_leaves_no_cache_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = join(directory, "level.json")
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(self.LEVEL, file)
+            cache_dir = join(directory, "cache")
+
+            with patch("tutorial.compile_level", side_effect=struct.error("bad")), self.assertRaises(struct.error):
+                load_level_data(path, cache_dir)
+
+            self.assertFalse(os.path.exists(join(cache_dir, "level.lvlc")))
+
+    def test_compiled_level_round_trips(self):
+        data = parse_level(self.LEVEL)
+
+        blob = compile_level(data, 123, 456)
+
+        self.assertEqual(read_compiled_level(blob, 123, 456), data)
+        with self.assertRaises(ValueError):
+            read_compiled_level(blob, 124, 456)
+        with self.assertRaises(ValueError):
+            read_compiled_level(blob[:-1])
+
+    def test_load_level_data_writes_and_reuses_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = join(directory, "level.json")
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(self.LEVEL, file)
+            cache_dir = join(directory, "cache")
+
+            first = load_level_data(path, cache_dir)
+            with patch("tutorial.parse_level") as mock_parse:
+                second = load_level_data(path, cache_dir)
+
+            mock_parse.assert_not_called()
+            self.assertEqual(first, second)
+            self.assertTrue(os.path.exists(join(cache_dir, "level.lvlc")))
+
+    def test_build_level_from_data(self):
+        level = build_level_from_data(parse_level(self.LEVEL))
+
+        kinds = [type(obj) for obj in level.objects]
+        self.assertEqual(len(level.terrain), 6)
+        self.assertNotIn(Block, kinds)
+        self.assertEqual(kinds.count(Fruit), 1)
+        self.assertEqual(kinds.count(Mob), 1)
+        self.assertIsInstance(level.buff, Buff)
+        self.assertEqual(level.player.rect.topleft, (-100, 300))
+
+
+class TestLevelReset(unittest.TestCase):
+
+    SCRIPT = [TickInput((pygame.K_w,) if tick % 40 == 0 else (), KeyState({pygame.K_d, pygame.K_LEFT}), False)
+              for tick in range(300)]
+
+    def play(self, level):
+        log = InputLog(1)
+        run_headless(level, ScriptedInput(self.SCRIPT), max_ticks=len(self.SCRIPT), on_tick=log.record)
+        return log.hashes
+
+    def test_reset_replays_like_a_fresh_level(self):
+        level = build_level(1)
+        initial = state_hash(level)
+        expected = self.play(build_level(1))
+
+        self.play(level)
+        level.remove(next(iter(level.objects.fruits)))
+        level.reset()
+
+        self.assertEqual(state_hash(level), initial)
+        self.assertEqual(self.play(level), expected)
+
+    def test_reset_does_not_share_rects_with_snapshot(self):
+        level = build_level(1)
+        spawn = level.player.rect.topleft
+
+        level.reset()
+        level.player.rect.x += 100
+        level.reset()
+
+        self.assertEqual(level.player.rect.topleft, spawn)
+
+
+class TestLevelPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = LevelPool(maxsize=2)
+        self.addCleanup(self.pool.close)
+
+    def test_level_is_reused_after_reset(self):
+        level = self.pool.get(1)
+        level.step(NO_INPUT)
+        level.remove(next(iter(level.objects.fruits)))
+
+        with patch("tutorial.build_level") as mock_build:
+            again = self.pool.get(1)
+
+        mock_build.assert_not_called()
+        self.assertIs(again, level)
+        self.assertEqual(again.tick, 0)
+        self.assertEqual(len(again.objects.fruits), len(build_level(1).objects.fruits))
+
+    def test_prebuilt_level_is_read_in_background_and_built_on_main_thread(self):
+        threads = []
+
+        def build(data):
+            threads.append(threading.current_thread())
+            return build_level_from_data(data)
+
+        with patch("tutorial.build_level_from_data", side_effect=build):
+            self.pool.prebuild(2)
+            self.pool.prebuild(99)
+            with patch("tutorial.build_level") as mock_build:
+                level = self.pool.get(2)
+
+        mock_build.assert_not_called()
+        self.assertEqual(threads, [threading.main_thread()])
+        self.assertEqual(level.tick, 0)
+        self.assertNotIn((99, False, tutorial.skin, tutorial.skin_2), self.pool)
+
+    def test_skin_change_builds_new_level_and_evicts_old(self):
+        level = self.pool.get(1)
+        with patch("tutorial.skin", "NinjaFrog"):
+            other = self.pool.get(1)
+        self.pool.get(2)
+
+        self.assertIsNot(other, level)
+        self.assertEqual(len(self.pool), 2)
+
+    def test_close_closes_streaming_levels(self):
+        level = self.pool.get(1, True)
+        self.pool.get(2)
+
+        with patch.object(StreamingLevel, "close", autospec=True) as mock_close:
+            self.pool.close()
+
+        self.assertEqual([args for args, _ in mock_close.call_args_list], [(level,)])
+        self.assertEqual(len(self.pool), 0)
+
+    def test_failed_prebuild_is_evicted_and_closed_quietly(self):
+        key = (2, True, tutorial.skin, tutorial.skin_2)
+        with patch("tutorial.read_level", side_effect=OSError("broken level")):
+            self.pool.prebuild(2, True)
+            self.assertIsInstance(self.pool._levels[key].exception(), OSError)
+
+        with self.assertNoLogs("concurrent.futures"):
+            self.pool.get(1)
+            self.pool.get(3)
+        self.assertNotIn(key, self.pool)
+
+        with patch("tutorial.read_level", side_effect=OSError("broken level")):
+            self.pool.prebuild(2, True)
+            self.pool.close()
+        self.assertEqual(len(self.pool), 0)
+
+    def test_win_advances_to_next_level(self):
+        played = []
+
+        def run(window, level, **kwargs):
+            played.append(level)
+            return "win" if len(played) == 1 else "lose"
+
+        with patch("tutorial.level_pool", self.pool), patch("tutorial.run_level", side_effect=run), \
+                patch.object(self.pool, "get", wraps=self.pool.get) as mock_get:
+            outcome = play_level(None, 1)
+
+        self.assertEqual(outcome, "lose")
+        self.assertEqual([args for args, _ in mock_get.call_args_list], [(1, False), (2, False)])
+        self.assertEqual(len(played), 2)
+        self.assertIn((3, False, tutorial.skin, tutorial.skin_2), self.pool)
+
+
+class TestStreamingLevel(unittest.TestCase):
+
+    LEVEL = {
+        "background": "Pink.png",
+        "block_size": 96,
+        "fall_limit": 630,
+        "win": {"fruits": 3, "mobs": 0},
+        "spawn": {"player": [-1000, 300], "player_2": [-900, 300]},
+        "floor": {"from": -11, "to": 200},
+        "fruits": [[-700, 200, 32, 32], [5000, 200, 32, 32], [15000, 200, 32, 32]],
+        "buffs": [[-800, 100, 64, 64]],
+    }
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = join(self.directory.name, "long.json")
+        with open(self.path, "w", encoding="utf-8") as file:
+            json.dump(self.LEVEL, file)
+
+    def test_chunk_file_reads_single_chunk(self):
+        data = parse_level(self.LEVEL)
+        chunk_path = join(self.directory.name, "long.lvls")
+        write_chunk_file(data, chunk_path, chunk_width=1000)
+
+        chunks = ChunkFile(chunk_path)
+        self.addCleanup(chunks.close)
+        tiles, entities = chunks.read(5)
+
+        self.assertEqual(len(tiles), len([x for x, _ in data.tiles if 5000 <= x < 6000]))
+        self.assertEqual(entities, [(1, 0, 5000, 200, 32, 32)])
+        self.assertEqual(chunks.buff_id, 3)
+        self.assertEqual(chunks.read(1000), ([], []))
+
+    def test_only_chunks_near_camera_are_loaded(self):
+        level = load_streaming_level(self.path, self.directory.name)
+        self.addCleanup(level.close)
+        total = len(parse_level(self.LEVEL).tiles)
+
+        self.assertLess(len(level.terrain), total // 4)
+        self.assertEqual(sorted(level.loaded), [-2, -1, 0])
+
+        level.offset_x = 14000
+        level.player.rect.x = level.player_2.rect.x = 14500
+        level.stream()
+
+        self.assertEqual(sorted(level.loaded), [13, 14, 15, 16])
+        self.assertIn(15000, [obj.rect.x for obj in level.objects if isinstance(obj, Fruit)])
+
+    def test_terrain_grid_does_not_grow_with_distance(self):
+        level = load_streaming_level(self.path, self.directory.name)
+        self.addCleanup(level.close)
+        columns = []
+        for x in range(0, 18000, 500):
+            level.offset_x = x
+            level.player.rect.x = level.player_2.rect.x = x + 500
+            level.stream()
+            columns.append(level.terrain.cols)
+
+        window = len(level.wanted_chunks()) * level.chunks.chunk_width // level.terrain.size
+        self.assertLessEqual(max(columns), 2 * window)
+        self.assertEqual({tile.rect.topleft for tile in level.terrain},
+                         {tuple(position) for tiles in level.chunk_tiles.values() for position in tiles})
+
+    def test_collected_entities_do_not_respawn(self):
+        level = load_streaming_level(self.path, self.directory.name)
+        self.addCleanup(level.close)
+        fruit = next(obj for obj in level.objects if isinstance(obj, Fruit))
+        buff = next(obj for obj in level.objects if isinstance(obj, Buff))
+
+        level.remove(fruit)
+        level.remove(buff)
+        level.unload_chunk(-1)
+        level.load_chunk(-1)
+
+        self.assertFalse(any(isinstance(obj, (Fruit, Buff)) for obj in level.loaded[-1]))
+        self.assertFalse(level.buff_alive())
+
+    def test_reset_brings_back_collected_entities(self):
+        level = load_streaming_level(self.path, self.directory.name)
+        self.addCleanup(level.close)
+        fruit = next(obj for obj in level.objects if isinstance(obj, Fruit))
+        level.remove(fruit)
+        level.offset_x = 14000
+        level.stream()
+
+        level.reset()
+
+        self.assertEqual(sorted(level.loaded), [-2, -1, 0])
+        self.assertTrue(level.buff_alive())
+        self.assertIn((fruit.rect.x, fruit.rect.y), [(obj.rect.x, obj.rect.y) for obj in level.objects.fruits])
+
+    def test_rewind_brings_back_collected_entities(self):
+        level = load_streaming_level(self.path, self.directory.name)
+        self.addCleanup(level.close)
+        rewind = RewindBuffer()
+        level.step(NO_INPUT)
+        rewind.record(level)
+        expected = state_hash(level)
+
+        level.remove(next(obj for obj in level.objects if isinstance(obj, Buff)))
+        level.step(NO_INPUT)
+        rewind.record(level)
+        rewind.rewind(level, 1)
+
+        self.assertTrue(level.buff_alive())
+        self.assertEqual(state_hash(level), expected)
+
+
+class TestRewindBuffer(unittest.TestCase):
+
+    SCRIPT = [TickInput((pygame.K_w,) if tick % 40 == 0 else (), KeyState({pygame.K_d, pygame.K_LEFT}), False)
+              for tick in range(300)]
+
+    def play(self, level, rewind=None, ticks=len(SCRIPT)):
+        hashes = []
+        while level.tick < ticks:
+            level.time = level.tick / FPS
+            level.step(self.SCRIPT[level.tick])
+            hashes.append(state_hash(level))
+            if rewind is not None:
+                rewind.record(level)
+        return hashes
+
+    def test_rewind_restores_recorded_ticks(self):
+        expected = self.play(build_level(1))
+        level = build_level(1)
+        rewind = RewindBuffer()
+        self.play(level, rewind, 200)
+
+        self.assertEqual(rewind.rewind(level, 130), 70)
+        self.assertEqual(state_hash(level), expected[69])
+        self.assertEqual(len(rewind), 70)
+        self.assertEqual(self.play(level, rewind), expected[70:])
+
+    def test_rewind_brings_back_collected_fruits(self):
+        level = build_level(1)
+        rewind = RewindBuffer()
+        level.step(NO_INPUT)
+        rewind.record(level)
+        fruit = next(iter(level.objects.fruits))
+
+        level.remove(fruit)
+        level.fruits_collected += 1
+        level.step(NO_INPUT)
+        rewind.record(level)
+        rewind.rewind(level, 1)
+
+        self.assertIn(fruit, level.objects.fruits)
+        self.assertEqual((level.consumed, level.fruits_collected, level.tick), (set(), 0, 1))
+
+    def test_buffer_is_bounded_and_stores_deltas(self):
+        level = build_level(1)
+        rewind = RewindBuffer(seconds=1, keyframe=FPS // 2)
+        self.play(level, rewind, FPS * 3)
+
+        self.assertEqual(len(rewind), FPS)
+        self.assertEqual(rewind.rewind(level, FPS * 10), FPS * 2 + 1)
+        self.assertLess(rewind.nbytes, FPS * RewindBuffer._FRAME.size // 2)
+
+    def test_new_run_clears_buffer(self):
+        level = build_level(1)
+        rewind = RewindBuffer()
+        self.play(level, rewind, 50)
+        level.reset()
+        self.play(level, rewind, 10)
+
+        self.assertEqual(len(rewind), 10)
+
+    def test_quicksave_and_quickload(self):
+        level = build_level(1)
+        rewind = RewindBuffer()
+        self.play(level, rewind, 50)
+        expected = state_hash(level)
+
+        self.assertFalse(rewind.control(level, TickInput((QUICKSAVE_KEY,), KeyState(), False)))
+        self.play(level, rewind, 120)
+        self.assertTrue(rewind.control(level, TickInput((QUICKLOAD_KEY,), KeyState(), False)))
+
+        self.assertEqual(state_hash(level), expected)
+        self.assertEqual(len(rewind), 0)
+        self.assertFalse(rewind.control(level, TickInput((REWIND_KEY,), KeyState(), False)))
+
+
 if __name__ == "__main__":
     unittest.main()
 